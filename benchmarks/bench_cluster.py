@@ -0,0 +1,94 @@
+"""Run a control plane and several worker agents on this host and place scripts.
+
+    python benchmarks/bench_cluster.py --workers 3 --users 60
+
+Starts the bot as control plane (in-process, against FakeTelegramAPI), spawns
+worker_agent.py processes on Unix sockets, replays /startfile for every user
+and reports start latency and how scripts were spread over the workers.
+"""
+import argparse
+import json
+import os
+import secrets
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_handlers import build_stream, run_scenario, setup_bot
+from fake_telegram import FakeTelegramAPI
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def wait_for(predicate, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--users', type=int, default=30)
+    parser.add_argument('--capacity', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=4)
+    args = parser.parse_args()
+    args.rounds = 1
+    args.broadcast_delay = 0
+
+    run_dir = tempfile.mkdtemp(prefix='ultimine-cluster-')
+    control = f"unix:{os.path.join(run_dir, 'control.sock')}"
+    os.environ['CLUSTER_LISTEN'] = control
+    os.environ['CLUSTER_SECRET'] = secrets.token_hex(16)  # inherited by the worker agents
+
+    api = FakeTelegramAPI().start()
+    hosting, users, _ = setup_bot(args, api)
+    hosting.start_cluster()
+
+    agents = []
+    for i in range(args.workers):
+        worker_id = f"w{i + 1}"
+        agents.append(subprocess.Popen([
+            sys.executable, os.path.join(ROOT, 'worker_agent.py'),
+            '--id', worker_id,
+            '--listen', f"unix:{os.path.join(run_dir, worker_id + '.sock')}",
+            '--control', control,
+            '--capacity', str(args.capacity),
+            '--data-dir', os.path.join(run_dir, worker_id)
+        ]))
+
+    try:
+        joined = time.perf_counter()
+        if not wait_for(lambda: len(hosting.workers) == args.workers, 30):
+            sys.exit(f"Only {len(hosting.workers)} of {args.workers} workers joined")
+        joined = time.perf_counter() - joined
+
+        result = run_scenario(hosting, api, 'startfile', build_stream('startfile', users, 1, 0), args.concurrency)
+        wait_for(lambda: sum(w['running'] for w in hosting.workers.values()) >= len(users),
+                 3 * hosting.CLUSTER_HEARTBEAT_INTERVAL)
+
+        placement = {worker_id: 0 for worker_id in hosting.workers}
+        for worker_id in hosting.cluster_scripts.values():
+            placement[worker_id] += 1
+        print(json.dumps({
+            'workers_joined_seconds': round(joined, 3),
+            'startfile': result,
+            'placement': placement,
+            'confirmed_running': {w: info['running'] for w, info in hosting.workers.items()}
+        }, indent=2))
+
+        run_scenario(hosting, api, 'stopfile', build_stream('stopfile', users, 1, 0), args.concurrency)
+    finally:
+        for agent in agents:
+            agent.terminate()
+        api.stop()
+
+
+if __name__ == '__main__':
+    main()
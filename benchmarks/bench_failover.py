@@ -0,0 +1,126 @@
+"""Measure active-standby failover time against the fake Bot API.
+
+    python benchmarks/bench_failover.py --runs 3
+
+Starts two bot processes with HA_ENABLED=1 on one DATA_DIR, starts a script
+through the leader, SIGKILLs the leader and measures the time until the
+standby's first getUpdates. It then asks /listfiles to check the script was
+adopted (still running, same pid) rather than restarted.
+"""
+import argparse
+import json
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_handlers import SAMPLE_SCRIPT, command_update
+from fake_telegram import FakeTelegramAPI
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USER_ID = 1000
+
+
+def wait_for(predicate, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        result = predicate()
+        if result:
+            return result
+        time.sleep(0.05)
+    return None
+
+
+def lease_holder(data_dir):
+    try:
+        with sqlite3.connect(os.path.join(data_dir, 'leader.db')) as conn:
+            row = conn.execute("SELECT holder FROM lease WHERE id = 1").fetchone()
+            return row[0] if row else None
+    except sqlite3.Error:
+        return None
+
+
+def running_pid(data_dir):
+    try:
+        with open(os.path.join(data_dir, 'running.json')) as f:
+            return json.load(f).get(f"{USER_ID}:bench.py", {}).get('pid')
+    except (OSError, ValueError):
+        return None
+
+
+def start_bot(api, data_dir):
+    env = dict(os.environ, HA_ENABLED='1', DATA_DIR=data_dir, TELEGRAM_API_URL=api.url,
+               BOT_TOKEN='123456:BENCH', METRICS_PORT='0')
+    return subprocess.Popen([sys.executable, os.path.join(ROOT, 'ultiminehosting.py')], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def run_once(api):
+    data_dir = tempfile.mkdtemp(prefix='ultimine-failover-')
+    user_dir = os.path.join(data_dir, 'uploads', str(USER_ID))
+    os.makedirs(user_dir)
+    with open(os.path.join(user_dir, 'bench.py'), 'w') as f:
+        f.write(SAMPLE_SCRIPT)
+
+    bots = [start_bot(api, data_dir)]
+    try:
+        holder = wait_for(lambda: lease_holder(data_dir), 30)
+        bots.append(start_bot(api, data_dir))
+        leader = next(b for b in bots if holder.endswith(f":{b.pid}"))
+
+        api.push_update(command_update(USER_ID, '/startfile bench.py'))
+        pid = wait_for(lambda: running_pid(data_dir), 30)
+        if not pid:
+            raise RuntimeError("leader never started the script")
+
+        time.sleep(1)  # let the standby settle into its retry loop
+        killed_at = time.time()
+        os.kill(leader.pid, signal.SIGKILL)
+        first_poll = wait_for(lambda: (lease_holder(data_dir) != holder and api.calls_since('getUpdates', killed_at)), 60)
+        if not first_poll:
+            raise RuntimeError("standby never took over")
+
+        seen = len(api.messages)
+        api.push_update(command_update(USER_ID, '/listfiles'))
+        reply = wait_for(lambda: [m for m in api.messages[seen:] if 'bench.py' in m.get('text', '')], 30)
+        adopted = bool(reply) and 'Running' in reply[0]['text'] and running_pid(data_dir) == pid
+        return {
+            'failover_seconds': round(first_poll[0] - killed_at, 3),
+            'script_adopted': adopted
+        }
+    finally:
+        for bot in bots:
+            bot.kill()
+        pid = running_pid(data_dir)
+        if pid:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--budget', type=float, default=10.0, help='fail if any failover takes longer (seconds)')
+    args = parser.parse_args()
+
+    api = FakeTelegramAPI().start()
+    try:
+        runs = [run_once(api) for _ in range(args.runs)]
+    finally:
+        api.stop()
+
+    worst = max(r['failover_seconds'] for r in runs)
+    print(json.dumps({'runs': runs, 'worst_failover_seconds': worst}, indent=2))
+    if worst > args.budget or not all(r['script_adopted'] for r in runs):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
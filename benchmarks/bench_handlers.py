@@ -0,0 +1,234 @@
+"""Replay synthetic update streams against the real bot handlers.
+
+    python benchmarks/bench_handlers.py --users 200 --concurrency 8 --output run.json
+    python benchmarks/bench_handlers.py --compare run.json
+
+The bot runs against a local FakeTelegramAPI with its data directory in a
+temporary folder. Results are JSON (throughput, p50/p95/p99 latency, RSS,
+thread count per scenario) so runs can be diffed; --compare exits non-zero
+when a scenario regresses by more than --threshold.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_telegram import FakeTelegramAPI
+
+SCENARIOS = ['start', 'status', 'listfiles', 'startfile', 'stopfile', 'callback', 'broadcast']
+CALLBACK_ROUTES = ['main_menu', 'list_files', 'help', 'modules_menu', 'upload_file']
+SAMPLE_SCRIPT = "import time\ntime.sleep(30)\n"
+
+update_ids = itertools.count(1)
+
+
+def make_user(uid):
+    return {'id': uid, 'is_bot': False, 'first_name': f"user{uid}"}
+
+
+def make_message(uid, text):
+    return {
+        'message_id': next(update_ids),
+        'date': int(time.time()),
+        'chat': {'id': uid, 'type': 'private'},
+        'from': make_user(uid),
+        'text': text
+    }
+
+
+def command_update(uid, text):
+    return {'update_id': next(update_ids), 'message': make_message(uid, text)}
+
+
+def callback_update(uid, data):
+    return {'update_id': next(update_ids), 'callback_query': {
+        'id': str(next(update_ids)),
+        'from': make_user(uid),
+        'chat_instance': str(uid),
+        'data': data,
+        'message': make_message(uid, "Main Menu")
+    }}
+
+
+def build_stream(scenario, users, rounds, admin_id):
+    if scenario == 'broadcast':
+        return [callback_update(admin_id, f"broadcast_now:bench {i}") for i in range(rounds)]
+    commands = {
+        'start': '/start',
+        'status': '/status',
+        'listfiles': '/listfiles',
+        'startfile': '/startfile bench.py',
+        'stopfile': '/stopfile bench.py'
+    }
+    stream = []
+    for r in range(rounds if scenario not in ('startfile', 'stopfile') else 1):
+        for uid in users:
+            if scenario == 'callback':
+                stream.append(callback_update(uid, CALLBACK_ROUTES[(uid + r) % len(CALLBACK_ROUTES)]))
+            else:
+                stream.append(command_update(uid, commands[scenario]))
+    return stream
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def process_stats():
+    try:
+        import psutil
+        proc = psutil.Process()
+        return proc.memory_info().rss / (1024 * 1024), proc.num_threads()
+    except ImportError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, threading.active_count()
+
+
+def run_scenario(hosting, api, scenario, stream, concurrency):
+    from telebot import types
+
+    latencies = []
+    lock = threading.Lock()
+
+    def replay(raw):
+        update = types.Update.de_json(raw)
+        started = time.perf_counter()
+        hosting.bot.process_new_updates([update])
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+
+    calls_before = api.total_calls()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(replay, stream))
+    duration = time.perf_counter() - started
+
+    latencies.sort()
+    rss_mb, threads = process_stats()
+    return {
+        'scenario': scenario,
+        'requests': len(stream),
+        'seconds': round(duration, 4),
+        'throughput_rps': round(len(stream) / duration, 2) if duration else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'max_ms': round(latencies[-1] * 1000, 3) if latencies else 0.0,
+        'api_calls': api.total_calls() - calls_before,
+        'rss_mb': round(rss_mb, 2),
+        'threads': threads
+    }
+
+
+def compare(results, baseline, threshold):
+    """Print per-scenario deltas; return the scenarios that regressed"""
+    previous = {r['scenario']: r for r in baseline['results']}
+    regressions = []
+    for result in results['results']:
+        old = previous.get(result['scenario'])
+        if not old:
+            continue
+        p95 = (result['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100 if old['p95_ms'] else 0.0
+        rps = (result['throughput_rps'] - old['throughput_rps']) / old['throughput_rps'] * 100 if old['throughput_rps'] else 0.0
+        print(f"{result['scenario']:>10}: p95 {p95:+7.1f}%  throughput {rps:+7.1f}%", file=sys.stderr)
+        if p95 > threshold or -rps > threshold:
+            regressions.append(result['scenario'])
+    return regressions
+
+
+def setup_bot(args, api):
+    data_dir = tempfile.mkdtemp(prefix='ultimine-bench-')
+    os.environ['DATA_DIR'] = data_dir
+    os.environ['TELEGRAM_API_URL'] = api.url
+    os.environ.setdefault('BOT_TOKEN', '123456:BENCH')
+
+    import ultiminehosting as hosting
+    hosting.bot.threaded = False
+    hosting.BROADCAST_DELAY = args.broadcast_delay
+    if not getattr(args, 'rate_limit', False):
+        hosting.allow_request = lambda arg, name: True
+
+    users = list(range(1000, 1000 + args.users))
+    for uid in users:
+        with open(os.path.join(hosting.ensure_user_dir(uid), 'bench.py'), 'w') as f:
+            f.write(SAMPLE_SCRIPT)
+        hosting.user_limits[str(uid)] = 2
+        hosting.known_users.add(uid)
+    return hosting, users, data_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--rounds', type=int, default=3, help='updates per user per scenario')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--api-latency', type=float, default=0.0, help='seconds added to every fake API call')
+    parser.add_argument('--broadcast-delay', type=float, default=0.0)
+    parser.add_argument('--rate-limit', action='store_true', help='keep the per-user rate limiter on')
+    parser.add_argument('--output', help='write JSON results here instead of stdout')
+    parser.add_argument('--compare', help='baseline JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=20.0, help='allowed regression in percent')
+    args = parser.parse_args()
+
+    api = FakeTelegramAPI(latency=args.api_latency).start()
+    hosting, users, data_dir = setup_bot(args, api)
+
+    results = {
+        'meta': {
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'users': args.users,
+            'concurrency': args.concurrency,
+            'rounds': args.rounds,
+            'api_latency': args.api_latency,
+            'data_dir': data_dir
+        },
+        'results': []
+    }
+
+    try:
+        for scenario in args.scenarios.split(','):
+            if scenario not in SCENARIOS:
+                parser.error(f"unknown scenario {scenario}")
+            stream = build_stream(scenario, users, args.rounds, hosting.ADMIN_IDS[0])
+            result = run_scenario(hosting, api, scenario, stream, args.concurrency)
+            results['results'].append(result)
+            print(f"{scenario:>10}: {result['throughput_rps']:>9.1f} req/s  p50 {result['p50_ms']:.1f}ms  "
+                  f"p95 {result['p95_ms']:.1f}ms  p99 {result['p99_ms']:.1f}ms", file=sys.stderr)
+    finally:
+        for info in list(hosting.processes.values()):
+            info['process'].terminate()
+        api.stop()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print(f"Regressed beyond {args.threshold}%: {', '.join(regressions)}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""Measure how fast the bot process starts.
+
+    python benchmarks/bench_startup.py --runs 5
+    python benchmarks/bench_startup.py --import-budget 250 --ready-budget 2
+
+Reports the import time of ultiminehosting from `python -X importtime` (with
+the slowest modules it pulls in) and the time from spawning the bot to its
+first getUpdates against FakeTelegramAPI. Exits non-zero when the median of
+either exceeds its budget.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_telegram import FakeTelegramAPI
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def bot_env(api_url=None):
+    env = dict(os.environ, DATA_DIR=tempfile.mkdtemp(prefix='ultimine-startup-'),
+               BOT_TOKEN='123456:BENCH', METRICS_PORT='0')
+    env.pop('HA_ENABLED', None)
+    env.pop('CLUSTER_LISTEN', None)
+    if api_url:
+        env['TELEGRAM_API_URL'] = api_url
+    return env
+
+
+def parse_importtime(stderr, module='ultiminehosting'):
+    """Return (cumulative us for module, {direct import: cumulative us}) from -X importtime output"""
+    children = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|', 2)
+        name = name[1:].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 0:
+            if name == module:
+                return int(cumulative), children
+            children = {}  # children are printed before their parent
+        elif depth == 1:
+            children[name.strip()] = int(cumulative)
+    return 0, {}
+
+
+def measure_import():
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ultiminehosting'],
+                            cwd=ROOT, env=bot_env(), capture_output=True, text=True)
+    wall = time.perf_counter() - started
+    if result.returncode != 0:
+        raise RuntimeError(f"import failed:\n{result.stderr[-2000:]}")
+    return wall, parse_importtime(result.stderr)
+
+
+def measure_ready(api):
+    spawned = time.time()
+    bot = subprocess.Popen([sys.executable, os.path.join(ROOT, 'ultiminehosting.py')], env=bot_env(api.url),
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = spawned + 60
+        while time.time() < deadline:
+            polls = api.calls_since('getUpdates', spawned)
+            if polls:
+                return polls[0] - spawned
+            if bot.poll() is not None:
+                raise RuntimeError(f"bot exited with {bot.returncode} before polling")
+            time.sleep(0.005)
+        raise RuntimeError("bot never called getUpdates")
+    finally:
+        bot.kill()
+        bot.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help='slowest imported modules to list')
+    parser.add_argument('--import-budget', type=float, default=400.0, help='median import time allowed (ms)')
+    parser.add_argument('--ready-budget', type=float, default=3.0, help='median time to first getUpdates allowed (s)')
+    args = parser.parse_args()
+
+    imports = [measure_import() for _ in range(args.runs)]
+    import_ms = statistics.median(total / 1000 for _, (total, _) in imports)
+    wall_ms = statistics.median(wall * 1000 for wall, _ in imports)
+    _, (_, children) = imports[-1]
+    slowest = sorted(children.items(), key=lambda item: item[1], reverse=True)[:args.top]
+
+    api = FakeTelegramAPI().start()
+    try:
+        ready = [measure_ready(api) for _ in range(args.runs)]
+    finally:
+        api.stop()
+    ready_s = statistics.median(ready)
+
+    print(json.dumps({
+        'import_ms': round(import_ms, 1),
+        'interpreter_plus_import_ms': round(wall_ms, 1),
+        'slowest_imports_ms': {name: round(us / 1000, 1) for name, us in slowest},
+        'first_get_updates_s': [round(r, 3) for r in ready],
+        'first_get_updates_median_s': round(ready_s, 3)
+    }, indent=2))
+
+    over = []
+    if import_ms > args.import_budget:
+        over.append(f"import {import_ms:.0f}ms > {args.import_budget:.0f}ms")
+    if ready_s > args.ready_budget:
+        over.append(f"first getUpdates {ready_s:.2f}s > {args.ready_budget:.2f}s")
+    if over:
+        print("Over budget: " + ", ".join(over), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""Check the Bot API transport under concurrent sends and injected failures.
+
+    python benchmarks/bench_transport.py --messages 2000 --concurrency 32
+    python benchmarks/bench_transport.py --errors 20 --rate-limits 2 --retry-after 1
+
+Sends --messages sendMessage calls from --concurrency threads through the
+bot's session against FakeTelegramAPI, with --errors 502 answers and
+--rate-limits 429 answers injected. A 502 may come after Telegram delivered
+the message, so each must surface as one failed send rather than be retried.
+Reports throughput, per-attempt latency, retries by reason and how many TCP
+connections the pool opened. Exits non-zero if sends failed other than the
+injected 502s, a send was retried after a 5xx, more connections were opened
+than the pool allows, or sends continued during a 429 pause. Attempts and pauses are
+timestamped in this process, so requests already in flight when the 429
+arrived don't count.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from requests.adapters import HTTPAdapter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_handlers import percentile
+from fake_telegram import FakeTelegramAPI
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--api-latency', type=float, default=0.01, help='seconds added to every fake API call')
+    parser.add_argument('--errors', type=int, default=10, help='sendMessage calls answered with 502')
+    parser.add_argument('--rate-limits', type=int, default=1, help='sendMessage calls answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    args = parser.parse_args()
+
+    api = FakeTelegramAPI(latency=args.api_latency).start()
+    os.environ['TELEGRAM_API_URL'] = api.url
+    os.environ.setdefault('BOT_TOKEN', '123456:BENCH')
+    os.environ['DATA_DIR'] = tempfile.mkdtemp(prefix='ultimine-transport-')
+
+    import ultiminehosting as hosting
+
+    latencies = []
+    failures = []
+    attempts = []  # monotonic time each HTTP attempt started, non-polling methods only
+    pauses = []  # monotonic time each 429 pause began
+    lock = threading.Lock()
+
+    pause_telegram = hosting.pause_telegram
+    http_send = HTTPAdapter.send
+
+    def recording_pause(seconds):
+        with lock:
+            pauses.append(time.monotonic())
+        pause_telegram(seconds)
+
+    def recording_send(adapter, request, **kwargs):
+        if hosting.get_api_method(request.url) != 'getUpdates':
+            with lock:
+                attempts.append(time.monotonic())
+        return http_send(adapter, request, **kwargs)
+
+    hosting.pause_telegram = recording_pause
+    HTTPAdapter.send = recording_send
+
+    def send(i):
+        started = time.perf_counter()
+        try:
+            hosting.bot.send_message(1000 + i % 100, f"transport bench {i}")
+        except Exception as e:
+            with lock:
+                failures.append(str(e))
+            return
+        with lock:
+            latencies.append(time.perf_counter() - started)
+
+    # Spread the injected failures through the run instead of front-loading them
+    def inject():
+        for _ in range(args.errors):
+            api.fail('sendMessage', 502)
+            time.sleep(0.01)
+        if args.rate_limits:
+            time.sleep(0.2)
+            api.fail('sendMessage', 429, args.rate_limits, retry_after=args.retry_after)
+
+    try:
+        injector = threading.Thread(target=inject, daemon=True)
+        started = time.perf_counter()
+        injector.start()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(send, range(args.messages)))
+        duration = time.perf_counter() - started
+    finally:
+        api.stop()
+
+    # No attempt may start while a 429 pause is in force. The grace covers a
+    # sender that passed the adapter's pause check just before the pause began.
+    grace = 0.05
+    pause_violations = sum(1 for t in attempts for p in pauses if p + grace < t < p + args.retry_after * 0.9)
+    retries = {'/'.join(labels): int(value) for labels, value in
+               hosting.metrics['telegram_api_retries_total']['series'].items()}
+    latencies.sort()
+    result = {
+        'messages': args.messages,
+        'failed': len(failures),
+        'seconds': round(duration, 3),
+        'throughput_rps': round(args.messages / duration, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'connections_opened': api.connections,
+        'pool_size': hosting.TELEGRAM_POOL_SIZE,
+        'retries': retries,
+        'sends_during_429_pause': pause_violations
+    }
+    print(json.dumps(result, indent=2))
+
+    problems = []
+    if len(failures) != args.errors:
+        problems.append(f"{len(failures)} sends failed for {args.errors} injected 502s"
+                        + (f", e.g. {failures[0]}" if failures else ""))
+    if retries.get('sendMessage/5xx'):
+        problems.append(f"sendMessage was retried {retries['sendMessage/5xx']} times after a 5xx")
+    if api.connections > hosting.TELEGRAM_POOL_SIZE:
+        problems.append(f"opened {api.connections} connections for a pool of {hosting.TELEGRAM_POOL_SIZE}")
+    if pause_violations:
+        problems.append(f"{pause_violations} sends went out during a 429 pause")
+    if problems:
+        print("\n".join(problems), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""Local stand-in for the Telegram Bot API used by the benchmarks.
+
+Point the bot at it with TELEGRAM_API_URL=<FakeTelegramAPI.url> before
+importing ultiminehosting. Every method answers with a plausible result so
+handlers run their normal code paths without touching Telegram. fail() makes
+the next calls of a method answer with an error status instead, to exercise
+the bot's retry handling.
+"""
+import itertools
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BOT_INFO = {
+    'id': 100000001,
+    'is_bot': True,
+    'first_name': 'ULTIMINE Bench',
+    'username': 'ultimine_bench_bot'
+}
+
+
+class FakeTelegramAPI:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0):
+        self.latency = latency
+        self.calls = {}
+        self.first_call = {}
+        self.files = {}
+        self.updates = []
+        self.history = []  # (timestamp, method)
+        self.messages = []  # params of every send*/edit* call
+        self.lock = threading.Lock()
+        self.message_ids = itertools.count(1)
+        self.faults = {}  # method -> [(status, retry_after)] answered before any real result
+        self.connections = 0
+        self.injected = []  # (timestamp, method, status) of every injected failure
+        self.server = ThreadingHTTPServer((host, port), self._make_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='fake-telegram', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def push_update(self, update):
+        with self.lock:
+            update.setdefault('update_id', len(self.updates) + 1)
+            self.updates.append(update)
+
+    def fail(self, method, status, count=1, retry_after=None):
+        """Answer the next count calls of method with status (429 carries retry_after)"""
+        with self.lock:
+            self.faults.setdefault(method, []).extend([(status, retry_after)] * count)
+
+    def total_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    def record(self, method):
+        now = time.time()
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            self.first_call.setdefault(method, now)
+            self.history.append((now, method))
+
+    def calls_since(self, method, since):
+        with self.lock:
+            return [t for t, m in self.history if m == method and t >= since]
+
+    def respond(self, method, params):
+        """Return the (status, body) pair for an API call"""
+        with self.lock:
+            fault = self.faults[method].pop(0) if self.faults.get(method) else None
+        if fault:
+            status, retry_after = fault
+            with self.lock:
+                self.injected.append((time.time(), method, status))
+            body = {'ok': False, 'error_code': status, 'description': f"Injected {status}"}
+            if retry_after is not None:
+                body['parameters'] = {'retry_after': retry_after}
+            return status, body
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': BOT_INFO}
+        if method == 'getUpdates':
+            offset = int(params.get('offset', 0) or 0)
+            with self.lock:
+                # Like Telegram, an offset confirms every earlier update
+                self.updates = [u for u in self.updates if u['update_id'] >= offset]
+                pending = list(self.updates)
+            if not pending:
+                time.sleep(min(float(params.get('timeout', 0) or 0), 0.5))
+            return 200, {'ok': True, 'result': pending}
+        if method == 'getFile':
+            file_id = params.get('file_id', '')
+            return 200, {'ok': True, 'result': {
+                'file_id': file_id,
+                'file_unique_id': file_id,
+                'file_size': len(self.files.get(file_id, b'')),
+                'file_path': f"documents/{file_id}"
+            }}
+        if method.startswith(('send', 'edit', 'forward', 'copy')):
+            with self.lock:
+                self.messages.append(dict(params, method=method))
+            chat_id = int(params.get('chat_id', 0) or 0)
+            return 200, {'ok': True, 'result': {
+                'message_id': next(self.message_ids),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': BOT_INFO,
+                'text': params.get('text', '')
+            }}
+        return 200, {'ok': True, 'result': True}
+
+    def _make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                with api.lock:
+                    api.connections += 1
+
+            def _params(self):
+                params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                content_type = self.headers.get('Content-Type', '')
+                if 'application/x-www-form-urlencoded' in content_type:
+                    params.update({k: v[0] for k, v in parse_qs(body.decode('utf-8', 'replace')).items()})
+                elif 'application/json' in content_type and body:
+                    params.update(json.loads(body))
+                elif 'multipart/form-data' in content_type:
+                    for name, value in re.findall(rb'name="(\w+)"\r\n\r\n([^\r]*)\r\n', body):
+                        params[name.decode()] = value.decode('utf-8', 'replace')
+                return params
+
+            def _send(self, status, payload, content_type='application/json'):
+                body = payload if isinstance(payload, bytes) else json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _handle(self):
+                parts = urlparse(self.path).path.strip('/').split('/')
+                params = self._params()
+                if api.latency:
+                    time.sleep(api.latency)
+                if parts[0] == 'file':
+                    api.record('downloadFile')
+                    file_id = parts[-1]
+                    return self._send(200, api.files.get(file_id, b''), 'application/octet-stream')
+                method = parts[-1]
+                api.record(method)
+                status, payload = api.respond(method, params)
+                self._send(status, payload)
+
+            do_GET = _handle
+            do_POST = _handle
+
+        return Handler
@@ -7,21 +7,32 @@ import json
 import re
 import shutil
 from telebot import types
-from PIL import Image, ImageDraw, ImageFont
 import textwrap
-import psutil
 import datetime
-import pytz
-import qrcode
-import requests
-from io import BytesIO
 import logging
-import pip
 import sys
-import traceback
-import zipfile
 import tempfile
 import io
+import hashlib
+import hmac
+import marshal
+import importlib.util
+import functools
+import bisect
+import socket
+import base64
+import heapq
+import itertools
+import random
+import collections
+import errno
+import struct
+import array
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+from telebot import apihelper
+import requests  # already loaded by telebot
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
 
 # Setup logging
 logging.basicConfig(
@@ -32,46 +43,428 @@ logger = logging.getLogger(__name__)
 
 # Configuration - USE ENVIRONMENT VARIABLES IN PRODUCTION!
 API_TOKEN = os.getenv("BOT_TOKEN", "BOT_TOKEN_HERE")
-bot = telebot.TeleBot(API_TOKEN, parse_mode="HTML")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # e.g. a local Bot API server
+if TELEGRAM_API_URL:
+    apihelper.API_URL = TELEGRAM_API_URL.rstrip('/') + "/bot{0}/{1}"
+    apihelper.FILE_URL = TELEGRAM_API_URL.rstrip('/') + "/file/bot{0}/{1}"
+INTERACTIVE_THREADS = 4  # telebot workers; they only run cheap handlers, heavy work goes to job queues
+bot = telebot.TeleBot(API_TOKEN, parse_mode="HTML", num_threads=INTERACTIVE_THREADS)
 
 # Directories
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BASE_DIR = os.getenv("DATA_DIR", os.path.dirname(os.path.abspath(__file__)))
 UPLOAD_DIR = os.path.join(BASE_DIR, 'uploads')
 LOGS_DIR = os.path.join(BASE_DIR, 'logs')
 MEDIA_DIR = os.path.join(BASE_DIR, 'media')
 BACKUP_DIR = os.path.join(BASE_DIR, 'backups')
 TEMP_DIR = os.path.join(BASE_DIR, 'temp')
 MODULES_DIR = os.path.join(BASE_DIR, 'modules')
+PYCACHE_DIR = os.path.join(BASE_DIR, 'pycache')
+PROJECT_CACHE_DIR = os.path.join(BASE_DIR, 'projects')
+RUNS_DIR = os.path.join(BASE_DIR, 'runs')
+LOG_INDEX_DIR = os.path.join(BASE_DIR, 'logindex')
+METER_DIR = os.path.join(BASE_DIR, 'metering')
 
-# Create directories if they don't exist
-for directory in [UPLOAD_DIR, LOGS_DIR, MEDIA_DIR, BACKUP_DIR, TEMP_DIR, MODULES_DIR]:
-    os.makedirs(directory, exist_ok=True)
+# Directories are created where they are first written to, so importing
+# this module (workers, benchmarks, a standby taking over) does no disk IO.
+# PIL, qrcode, psutil, pip and the archive modules are likewise imported
+# inside the functions that use them.
 
 # Data files
 LIMITS_FILE = os.path.join(BASE_DIR, 'limits.json')
 USERS_FILE = os.path.join(BASE_DIR, 'users.json')
-BROADCAST_HISTORY_FILE = os.path.join(BASE_DIR, 'broadcast_history.json')
+BROADCAST_HISTORY_FILE = os.path.join(BASE_DIR, 'broadcast_history.json')  # pre-database history, migrated once
+BROADCAST_DB = os.path.join(BASE_DIR, 'broadcasts.db')
 MODULES_FILE = os.path.join(BASE_DIR, 'modules.json')
+RUNNING_FILE = os.path.join(BASE_DIR, 'running.json')
+LEASE_FILE = os.path.join(BASE_DIR, 'leader.db')
+SCHEDULES_FILE = os.path.join(BASE_DIR, 'schedules.json')
+ADMISSION_FILE = os.path.join(BASE_DIR, 'admission.json')
 
 # Admin and maintenance
 ADMIN_IDS = [1295542470]  # Replace with your Telegram user ID
+BROADCAST_DELAY = 0.1  # Seconds between broadcast messages
 MAINTENANCE_MODE = False
 WHITELIST = ADMIN_IDS.copy()  # Users who can use bot during maintenance
 
 # Global variables
-processes = {}
+class UserKeyedDict(dict):
+    """A dict keyed by "uid:name" that also indexes its keys by uid, so one user's entries need no scan"""
+    
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.lock = threading.Lock()
+        self.by_user = {}
+        for key in self:
+            self.by_user.setdefault(key.split(':', 1)[0], set()).add(key)
+    
+    def __setitem__(self, key, value):
+        with self.lock:
+            super().__setitem__(key, value)
+            self.by_user.setdefault(key.split(':', 1)[0], set()).add(key)
+    
+    def __delitem__(self, key):
+        with self.lock:
+            super().__delitem__(key)
+            self._forget(key)
+    
+    def pop(self, key, *default):
+        with self.lock:
+            if key in self:
+                self._forget(key)
+            return super().pop(key, *default)
+    
+    def _forget(self, key):
+        user = key.split(':', 1)[0]
+        keys = self.by_user.get(user)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.by_user[user]
+    
+    def user_keys(self, uid):
+        with self.lock:
+            return list(self.by_user.get(str(uid), ()))
+
+processes = UserKeyedDict()
 user_limits = {}
 known_users = set()
 start_time = time.time()
-broadcast_history = []
 installed_modules = {}
+schedules = UserKeyedDict()
+
+# Metrics
+# Prometheus-style registry kept as plain dicts: {name: {'type', 'help', 'labels', 'series'}}.
+# Histogram series store per-bucket (non-cumulative) counts so observing is a
+# bisect plus two additions; cumulative values are only computed when scraped.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+METRICS_MAX_SERIES = 1000
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+metrics = {}
+metrics_lock = threading.Lock()
+metric_collectors = []
+handler_context = threading.local()
+
+def register_metric(name, kind, help_text, labels=(), buckets=LATENCY_BUCKETS):
+    metrics[name] = {
+        'type': kind,
+        'help': help_text,
+        'labels': tuple(labels),
+        'buckets': tuple(buckets) if kind == 'histogram' else None,
+        'series': {}
+    }
+
+def _get_series(metric, labels):
+    series = metric['series']
+    if labels not in series:
+        if len(series) >= METRICS_MAX_SERIES:
+            labels = ('other',) * len(metric['labels'])
+            if labels in series:
+                return labels
+        series[labels] = [[0] * (len(metric['buckets']) + 1), 0.0] if metric['buckets'] else 0
+    return labels
+
+def inc_metric(name, *labels, value=1):
+    metric = metrics[name]
+    labels = tuple(str(l) for l in labels)
+    with metrics_lock:
+        labels = _get_series(metric, labels)
+        metric['series'][labels] += value
+
+def set_metric(name, *labels, value):
+    metric = metrics[name]
+    labels = tuple(str(l) for l in labels)
+    with metrics_lock:
+        labels = _get_series(metric, labels)
+        metric['series'][labels] = value
+
+def observe_metric(name, *labels, value):
+    metric = metrics[name]
+    labels = tuple(str(l) for l in labels)
+    index = bisect.bisect_left(metric['buckets'], value)
+    with metrics_lock:
+        labels = _get_series(metric, labels)
+        series = metric['series'][labels]
+        series[0][index] += 1
+        series[1] += value
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+def render_metrics():
+    """Render the registry in the Prometheus text exposition format"""
+    for collector in metric_collectors:
+        try:
+            collector()
+        except Exception as e:
+            logger.error(f"Error collecting metrics: {e}")
+    
+    lines = []
+    with metrics_lock:
+        for name, metric in metrics.items():
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            for labels, value in metric['series'].items():
+                if metric['type'] != 'histogram':
+                    lines.append(f"{name}{_format_labels(metric['labels'], labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric['buckets'] + ('+Inf',), value[0]):
+                    cumulative += count
+                    le = _format_labels(metric['labels'], labels, ('le', bound))
+                    lines.append(f"{name}_bucket{le} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(metric['labels'], labels)} {value[1]}")
+                lines.append(f"{name}_count{_format_labels(metric['labels'], labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+def track_handler(name):
+    """Rate limit a handler and record its latency and errors; name may be a callable of the handler's argument"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(arg, *args, **kwargs):
+            label = name(arg) if callable(name) else name
+            if not allow_request(arg, label):
+                inc_metric('bot_rate_limited_total', label)
+                return None
+            previous = getattr(handler_context, 'name', None)
+            handler_context.name = label
+            started = time.perf_counter()
+            try:
+                return func(arg, *args, **kwargs)
+            except Exception:
+                inc_metric('bot_handler_exceptions_total', label)
+                raise
+            finally:
+                observe_metric('bot_handler_duration_seconds', label, value=time.perf_counter() - started)
+                handler_context.name = previous
+        return wrapper
+    return decorator
+
+def count_logged_errors(record):
+    """Logger filter attributing logged errors to the handler that is running"""
+    if record.levelno >= logging.ERROR:
+        inc_metric('bot_handler_errors_total', getattr(handler_context, 'name', None) or 'background')
+    return True
+
+def timed_make_request(token, method_name, *args, **kwargs):
+    started = time.perf_counter()
+    try:
+        return _make_request(token, method_name, *args, **kwargs)
+    except apihelper.ApiTelegramException as e:
+        if e.error_code == 429:
+            inc_metric('telegram_api_rate_limited_total', method_name)
+        inc_metric('telegram_api_errors_total', method_name)
+        raise
+    except Exception:
+        inc_metric('telegram_api_errors_total', method_name)
+        raise
+    finally:
+        observe_metric('telegram_api_duration_seconds', method_name, value=time.perf_counter() - started)
+
+def collect_process_metrics():
+    running = {}
+    for key in list(processes) + list(cluster_scripts):
+        user = key.split(':', 1)[0]
+        running[user] = running.get(user, 0) + 1
+    with metrics_lock:
+        metrics['hosted_scripts_running']['series'] = {(user,): count for user, count in running.items()}
+
+class QuietWSGIRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def metrics_app(environ, start_response):
+    if environ.get('PATH_INFO') != '/metrics':
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return [b'Not Found\n']
+    body = render_metrics().encode('utf-8')
+    start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+                              ('Content-Length', str(len(body)))])
+    return [body]
+
+def start_metrics_server():
+    try:
+        server = make_server(METRICS_HOST, METRICS_PORT, metrics_app, handler_class=QuietWSGIRequestHandler)
+    except OSError as e:
+        logger.error(f"Error starting metrics server: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"📈 Metrics available at http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return server
+
+register_metric('bot_handler_duration_seconds', 'histogram', 'Handler latency by command or callback route', ['handler'])
+register_metric('bot_handler_exceptions_total', 'counter', 'Uncaught exceptions raised by handlers', ['handler'])
+register_metric('bot_handler_errors_total', 'counter', 'Errors logged while a handler was running', ['handler'])
+register_metric('telegram_api_duration_seconds', 'histogram', 'Telegram Bot API call latency', ['method'])
+register_metric('telegram_api_errors_total', 'counter', 'Failed Telegram Bot API calls', ['method'])
+register_metric('telegram_api_rate_limited_total', 'counter', 'Telegram Bot API calls rejected with 429', ['method'])
+register_metric('telegram_http_duration_seconds', 'histogram', 'Single HTTP attempts to the Bot API, including file downloads', ['method'])
+register_metric('telegram_api_retries_total', 'counter', 'Bot API requests retried by the transport', ['method', 'reason'])
+register_metric('broadcast_messages_total', 'counter', 'Broadcast deliveries', ['type', 'status'])
+register_metric('broadcast_actions_total', 'counter', 'Broadcast messages edited or deleted after sending', ['action', 'status'])
+register_metric('broadcast_duration_seconds', 'histogram', 'Time to deliver a whole broadcast', ['type'],
+                buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600))
+register_metric('hosted_script_starts_total', 'counter', 'Hosted script launches')
+register_metric('hosted_script_exits_total', 'counter', 'Hosted script exits by outcome', ['outcome'])
+register_metric('hosted_scripts_running', 'gauge', 'Running hosted scripts per user', ['user'])
+register_metric('state_save_duration_seconds', 'histogram', 'Time spent in save_data()')
+register_metric('script_redeploys_total', 'counter', 'Hot redeploys by outcome', ['outcome'])
+register_metric('script_redeploy_downtime_seconds', 'histogram', 'Time from the old instance exiting to the first output of the new one')
+register_metric('dependency_installs_total', 'counter', 'Distributions installed automatically for uploads', ['status'])
+register_metric('admission_decisions_total', 'counter', 'Local launch admission decisions', ['decision'])
+register_metric('admission_queue_depth', 'gauge', 'Launches waiting for host capacity')
+register_metric('admission_wait_seconds', 'histogram', 'Time queued launches waited before starting',
+                buckets=(1, 5, 15, 30, 60, 300, 900, 1800))
+register_metric('scheduled_runs_total', 'counter', 'Scheduled run attempts by outcome', ['status'])
+register_metric('storage_reclaimed_bytes_total', 'counter', 'Bytes deleted by the storage janitor', ['dir'])
+register_metric('storage_files_removed_total', 'counter', 'Files deleted by the storage janitor', ['dir'])
+register_metric('storage_dir_bytes', 'gauge', 'Size of managed directories at the last janitor pass', ['dir'])
+register_metric('job_queue_depth', 'gauge', 'Jobs waiting per job class', ['job_class'])
+register_metric('jobs_running', 'gauge', 'Jobs running per job class', ['job_class'])
+register_metric('job_wait_seconds', 'histogram', 'Time jobs spent queued', ['job_class'],
+                buckets=(0.1, 0.5, 1, 5, 15, 30, 60, 300, 900, 3600))
+register_metric('job_duration_seconds', 'histogram', 'Time jobs spent running', ['job_class'],
+                buckets=(0.1, 0.5, 1, 5, 15, 30, 60, 300, 900, 3600))
+register_metric('bot_rate_limited_total', 'counter', 'Requests rejected by the per-user rate limiter', ['handler'])
+register_metric('coalesced_requests_total', 'counter', 'Requests served by an identical in-flight or fresh computation', ['kind'])
+
+metric_collectors.append(collect_process_metrics)
+logger.addFilter(count_logged_errors)
+_make_request = apihelper._make_request
+apihelper._make_request = timed_make_request
+
+# Telegram transport
+# All Bot API traffic, file downloads included (telebot fetches those outside
+# _make_request), goes through one shared session. Its adapter keeps up to
+# TELEGRAM_POOL_SIZE keep-alive connections (callers wait for a free one
+# rather than opening more), picks the timeout per method and retries
+# transient failures with full-jitter exponential backoff. A 429 pauses every
+# sender until retry_after has passed, since Telegram's limit is per bot.
+# Read timeouts, dropped connections and 5xx answers are only retried for
+# methods that are safe to repeat; once a sendMessage may have been written,
+# a lost response or a 502 may mean the message was delivered. Other methods
+# are retried only when the connection could not be opened at all.
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "32"))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))
+TELEGRAM_RETRY_BASE = 0.25  # seconds before the first retry, doubled after each
+TELEGRAM_MAX_RETRY_AFTER = 60  # longer 429 waits are handed back to the caller
+TELEGRAM_TIMEOUTS = {  # (connect, read) seconds
+    'default': (5, 15),
+    'getUpdates': None,  # keep telebot's, which is derived from the long polling timeout
+    'sendDocument': (5, 120),
+    'sendPhoto': (5, 60),
+    'downloadFile': (5, 120),
+}
+TELEGRAM_IDEMPOTENT_PREFIXES = ('get', 'edit', 'delete', 'answer', 'set', 'downloadFile')
+
+telegram_backoff_until = 0.0
+telegram_backoff_lock = threading.Lock()
+
+def get_api_method(url):
+    """Bot API method name of a request URL; file downloads are 'downloadFile'"""
+    path = url.split('?', 1)[0]
+    if '/file/bot' in path:
+        return 'downloadFile'
+    return path.rsplit('/', 1)[-1]
+
+def get_response_retry_after(response):
+    try:
+        return float(response.json().get('parameters', {}).get('retry_after', 1))
+    except (ValueError, AttributeError):
+        return 1.0
+
+def is_connect_failure(error):
+    """True if a ConnectionError happened before the request could be sent"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+def pause_telegram(seconds):
+    global telegram_backoff_until
+    with telegram_backoff_lock:
+        telegram_backoff_until = max(telegram_backoff_until, time.monotonic() + seconds)
+
+class TelegramAdapter(HTTPAdapter):
+    def __init__(self):
+        super().__init__(pool_connections=2, pool_maxsize=TELEGRAM_POOL_SIZE, pool_block=True, max_retries=0)
+    
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        method = get_api_method(request.url)
+        timeout = TELEGRAM_TIMEOUTS.get(method, TELEGRAM_TIMEOUTS['default']) or timeout
+        for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+            last = attempt == TELEGRAM_MAX_RETRIES
+            if method != 'getUpdates':
+                delay = telegram_backoff_until - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            
+            started = time.perf_counter()
+            try:
+                response = super().send(request, stream=stream, timeout=timeout, verify=verify, cert=cert, proxies=proxies)
+            except requests.exceptions.ReadTimeout:
+                if last or not method.startswith(TELEGRAM_IDEMPOTENT_PREFIXES):
+                    raise
+                reason = 'timeout'
+            except requests.exceptions.ConnectionError as e:
+                if last or not (is_connect_failure(e) or method.startswith(TELEGRAM_IDEMPOTENT_PREFIXES)):
+                    raise
+                reason = 'network'  # refused or unreachable; reset too for methods safe to repeat
+            else:
+                if response.status_code == 429:
+                    retry_after = get_response_retry_after(response)
+                    if last or retry_after > TELEGRAM_MAX_RETRY_AFTER:
+                        return response
+                    pause_telegram(retry_after)
+                    logger.warning(f"Telegram asked to slow down on {method}, pausing sends for {retry_after:.0f}s")
+                    reason = '429'
+                elif response.status_code >= 500 and not last and method.startswith(TELEGRAM_IDEMPOTENT_PREFIXES):
+                    reason = '5xx'
+                else:
+                    return response
+                response.content  # read the body so close() returns the connection to the pool
+                response.close()
+            finally:
+                observe_metric('telegram_http_duration_seconds', method, value=time.perf_counter() - started)
+            
+            inc_metric('telegram_api_retries_total', method, reason)
+            time.sleep(random.uniform(0, TELEGRAM_RETRY_BASE * 2 ** attempt))
+
+def make_telegram_session():
+    session = requests.Session()
+    adapter = TelegramAdapter()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+apihelper.session = make_telegram_session()
 
 # Load data from files
-def load_data():
-    global user_limits, known_users, broadcast_history, installed_modules
+data_mtimes = {}
+
+def data_file_changed(path, only_changed):
+    """True if path exists and, with only_changed, was modified since it was last loaded"""
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return False
+    if only_changed and data_mtimes.get(path) == mtime:
+        return False
+    data_mtimes[path] = mtime
+    return True
+
+def load_data(only_changed=False):
+    global user_limits, known_users, installed_modules, schedules
     
     try:
-        if os.path.exists(LIMITS_FILE):
+        if data_file_changed(LIMITS_FILE, only_changed):
             with open(LIMITS_FILE, 'r') as f:
                 user_limits = json.load(f)
     except Exception as e:
@@ -79,180 +472,3566 @@ def load_data():
         user_limits = {}
     
     try:
-        if os.path.exists(USERS_FILE):
-            with open(USERS_FILE, 'r') as f:
-                known_users = set(json.load(f))
-    except Exception as e:
-        logger.error(f"Error loading users: {e}")
-        known_users = set()
+        if data_file_changed(USERS_FILE, only_changed):
+            with open(USERS_FILE, 'r') as f:
+                known_users = set(json.load(f))
+    except Exception as e:
+        logger.error(f"Error loading users: {e}")
+        known_users = set()
+    
+    try:
+        if data_file_changed(MODULES_FILE, only_changed):
+            with open(MODULES_FILE, 'r') as f:
+                installed_modules = json.load(f)
+    except Exception as e:
+        logger.error(f"Error loading modules: {e}")
+        installed_modules = {}
+    
+    try:
+        if data_file_changed(SCHEDULES_FILE, only_changed):
+            with open(SCHEDULES_FILE, 'r') as f:
+                schedules = UserKeyedDict(json.load(f))
+    except Exception as e:
+        logger.error(f"Error loading schedules: {e}")
+        schedules = UserKeyedDict()
+    
+    try:
+        if data_file_changed(ADMISSION_FILE, only_changed):
+            with open(ADMISSION_FILE, 'r') as f:
+                admission.update(json.load(f))
+    except Exception as e:
+        logger.error(f"Error loading admission state: {e}")
+
+def write_json_atomic(path, data):
+    """Replace path in one step so a standby reading the shared store never sees half a file"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        # On a full disk the old file stays intact; free space and let the caller log it
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        note_disk_error(e)
+        raise
+
+def save_data():
+    started = time.perf_counter()
+    try:
+        write_json_atomic(LIMITS_FILE, user_limits)
+    except Exception as e:
+        logger.error(f"Error saving limits: {e}")
+    
+    try:
+        write_json_atomic(USERS_FILE, list(known_users))
+    except Exception as e:
+        logger.error(f"Error saving users: {e}")
+    
+    try:
+        write_json_atomic(MODULES_FILE, installed_modules)
+    except Exception as e:
+        logger.error(f"Error saving modules: {e}")
+    
+    try:
+        with schedule_lock:
+            snapshot = {key: dict(entry) for key, entry in schedules.items()}
+        write_json_atomic(SCHEDULES_FILE, snapshot)
+    except Exception as e:
+        logger.error(f"Error saving schedules: {e}")
+    
+    observe_metric('state_save_duration_seconds', value=time.perf_counter() - started)
+
+# Utility functions
+def get_user_dir(user_id):
+    return os.path.join(UPLOAD_DIR, str(user_id))
+
+def ensure_user_dir(user_id):
+    path = get_user_dir(user_id)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def get_limit(user_id):
+    return user_limits.get(str(user_id), 2)
+
+def get_running_count(user_id):
+    prefix = f"{user_id}:"
+    return sum(1 for k in processes if k.startswith(prefix)) + sum(1 for k in cluster_scripts if k.startswith(prefix))
+
+def get_uploaded_count(user_id):
+    path = get_user_dir(user_id)
+    if not os.path.exists(path):
+        return 0
+    return len([f for f in os.listdir(path) if f.endswith('.py') or f.endswith(PROJECT_SUFFIX)])
+
+def get_storage_usage(user_id):
+    return coalesce(('storage', str(user_id)), lambda: _get_storage_usage(user_id), ttl=STORAGE_USAGE_TTL)
+
+def _get_storage_usage(user_id):
+    user_dir = get_user_dir(user_id)
+    if not os.path.exists(user_dir):
+        return 0
+    total_size = 0
+    for dirpath, _, filenames in os.walk(user_dir):
+        for f in filenames:
+            fp = os.path.join(dirpath, f)
+            total_size += os.path.getsize(fp)
+    return total_size / (1024 * 1024)  # MB
+
+def get_server_stats():
+    # cpu_percent blocks for a second; everyone asking in that second shares the sample
+    return coalesce(('server_stats',), _get_server_stats, ttl=SERVER_STATS_TTL)
+
+def _get_server_stats():
+    import psutil
+    try:
+        cpu = psutil.cpu_percent(interval=1)
+        memory = psutil.virtual_memory().percent
+        disk = psutil.disk_usage('/').percent
+        uptime = str(datetime.timedelta(seconds=time.time() - start_time))
+        return cpu, memory, disk, uptime
+    except Exception as e:
+        logger.error(f"Error getting server stats: {e}")
+        return 0, 0, 0, "Unknown"
+
+# User index
+# Admin user listings page through a sorted copy of known_users by cursor
+# (the last or first id shown), so a page costs a bisect plus PAGE_SIZE
+# rows however many users there are. The filtered views start from what is
+# already small: running scripts for "running"/"at limit", and a partial
+# index of blocked deliveries for "blocked".
+USER_PAGE_SIZE = 20
+USER_FILTERS = {'all': "All", 'running': "Running", 'limit': "At limit", 'blocked': "Blocked"}
+
+user_index = {'source': None, 'ids': []}  # sorted ids of the known_users set in 'source'
+user_index_lock = threading.Lock()
+
+def register_user(user_id):
+    with user_index_lock:
+        if user_id in known_users:
+            return
+        known_users.add(user_id)
+        if user_index['source'] is known_users:
+            bisect.insort(user_index['ids'], user_id)
+
+def get_user_ids():
+    """All known user ids, sorted; rebuilt only when load_data replaced the set"""
+    with user_index_lock:
+        if user_index['source'] is not known_users or len(user_index['ids']) != len(known_users):
+            user_index['ids'] = sorted(known_users)
+            user_index['source'] = known_users
+        return user_index['ids']
+
+def get_running_by_user():
+    running = {}
+    for key in list(processes) + list(cluster_scripts):
+        user = int(key.split(':', 1)[0])
+        running[user] = running.get(user, 0) + 1
+    return running
+
+def page_sorted(ids, after=None, before=None, size=USER_PAGE_SIZE):
+    """Slice a sorted id list by cursor, returning (page, prev cursor, next cursor)"""
+    if before is not None:
+        end = bisect.bisect_left(ids, before)
+        start = max(0, end - size)
+    else:
+        start = bisect.bisect_right(ids, after) if after is not None else 0
+        end = start + size
+    page = ids[start:end]
+    if not page:
+        return [], None, None
+    return page, page[0] if start > 0 else None, page[-1] if end < len(ids) else None
+
+def page_blocked_users(after=None, before=None, size=USER_PAGE_SIZE):
+    """Page through users whose latest broadcast found the bot blocked"""
+    conn = open_broadcast_db()
+    try:
+        if before is not None:
+            rows = conn.execute("SELECT user_id FROM blocked_users WHERE user_id < ? ORDER BY user_id DESC LIMIT ?",
+                                (before, size + 1)).fetchall()
+            page = [row[0] for row in rows[:size]][::-1]
+        else:
+            rows = conn.execute("SELECT user_id FROM blocked_users WHERE user_id > ? ORDER BY user_id LIMIT ?",
+                                (-2 ** 63 if after is None else after, size + 1)).fetchall()
+            page = [row[0] for row in rows[:size]]
+        if not page:
+            return [], None, None
+        
+        def exists(condition, edge):
+            return conn.execute(f"SELECT 1 FROM blocked_users WHERE {condition} LIMIT 1", (edge,)).fetchone() is not None
+        
+        more = len(rows) > size
+        has_prev = more if before is not None else exists("user_id < ?", page[0])
+        has_next = more if before is None else exists("user_id > ?", page[-1])
+    finally:
+        conn.close()
+    return page, page[0] if has_prev else None, page[-1] if has_next else None
+
+def list_users_page(user_filter='all', after=None, before=None):
+    """Return (page of user ids, prev cursor, next cursor, running counts) for an admin listing"""
+    running = get_running_by_user()
+    if user_filter == 'blocked':
+        return page_blocked_users(after, before) + (running,)
+    if user_filter == 'running':
+        ids = sorted(running)
+    elif user_filter == 'limit':
+        ids = sorted(user for user, count in running.items() if count >= get_limit(user))
+    else:
+        ids = get_user_ids()
+    return page_sorted(ids, after, before) + (running,)
+
+def render_users_page(user_filter='all', after=None, before=None):
+    """Return (text, markup) for one page of the admin user listing"""
+    page, prev_cursor, next_cursor, running = list_users_page(user_filter, after, before)
+    lines = [f"<b>👥 Users: {USER_FILTERS[user_filter]}</b> ({len(known_users)} known)"]
+    for user in page:
+        lines.append(f"• <code>{user}</code> | Limit: {get_limit(user)} | Running: {running.get(user, 0)}")
+    if not page:
+        lines.append("No users match.")
+    lines.append("\nDetails: /user id")
+    
+    markup = types.InlineKeyboardMarkup()
+    nav = []
+    if prev_cursor is not None:
+        nav.append(types.InlineKeyboardButton("⬅️ Prev", callback_data=f"users:{user_filter}:b:{prev_cursor}"))
+    if next_cursor is not None:
+        nav.append(types.InlineKeyboardButton("Next ➡️", callback_data=f"users:{user_filter}:a:{next_cursor}"))
+    if nav:
+        markup.row(*nav)
+    markup.row(*[types.InlineKeyboardButton(("• " if name == user_filter else "") + label, callback_data=f"users:{name}")
+                 for name, label in USER_FILTERS.items()])
+    return "\n".join(lines), markup
+
+# Rate limiting and request coalescing
+# Every handler call takes a token from a per-(user, handler) bucket; buckets
+# hold `burst` tokens and refill at `rate` per second, both scaled by the
+# user's tier. Admins are never limited.
+RATE_LIMITS = {
+    'default': (20, 1.0),
+    'status_command': (3, 1 / 10),
+    'admin_stats': (3, 1 / 10),
+    'backup_command': (2, 1 / 60),
+    'restore_command': (2, 1 / 60),
+    'install_module_command': (3, 1 / 30),
+    'start_file_command': (5, 1 / 5),
+    'get_log_command': (5, 1 / 5),
+    'search_log_command': (5, 1 / 5),
+    'attach_command': (3, 1 / 10),
+    'redeploy_command': (3, 1 / 30),
+    'handle_document': (5, 1 / 10),
+    'qr_command': (5, 1 / 5),
+}
+RATE_LIMIT_TIERS = [(10, 4.0), (5, 2.0), (0, 1.0)]  # (min script limit from user_limits, multiplier)
+RATE_BUCKETS_MAX = 50000
+SERVER_STATS_TTL = 1
+STORAGE_USAGE_TTL = 5
+
+rate_buckets = {}  # (user, handler) -> [tokens, last refill, notified]
+rate_limit_lock = threading.Lock()
+coalesced = {}  # key -> {'event', 'result', 'error', 'done_at'}
+coalesce_lock = threading.Lock()
+
+def get_request_user(arg):
+    if isinstance(arg, types.CallbackQuery):
+        return arg.from_user.id
+    return arg.chat.id
+
+def get_rate_limit_multiplier(user_id):
+    limit = get_limit(user_id)
+    return next(multiplier for min_limit, multiplier in RATE_LIMIT_TIERS if limit >= min_limit)
+
+def allow_request(arg, name):
+    """Take a token for this user and handler, telling the user once when they run out"""
+    user_id = get_request_user(arg)
+    if user_id in ADMIN_IDS:
+        return True
+    
+    burst, rate = RATE_LIMITS.get(name, RATE_LIMITS['default'])
+    multiplier = get_rate_limit_multiplier(user_id)
+    burst, rate = burst * multiplier, rate * multiplier
+    now = time.monotonic()
+    with rate_limit_lock:
+        bucket = rate_buckets.get((user_id, name))
+        if bucket is None:
+            if len(rate_buckets) >= RATE_BUCKETS_MAX:
+                for key in [k for k, b in rate_buckets.items() if now - b[1] > 3600]:
+                    del rate_buckets[key]
+            bucket = rate_buckets[(user_id, name)] = [burst, now, False]
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            bucket[2] = False
+            return True
+        notify = not bucket[2]
+        bucket[2] = True
+        wait = (1 - bucket[0]) / rate
+    
+    if notify:
+        text = f"⏳ Too many requests. Please wait {wait:.0f}s and try again."
+        try:
+            if isinstance(arg, types.CallbackQuery):
+                bot.answer_callback_query(arg.id, text)
+            else:
+                bot.send_message(user_id, text)
+        except Exception as e:
+            logger.error(f"Error sending rate limit notice: {e}")
+    return False
+
+def coalesce(key, func, ttl=0):
+    """Run func once for concurrent callers with the same key, reusing the result for ttl seconds"""
+    with coalesce_lock:
+        entry = coalesced.get(key)
+        if entry and (not entry['event'].is_set() or time.monotonic() - entry['done_at'] < ttl):
+            owner = False
+        else:
+            if len(coalesced) > 1000:
+                now = time.monotonic()
+                for k in [k for k, e in coalesced.items() if e['event'].is_set() and now - e['done_at'] >= ttl]:
+                    del coalesced[k]
+            entry = coalesced[key] = {'event': threading.Event(), 'result': None, 'error': None, 'done_at': 0}
+            owner = True
+    
+    if owner:
+        try:
+            entry['result'] = func()
+        except Exception as e:
+            entry['error'] = e
+        finally:
+            entry['done_at'] = time.monotonic()
+            entry['event'].set()
+            if not ttl:
+                with coalesce_lock:
+                    if coalesced.get(key) is entry:
+                        del coalesced[key]
+    else:
+        inc_metric('coalesced_requests_total', key[0])
+        entry['event'].wait()
+    
+    if entry['error']:
+        raise entry['error']
+    return entry['result']
+
+# Job queues
+# Heavy work runs outside telebot's handler threads, in one small pool per job
+# class so a broadcast can't starve restores or module installs. Inside a class
+# jobs run by (priority, arrival); admins jump ahead of users.
+JOB_CLASSES = {
+    'file_io': 2,  # uploads, backups, restores
+    'install': 1,  # pip runs
+    'broadcast': 1
+}
+JOB_PRIORITY_ADMIN = 0
+JOB_PRIORITY_USER = 10
+
+job_queues = {name: {'heap': [], 'cond': threading.Condition(), 'running': 0, 'workers': []}
+              for name in JOB_CLASSES}
+job_sequence = itertools.count()
+
+def job_priority(user_id):
+    return JOB_PRIORITY_ADMIN if int(user_id) in ADMIN_IDS else JOB_PRIORITY_USER
+
+def submit_job(job_class, func, *args, priority=JOB_PRIORITY_USER):
+    """Queue func(*args) in a job class, returning how many jobs are ahead of it"""
+    queue = job_queues[job_class]
+    with queue['cond']:
+        if not queue['workers']:
+            for i in range(JOB_CLASSES[job_class]):
+                worker = threading.Thread(target=_run_jobs, args=(job_class,), name=f"job:{job_class}:{i}", daemon=True)
+                worker.start()
+                queue['workers'].append(worker)
+        ahead = queue['running'] + sum(1 for p, _, _ in queue['heap'] if p <= priority)
+        heapq.heappush(queue['heap'], (priority, next(job_sequence), (func, args, time.perf_counter())))
+        queue['cond'].notify()
+    return ahead if ahead >= JOB_CLASSES[job_class] else 0
+
+def _run_jobs(job_class):
+    queue = job_queues[job_class]
+    handler_context.name = f"job:{job_class}"
+    while True:
+        with queue['cond']:
+            while not queue['heap']:
+                queue['cond'].wait()
+            _, _, (func, args, queued_at) = heapq.heappop(queue['heap'])
+            queue['running'] += 1
+        started = time.perf_counter()
+        observe_metric('job_wait_seconds', job_class, value=started - queued_at)
+        try:
+            func(*args)
+        except Exception as e:
+            logger.error(f"Error in {job_class} job: {e}")
+        finally:
+            with queue['cond']:
+                queue['running'] -= 1
+            observe_metric('job_duration_seconds', job_class, value=time.perf_counter() - started)
+
+def queued_text(what, ahead):
+    if ahead:
+        return f"⏳ {what} queued, {ahead} ahead of you. I'll message you when it's done."
+    return f"⏳ {what} started. I'll message you when it's done."
+
+def collect_job_metrics():
+    for job_class, queue in job_queues.items():
+        set_metric('job_queue_depth', job_class, value=len(queue['heap']))
+        set_metric('jobs_running', job_class, value=queue['running'])
+
+metric_collectors.append(collect_job_metrics)
+
+# Broadcast log
+# Broadcasts and the outcome for every recipient are kept in BROADCAST_DB
+# (SQLite, like the leader lease) instead of a JSON list rewritten on every
+# save. deliveries is keyed by (broadcast, user) with a second index by user,
+# so "did user X get broadcast Y" and "retry the failures of Y" are index
+# lookups. Only the newest BROADCAST_LOG_MAX broadcasts are kept.
+# blocked_users holds every user whose latest delivery was blocked, updated
+# as deliveries are recorded, so the admin "blocked" listing pages it
+# directly. It outlives the pruned broadcasts.
+BROADCAST_LOG_MAX = 500
+BROADCAST_PAGE_SIZE = 5
+BROADCAST_FLUSH_EVERY = 100  # deliveries written per transaction
+BROADCAST_ACTION_WORKERS = 8
+BROADCAST_ACTION_RATE = 25  # edit/delete calls per second across all workers
+BROADCAST_ACTION_RETRIES = 3  # attempts per message after a 429
+DELIVERY_SENT = 0
+DELIVERY_FAILED = 1
+DELIVERY_BLOCKED = 2
+DELIVERY_LABELS = {DELIVERY_SENT: 'sent', DELIVERY_FAILED: 'failed', DELIVERY_BLOCKED: 'blocked'}
+BROADCAST_SCHEMA = """
+PRAGMA journal_mode=WAL;
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    type TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    created REAL NOT NULL,
+    sent INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    blocked INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS deliveries (
+    broadcast_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    status INTEGER NOT NULL,
+    reason TEXT,
+    message_id INTEGER,
+    PRIMARY KEY (broadcast_id, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS deliveries_by_user ON deliveries (user_id, broadcast_id);
+DROP INDEX IF EXISTS deliveries_blocked;
+CREATE TABLE IF NOT EXISTS blocked_users (
+    user_id INTEGER PRIMARY KEY,
+    broadcast_id INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS broadcast_actions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    broadcast_id INTEGER NOT NULL,
+    action TEXT NOT NULL,
+    payload TEXT,
+    admin_id INTEGER NOT NULL,
+    created REAL NOT NULL,
+    total INTEGER NOT NULL,
+    cursor INTEGER NOT NULL DEFAULT -9223372036854775808,
+    done INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    finished REAL
+);
+"""
+
+broadcast_db_ready = False
+broadcast_db_lock = threading.Lock()
+
+def open_broadcast_db():
+    global broadcast_db_ready
+    import sqlite3
+    conn = sqlite3.connect(BROADCAST_DB, timeout=10)
+    conn.row_factory = sqlite3.Row
+    if not broadcast_db_ready:
+        with broadcast_db_lock:
+            if not broadcast_db_ready:
+                fresh = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'blocked_users'").fetchone() is None
+                conn.executescript(BROADCAST_SCHEMA)
+                migrate_broadcast_history(conn)
+                if fresh:
+                    migrate_blocked_users(conn)
+                broadcast_db_ready = True
+    return conn
+
+def migrate_broadcast_history(conn):
+    """Move the old broadcast_history.json list into the database, once"""
+    try:
+        with open(BROADCAST_HISTORY_FILE, 'r') as f:
+            history = json.load(f)
+    except (OSError, ValueError):
+        return
+    with conn:
+        for item in history:
+            payload = {k: v for k, v in item.items() if k in ('content', 'buttons', 'caption')}
+            created = datetime.datetime.fromisoformat(item['date']).timestamp()
+            conn.execute("INSERT INTO broadcasts (type, payload, created, sent, failed) VALUES (?, ?, ?, ?, ?)",
+                         (item['type'], json.dumps(payload), created, item.get('sent', 0), item.get('failed', 0)))
+    os.replace(BROADCAST_HISTORY_FILE, BROADCAST_HISTORY_FILE + '.migrated')
+    logger.info(f"Migrated {len(history)} broadcasts into {BROADCAST_DB}")
+
+def migrate_blocked_users(conn):
+    """Fill blocked_users from the deliveries recorded before it existed, once"""
+    with conn:
+        conn.execute("INSERT OR IGNORE INTO blocked_users SELECT d.user_id, d.broadcast_id FROM deliveries d "
+                     "WHERE d.status = ? AND d.broadcast_id = "
+                     "(SELECT MAX(broadcast_id) FROM deliveries WHERE user_id = d.user_id)", (DELIVERY_BLOCKED,))
+
+def create_broadcast(kind, payload):
+    conn = open_broadcast_db()
+    try:
+        with conn:
+            return conn.execute("INSERT INTO broadcasts (type, payload, created) VALUES (?, ?, ?)",
+                                (kind, json.dumps(payload), time.time())).lastrowid
+    finally:
+        conn.close()
+
+def record_deliveries(conn, rows):
+    """rows are (broadcast_id, user_id, status, reason, message_id)"""
+    if rows:
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO deliveries VALUES (?, ?, ?, ?, ?)", rows)
+            # Only a user's latest delivery decides whether they are blocked
+            conn.executemany("INSERT OR REPLACE INTO blocked_users SELECT ?, ? WHERE NOT EXISTS "
+                             "(SELECT 1 FROM deliveries WHERE user_id = ? AND broadcast_id > ?)",
+                             [(user, broadcast, user, broadcast) for broadcast, user, status, _, _ in rows
+                              if status == DELIVERY_BLOCKED])
+            conn.executemany("DELETE FROM blocked_users WHERE user_id = ? AND broadcast_id <= ?",
+                             [(user, broadcast) for broadcast, user, status, _, _ in rows
+                              if status != DELIVERY_BLOCKED])
+
+def finish_broadcast(conn, broadcast_id):
+    """Store the delivery totals of a broadcast, drop the oldest broadcasts and return the totals"""
+    counts = {label: 0 for label in DELIVERY_LABELS.values()}
+    for status, count in conn.execute(
+            "SELECT status, COUNT(*) FROM deliveries WHERE broadcast_id = ? GROUP BY status", (broadcast_id,)):
+        counts[DELIVERY_LABELS[status]] = count
+    with conn:
+        conn.execute("UPDATE broadcasts SET sent = ?, failed = ?, blocked = ? WHERE id = ?",
+                     (counts['sent'], counts['failed'], counts['blocked'], broadcast_id))
+        oldest_kept = conn.execute("SELECT id FROM broadcasts ORDER BY id DESC LIMIT 1 OFFSET ?",
+                                   (BROADCAST_LOG_MAX - 1,)).fetchone()
+        if oldest_kept:
+            conn.execute("DELETE FROM deliveries WHERE broadcast_id < ?", (oldest_kept[0],))
+            conn.execute("DELETE FROM broadcast_actions WHERE broadcast_id < ?", (oldest_kept[0],))
+            conn.execute("DELETE FROM broadcasts WHERE id < ?", (oldest_kept[0],))
+    return counts
+
+def get_broadcast(broadcast_id):
+    conn = open_broadcast_db()
+    try:
+        row = conn.execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+        return dict(row, payload=json.loads(row['payload'])) if row else None
+    finally:
+        conn.close()
+
+def list_broadcasts(before=None, limit=BROADCAST_PAGE_SIZE):
+    """Newest broadcasts with id < before, and whether older ones exist"""
+    conn = open_broadcast_db()
+    try:
+        rows = conn.execute("SELECT * FROM broadcasts WHERE id < ? ORDER BY id DESC LIMIT ?",
+                            (before or 2 ** 62, limit + 1)).fetchall()
+    finally:
+        conn.close()
+    return [dict(row, payload=json.loads(row['payload'])) for row in rows[:limit]], len(rows) > limit
+
+def get_failed_recipients(broadcast_id):
+    """Users a broadcast failed for, not counting those who blocked the bot"""
+    conn = open_broadcast_db()
+    try:
+        return [row[0] for row in conn.execute(
+            "SELECT user_id FROM deliveries WHERE broadcast_id = ? AND status = ?", (broadcast_id, DELIVERY_FAILED))]
+    finally:
+        conn.close()
+
+def get_user_deliveries(user_id, broadcast_id=None, limit=10):
+    conn = open_broadcast_db()
+    try:
+        query = ("SELECT d.*, b.type, b.created FROM deliveries d JOIN broadcasts b ON b.id = d.broadcast_id "
+                 "WHERE d.user_id = ?")
+        args = [user_id]
+        if broadcast_id is not None:
+            query += " AND d.broadcast_id = ?"
+            args.append(broadcast_id)
+        return [dict(row) for row in conn.execute(query + " ORDER BY d.broadcast_id DESC LIMIT ?", args + [limit])]
+    finally:
+        conn.close()
+
+def classify_delivery_error(error):
+    """Map a send exception to (delivery status, short reason)"""
+    code = getattr(error, 'error_code', None)
+    reason = getattr(error, 'description', None) or str(error)
+    if code == 403:
+        return DELIVERY_BLOCKED, reason[:200]  # blocked the bot or deactivated
+    return DELIVERY_FAILED, reason[:200]
+
+def format_broadcast_text(payload):
+    """Return (text, parse_mode, markup) of a text broadcast as users see it"""
+    msg = payload['content']
+    parse_mode = "HTML" if re.search(r'<[a-z][\s\S]*>', msg) else None
+    return f"📢 <b>Announcement</b>\n\n{msg}", parse_mode, build_broadcast_buttons(payload.get('buttons'))
+
+def make_broadcast_sender(kind, payload):
+    """Return (send(user) -> Message, prepare(users) or None) for a stored broadcast"""
+    if kind == 'text':
+        text, parse_mode, markup = format_broadcast_text(payload)
+        return (lambda user: bot.send_message(user, text, parse_mode=parse_mode, reply_markup=markup)), None
+    
+    if kind == 'image':
+        return (lambda user: bot.send_photo(user, payload['file_id'], caption=payload['caption'])), None
+    
+    if kind == 'qr':
+        attachments = {}
+        
+        def prepare(users):
+            links = {user: get_invite_link(user) for user in users}
+            pngs = create_qr_codes(links.values())
+            attachments.update({user: (link, pngs[link]) for user, link in links.items()})
+        
+        def send(user):
+            link, png = attachments[user]
+            return bot.send_photo(user, png, caption=f"🔗 Your personal invite link:\n{link}\n\nShare this QR code to invite friends!")
+        
+        return send, prepare
+    
+    raise ValueError(f"Unknown broadcast type {kind}")
+
+def format_broadcast_result(broadcast_id, counts):
+    return f"Broadcast #{broadcast_id}\nSent: {counts['sent']}\nFailed: {counts['failed']}\nBlocked: {counts['blocked']}"
+
+def deliver_broadcast(kind, payload, on_done, recipients=None, broadcast_id=None):
+    """Queue a broadcast, returning how many jobs are ahead of it.
+    
+    Without recipients it goes to every known user as a new broadcast; with
+    recipients and broadcast_id it re-sends an existing one to just those.
+    on_done(broadcast_id, counts) runs once it has been sent.
+    """
+    def job():
+        bid = broadcast_id or create_broadcast(kind, payload)
+        users = list(known_users) if recipients is None else list(recipients)
+        send, prepare = make_broadcast_sender(kind, payload)
+        if prepare:
+            prepare(users)  # e.g. render per-user attachments in one batch
+        
+        started = time.perf_counter()
+        pending = []
+        conn = open_broadcast_db()
+        try:
+            for uid in users:
+                try:
+                    result = send(uid)
+                    pending.append((bid, uid, DELIVERY_SENT, None, getattr(result, 'message_id', None)))
+                    inc_metric('broadcast_messages_total', kind, 'sent')
+                    time.sleep(BROADCAST_DELAY)  # Rate limiting
+                except Exception as e:
+                    logger.error(f"Error broadcasting {kind} to {uid}: {e}")
+                    status, reason = classify_delivery_error(e)
+                    pending.append((bid, uid, status, reason, None))
+                    inc_metric('broadcast_messages_total', kind, DELIVERY_LABELS[status])
+                if len(pending) >= BROADCAST_FLUSH_EVERY:
+                    record_deliveries(conn, pending)
+                    pending = []
+            record_deliveries(conn, pending)
+            counts = finish_broadcast(conn, bid)
+        finally:
+            conn.close()
+        observe_metric('broadcast_duration_seconds', kind, value=time.perf_counter() - started)
+        
+        on_done(bid, counts)
+    
+    return submit_job('broadcast', job, priority=JOB_PRIORITY_ADMIN)
+
+# Broadcast recall
+# Editing or deleting a sent broadcast replays editMessageText/Caption or
+# deleteMessage against the message ids kept in deliveries (chat id is the
+# user id, broadcasts only go to private chats). Each action is a row in
+# broadcast_actions whose cursor is the last user id finished; messages are
+# handled in user id order, one batch of BROADCAST_FLUSH_EVERY at a time over
+# BROADCAST_ACTION_WORKERS threads, and the cursor is committed after every
+# batch. An action interrupted by a crash resumes from its cursor on the next
+# start, redoing at most one batch.
+def create_broadcast_action(broadcast_id, action, admin_id, payload=None):
+    """Record an edit or delete of every delivered message of a broadcast and return its id"""
+    conn = open_broadcast_db()
+    try:
+        with conn:
+            total = conn.execute("SELECT COUNT(*) FROM deliveries WHERE broadcast_id = ? AND message_id IS NOT NULL",
+                                 (broadcast_id,)).fetchone()[0]
+            if payload is not None:
+                # Later retries should send the corrected version
+                conn.execute("UPDATE broadcasts SET payload = ? WHERE id = ?", (json.dumps(payload), broadcast_id))
+            return conn.execute(
+                "INSERT INTO broadcast_actions (broadcast_id, action, payload, admin_id, created, total) VALUES (?, ?, ?, ?, ?, ?)",
+                (broadcast_id, action, json.dumps(payload), admin_id, time.time(), total)).lastrowid
+    finally:
+        conn.close()
+
+def make_broadcast_action(kind, action, payload):
+    """Return apply(user, message_id) performing action on one delivered message"""
+    if action == 'delete':
+        return lambda user, message_id: bot.delete_message(user, message_id)
+    if kind == 'text':
+        text, parse_mode, markup = format_broadcast_text(payload)
+        return lambda user, message_id: bot.edit_message_text(text, user, message_id, parse_mode=parse_mode,
+                                                              reply_markup=markup)
+    if kind == 'image':
+        return lambda user, message_id: bot.edit_message_caption(payload['caption'], user, message_id)
+    raise ValueError(f"Can't {action} a {kind} broadcast")
+
+def get_retry_after(error):
+    """Seconds Telegram asked us to wait, or None if error is not a 429"""
+    if getattr(error, 'error_code', None) != 429:
+        return None
+    return ((getattr(error, 'result_json', None) or {}).get('parameters') or {}).get('retry_after', 1)
+
+def make_action_pacer(rate):
+    """Return (wait(), back_off(seconds)) spacing calls from all workers rate per second apart"""
+    lock = threading.Lock()
+    next_slot = [time.monotonic()]
+    
+    def wait():
+        with lock:
+            now = time.monotonic()
+            slot = max(now, next_slot[0])
+            next_slot[0] = slot + 1 / rate
+        time.sleep(slot - now)
+    
+    def back_off(seconds):
+        with lock:
+            next_slot[0] = max(next_slot[0], time.monotonic() + seconds)
+    
+    return wait, back_off
+
+def format_action_progress(action, done, failed, total, elapsed):
+    verb = "Editing" if action['action'] == 'edit' else "Deleting"
+    finished = done + failed
+    percent = finished * 100 // total if total else 100
+    rate = finished / elapsed if elapsed else 0.0
+    return (f"{'✏️' if action['action'] == 'edit' else '🗑'} {verb} broadcast #{action['broadcast_id']}: "
+            f"{percent}% ({finished}/{total})\nDone: {done} | Failed: {failed} | {rate:.1f} msg/s")
+
+def run_broadcast_action(action_id):
+    """Apply a stored edit or delete to every message it hasn't reached yet"""
+    from concurrent.futures import ThreadPoolExecutor
+    
+    conn = open_broadcast_db()
+    try:
+        action = dict(conn.execute("SELECT * FROM broadcast_actions WHERE id = ?", (action_id,)).fetchone())
+        kind = conn.execute("SELECT type FROM broadcasts WHERE id = ?", (action['broadcast_id'],)).fetchone()
+        if not kind or action['finished']:
+            return
+        apply = make_broadcast_action(kind[0], action['action'], json.loads(action['payload']))
+        wait, back_off = make_action_pacer(BROADCAST_ACTION_RATE)
+        
+        def handle(target):
+            user, message_id = target
+            for attempt in range(BROADCAST_ACTION_RETRIES):
+                wait()
+                try:
+                    apply(user, message_id)
+                    return user, True
+                except Exception as e:
+                    retry_after = get_retry_after(e)
+                    if retry_after is not None and attempt + 1 < BROADCAST_ACTION_RETRIES:
+                        back_off(retry_after)
+                        continue
+                    if 'not modified' in str(e):
+                        return user, True  # already edited before a restart
+                    logger.error(f"Error applying {action['action']} of broadcast #{action['broadcast_id']} for {user}: {e}")
+                    return user, False
+        
+        try:
+            progress = bot.send_message(action['admin_id'], format_action_progress(action, action['done'], action['failed'], action['total'], 0))
+        except Exception as e:
+            logger.error(f"Error sending broadcast action progress: {e}")
+            progress = None
+        
+        started = time.perf_counter()
+        done_before = action['done'] + action['failed']
+        cursor, done, failed = action['cursor'], action['done'], action['failed']
+        with ThreadPoolExecutor(BROADCAST_ACTION_WORKERS, thread_name_prefix=f"recall:{action_id}") as pool:
+            while True:
+                batch = conn.execute(
+                    "SELECT user_id, message_id FROM deliveries WHERE broadcast_id = ? AND user_id > ? "
+                    "AND message_id IS NOT NULL ORDER BY user_id LIMIT ?",
+                    (action['broadcast_id'], cursor, BROADCAST_FLUSH_EVERY)).fetchall()
+                if not batch:
+                    break
+                results = list(pool.map(handle, [tuple(row) for row in batch]))
+                succeeded = [user for user, ok in results if ok]
+                done += len(succeeded)
+                failed += len(results) - len(succeeded)
+                cursor = batch[-1][0]
+                for user, ok in results:
+                    inc_metric('broadcast_actions_total', action['action'], 'done' if ok else 'failed')
+                with conn:
+                    if action['action'] == 'delete':
+                        conn.executemany("UPDATE deliveries SET message_id = NULL WHERE broadcast_id = ? AND user_id = ?",
+                                         [(action['broadcast_id'], user) for user in succeeded])
+                    conn.execute("UPDATE broadcast_actions SET cursor = ?, done = ?, failed = ? WHERE id = ?",
+                                 (cursor, done, failed, action_id))
+                
+                if progress:
+                    try:
+                        bot.edit_message_text(format_action_progress(action, done, failed, action['total'],
+                                                                     time.perf_counter() - started),
+                                              progress.chat.id, progress.message_id)
+                    except Exception as e:
+                        logger.error(f"Error updating broadcast action progress: {e}")
+        
+        with conn:
+            conn.execute("UPDATE broadcast_actions SET finished = ? WHERE id = ?", (time.time(), action_id))
+    finally:
+        conn.close()
+    
+    elapsed = time.perf_counter() - started
+    rate = (done + failed - done_before) / elapsed if elapsed else 0.0
+    verb = "Edited" if action['action'] == 'edit' else "Deleted"
+    bot.send_message(action['admin_id'], f"✅ {verb} broadcast #{action['broadcast_id']}\n"
+                                         f"Done: {done} | Failed: {failed} of {action['total']}\n"
+                                         f"Took {elapsed:.1f}s ({rate:.1f} msg/s)")
+
+def submit_broadcast_action(action_id):
+    return submit_job('broadcast', run_broadcast_action, action_id, priority=JOB_PRIORITY_ADMIN)
+
+def resume_broadcast_actions():
+    """Queue the edits and deletes a previous run didn't finish"""
+    try:
+        conn = open_broadcast_db()
+        try:
+            pending = [row[0] for row in conn.execute("SELECT id FROM broadcast_actions WHERE finished IS NULL ORDER BY id")]
+        finally:
+            conn.close()
+    except Exception as e:
+        logger.error(f"Error loading unfinished broadcast actions: {e}")
+        return
+    for action_id in pending:
+        submit_broadcast_action(action_id)
+    if pending:
+        logger.info(f"Resumed {len(pending)} unfinished broadcast edits/deletes")
+
+# Image rendering
+# Fonts and the background/watermark template are built once; each image is
+# a copy of the template with the text laid out via textbbox (font.getsize
+# is gone in Pillow 10). Encoded images for identical texts come from an LRU.
+IMAGE_SIZE = (800, 600)
+IMAGE_BACKGROUND = (29, 29, 29)  # Dark background
+IMAGE_FONT = "arial.ttf"
+IMAGE_FONT_SIZE = 24
+IMAGE_WRAP_WIDTH = 40
+IMAGE_CACHE_SIZE = 64
+IMAGE_WATERMARK = "ULTIMINE Hosting"
+image_lock = threading.Lock()  # FreeType faces aren't safe to draw with from several threads
+
+@functools.lru_cache(maxsize=8)
+def get_font(name=IMAGE_FONT, size=IMAGE_FONT_SIZE):
+    from PIL import ImageFont
+    try:
+        return ImageFont.truetype(name, size)
+    except OSError:
+        try:
+            return ImageFont.load_default(size)
+        except TypeError:  # Pillow < 10.1 has a single bitmap size
+            return ImageFont.load_default()
+
+@functools.lru_cache(maxsize=1)
+def get_image_template():
+    """The empty canvas with its watermark, copied for every image"""
+    from PIL import Image, ImageDraw
+    img = Image.new('RGB', IMAGE_SIZE, color=IMAGE_BACKGROUND)
+    ImageDraw.Draw(img).text((20, IMAGE_SIZE[1] - 30), IMAGE_WATERMARK, font=get_font(), fill=(200, 200, 200))
+    return img
+
+@functools.lru_cache(maxsize=IMAGE_CACHE_SIZE)
+def render_text_image(text, fmt='JPEG'):
+    from PIL import ImageDraw
+    font = get_font()
+    with image_lock:
+        img = get_image_template().copy()
+        d = ImageDraw.Draw(img)
+        
+        line_height = font.getbbox("Ay")[3]
+        y_text = 50
+        for line in textwrap.wrap(text, width=IMAGE_WRAP_WIDTH):
+            left, _, right, _ = d.textbbox((0, 0), line, font=font)
+            d.text(((IMAGE_SIZE[0] - (right - left)) / 2 - left, y_text), line, font=font, fill=(255, 255, 255))
+            y_text += line_height + 10
+    
+    buffer = io.BytesIO()
+    img.save(buffer, format=fmt, quality=90)
+    return buffer.getvalue()
+
+def create_image_with_text(text):
+    """Create an image with text for broadcast messages, returning the encoded JPEG bytes"""
+    try:
+        return render_text_image(text)
+    except Exception as e:
+        logger.error(f"Error creating image: {e}")
+        return None
+
+# QR codes
+# QR codes are returned as in-memory PNG bytes and cached by (data, params).
+# Batches render their cache misses in a process pool, because encoding is
+# pure Python and would hold the GIL against the handler threads.
+QR_CACHE_SIZE = 256
+QR_POOL_WORKERS = min(4, os.cpu_count() or 1)
+QR_MAX_DATA = 1000  # characters accepted from /qr
+
+qr_cache = collections.OrderedDict()
+qr_cache_lock = threading.Lock()
+qr_pool = None
+qr_pool_lock = threading.Lock()
+
+def render_qr(data, box_size=10, border=4, error_correction='L'):
+    """Encode data as a PNG QR code (module level so pool workers can run it)"""
+    import qrcode
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=getattr(qrcode.constants, f"ERROR_CORRECT_{error_correction}"),
+        box_size=box_size,
+        border=border,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+    img = qr.make_image(fill_color="black", back_color="white")
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def qr_cache_get(key):
+    with qr_cache_lock:
+        png = qr_cache.get(key)
+        if png is not None:
+            qr_cache.move_to_end(key)
+        return png
+
+def qr_cache_put(key, png):
+    with qr_cache_lock:
+        qr_cache[key] = png
+        qr_cache.move_to_end(key)
+        while len(qr_cache) > QR_CACHE_SIZE:
+            qr_cache.popitem(last=False)
+
+def create_qr_code(data, box_size=10, border=4, error_correction='L'):
+    """Return PNG bytes for a QR code of data, or None on error"""
+    key = (data, box_size, border, error_correction)
+    png = qr_cache_get(key)
+    if png is None:
+        try:
+            png = render_qr(*key)
+        except Exception as e:
+            logger.error(f"Error creating QR code: {e}")
+            return None
+        qr_cache_put(key, png)
+    return png
+
+def get_qr_pool():
+    global qr_pool
+    with qr_pool_lock:
+        if qr_pool is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            # spawn, not fork: forking a process full of threads can copy held locks
+            qr_pool = ProcessPoolExecutor(max_workers=QR_POOL_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return qr_pool
+
+def create_qr_codes(items, box_size=10, border=4, error_correction='L'):
+    """Return {data: PNG bytes} for many QR codes, rendering cache misses in the process pool"""
+    results = {}
+    missing = []
+    for data in items:
+        key = (data, box_size, border, error_correction)
+        png = qr_cache_get(key)
+        if png is None:
+            missing.append(key)
+        else:
+            results[data] = png
+    
+    if missing:
+        pngs = get_qr_pool().map(render_qr, *zip(*missing), chunksize=16)
+        for key, png in zip(missing, pngs):
+            qr_cache_put(key, png)
+            results[key[0]] = png
+    return results
+
+@functools.lru_cache(maxsize=1)
+def get_bot_username():
+    return bot.get_me().username
+
+def get_invite_link(user_id):
+    return f"https://t.me/{get_bot_username()}?start=ref{user_id}"
+
+def backup_user_data(user_id):
+    # Concurrent /backup requests from one user share a single archive
+    return coalesce(('backup', str(user_id)), lambda: _backup_user_data(user_id))
+
+def _backup_user_data(user_id):
+    try:
+        user_dir = get_user_dir(user_id)
+        if not os.path.exists(user_dir) or not os.listdir(user_dir):
+            return None
+        
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        backup_name = f"user_{user_id}_{timestamp}.zip"
+        backup_path = os.path.join(BACKUP_DIR, backup_name)
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        
+        try:
+            shutil.make_archive(backup_path.replace('.zip', ''), 'zip', user_dir)
+        except OSError as e:
+            if os.path.exists(backup_path):
+                os.remove(backup_path)  # don't leave a truncated archive behind
+            note_disk_error(e)
+            raise
+        return backup_path
+    except Exception as e:
+        logger.error(f"Error creating backup: {e}")
+        return None
+
+def format_time(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+def sanitize_filename(filename):
+    """Sanitize filename to prevent directory traversal"""
+    if not filename:
+        return None
+    filename = os.path.basename(filename)
+    if not filename.endswith('.py'):
+        filename += '.py'
+    return filename
+
+# Bytecode cache
+# Scripts are launched through this stub so the interpreter runs the cached
+# code object instead of recompiling the source on every /startfile.
+BYTECODE_LAUNCHER = """
+import sys
+def _run():
+    import os, marshal, types, importlib.util
+    src, pyc = sys.argv[1], sys.argv[2]
+    code = None
+    try:
+        with open(pyc, 'rb') as f:
+            if f.read(4) == importlib.util.MAGIC_NUMBER:
+                f.read(12)
+                code = marshal.load(f)
+    except Exception:
+        code = None
+    if code is None:
+        with open(src, 'rb') as f:
+            code = compile(f.read(), src, 'exec')
+    else:
+        def refile(c):
+            consts = tuple(refile(k) if isinstance(k, types.CodeType) else k for k in c.co_consts)
+            return c.replace(co_filename=src, co_consts=consts)
+        code = refile(code)
+    sys.argv = [src] + sys.argv[3:]
+    sys.path[0] = os.path.dirname(src)
+    main = sys.modules['__main__'].__dict__
+    main.pop('_run', None)
+    main.pop('sys', None)
+    main['__file__'] = src
+    exec(code, main)
+_run()
+"""
+
+def script_digest(source):
+    return hashlib.sha256(source).hexdigest()
+
+def get_bytecode_path(digest):
+    return os.path.join(PYCACHE_DIR, f"{digest}.{sys.implementation.cache_tag}.pyc")
+
+def check_script_syntax(source, filename):
+    """Compile a script, returning (code, error message)"""
+    try:
+        return compile(source, filename, 'exec', dont_inherit=True), None
+    except SyntaxError as e:
+        return None, f"line {e.lineno}: {e.msg}"
+    except ValueError as e:
+        return None, str(e)
+
+def store_bytecode(source, code):
+    """Write a hash-based .pyc for already compiled source into the shared cache"""
+    pyc_path = get_bytecode_path(script_digest(source))
+    if os.path.exists(pyc_path):
+        return pyc_path
+    try:
+        data = bytearray(importlib.util.MAGIC_NUMBER)
+        data.extend((0b01).to_bytes(4, 'little'))  # unchecked hash-based pyc
+        data.extend(importlib.util.source_hash(source))
+        data.extend(marshal.dumps(code))
+        tmp_path = f"{pyc_path}.{threading.get_ident()}.tmp"
+        os.makedirs(PYCACHE_DIR, exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, pyc_path)
+        return pyc_path
+    except Exception as e:
+        logger.error(f"Error writing bytecode cache: {e}")
+        return None
+
+def precompile_script(path):
+    """Make sure a cached .pyc exists for a script, returning (pyc path, error message)"""
+    try:
+        with open(path, 'rb') as f:
+            source = f.read()
+    except OSError as e:
+        return None, str(e)
+    pyc_path = get_bytecode_path(script_digest(source))
+    if os.path.exists(pyc_path):
+        return pyc_path, None
+    code, error = check_script_syntax(source, os.path.basename(path))
+    if error:
+        return None, error
+    return store_bytecode(source, code), None
+
+def precompile_in_background(paths, on_error=None):
+    """Populate the bytecode cache for several scripts without blocking the handler"""
+    def worker():
+        for path in paths:
+            _, error = precompile_script(path)
+            if error and on_error:
+                on_error(path, error)
+    threading.Thread(target=worker, daemon=True).start()
+
+# Projects
+# A project is an uploaded zip/tar archive with an entry point. The archive and
+# a small <name>.project.json record live in the user's directory; the extracted
+# tree is shared read-only in PROJECT_CACHE_DIR/<sha256 of archive>, and each
+# project gets a writable overlay directory in RUNS_DIR used as its cwd.
+PROJECT_SUFFIX = '.project.json'
+PROJECT_ARCHIVE_EXTS = ('.zip', '.tar', '.tar.gz', '.tgz')
+PROJECT_MANIFEST = 'project.json'
+MAX_PROJECT_SIZE = 200 * 1024 * 1024  # uncompressed bytes
+# A requirement is a PyPI name with optional extras and version specifiers;
+# anything else (pip options, URLs, VCS or local paths) would reach pip as-is
+_VERSION_SPEC = r"(?:===?|~=|!=|<=|>=|<|>)\s*[A-Za-z0-9.*+!_-]+"
+REQUIREMENT_RE = re.compile(r"^[A-Za-z0-9](?:[A-Za-z0-9._-]*[A-Za-z0-9])?"
+                            r"(?:\[[A-Za-z0-9._-]+(?:\s*,\s*[A-Za-z0-9._-]+)*\])?"
+                            rf"\s*(?:{_VERSION_SPEC}(?:\s*,\s*{_VERSION_SPEC})*)?$")
+
+def get_archive_ext(filename):
+    for ext in PROJECT_ARCHIVE_EXTS:
+        if filename.lower().endswith(ext):
+            return ext
+    return None
+
+def sanitize_project_name(filename):
+    ext = get_archive_ext(filename) or ''
+    name = os.path.basename(filename)[:len(os.path.basename(filename)) - len(ext)]
+    name = re.sub(r'[^A-Za-z0-9_.-]', '_', name).strip('.')
+    if not name or name.endswith('.py'):
+        return None
+    return name
+
+def get_project(user_id, name):
+    """Load a project record, or None if the user has no such project"""
+    if not name or os.path.basename(name) != name:
+        return None
+    meta_path = os.path.join(get_user_dir(user_id), name + PROJECT_SUFFIX)
+    try:
+        with open(meta_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def list_projects(user_id):
+    user_dir = get_user_dir(user_id)
+    if not os.path.exists(user_dir):
+        return []
+    names = [f[:-len(PROJECT_SUFFIX)] for f in os.listdir(user_dir) if f.endswith(PROJECT_SUFFIX)]
+    return [p for p in (get_project(user_id, n) for n in sorted(names)) if p]
+
+def sanitize_target(user_id, name):
+    """Resolve a command argument to a project name or a .py filename"""
+    if not name:
+        return None
+    name = os.path.basename(name)
+    if get_project(user_id, name):
+        return name
+    return sanitize_filename(name)
+
+def read_archive_members(data, ext):
+    """Return {member path: size} for the regular files in a project archive"""
+    import tarfile
+    import zipfile
+    members = {}
+    if ext == '.zip':
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            for info in zf.infolist():
+                if not info.is_dir():
+                    members[info.filename] = info.file_size
+    else:
+        with tarfile.open(fileobj=io.BytesIO(data)) as tf:
+            for info in tf.getmembers():
+                if info.isfile():
+                    members[info.name] = info.size
+    return members
+
+def read_archive_file(data, ext, member):
+    import tarfile
+    import zipfile
+    if ext == '.zip':
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            return zf.read(member)
+    with tarfile.open(fileobj=io.BytesIO(data)) as tf:
+        return tf.extractfile(member).read()
+
+def normalize_member(member):
+    return os.path.normpath(member).lstrip('/')
+
+def get_archive_root(members):
+    """Archives made from a folder have a single top-level directory; use it as the root"""
+    names = [normalize_member(m) for m in members]
+    tops = {n.split('/', 1)[0] for n in names}
+    if len(tops) == 1 and all('/' in n for n in names):
+        return tops.pop()
+    return ''
+
+def parse_requirements(text):
+    requirements = []
+    for line in text.splitlines():
+        line = line.split('#', 1)[0].strip()
+        if line and not line.startswith('-'):
+            requirements.append(line)
+    return requirements
+
+def inspect_project_archive(data, ext, entry=None):
+    """Validate a project archive, returning (project info, error message)"""
+    import tarfile
+    import zipfile
+    try:
+        members = read_archive_members(data, ext)
+    except (zipfile.BadZipFile, tarfile.TarError) as e:
+        return None, f"Invalid archive: {e}"
+    if not members:
+        return None, "Archive is empty"
+    if sum(members.values()) > MAX_PROJECT_SIZE:
+        return None, f"Project is larger than {MAX_PROJECT_SIZE // (1024 * 1024)}MB when extracted"
+    
+    root = get_archive_root(members)
+    def member_name(path):
+        for m in members:
+            if normalize_member(m) == (f"{root}/{path}" if root else path):
+                return m
+        return None
+    
+    manifest = {}
+    manifest_member = member_name(PROJECT_MANIFEST)
+    if manifest_member:
+        try:
+            manifest = json.loads(read_archive_file(data, ext, manifest_member))
+        except ValueError as e:
+            return None, f"Invalid {PROJECT_MANIFEST}: {e}"
+    
+    entry = entry or manifest.get('entry')
+    if not entry:
+        return None, None
+    entry = normalize_member(entry)
+    entry_member = None if entry.startswith('..') else member_name(entry)
+    if not entry.endswith('.py') or not entry_member:
+        return None, f"Entry point {entry} not found in archive"
+    
+    _, error = check_script_syntax(read_archive_file(data, ext, entry_member), entry)
+    if error:
+        return None, f"Syntax error in {entry}: {error}"
+    
+    requirements = manifest.get('requirements', [])
+    if not isinstance(requirements, list) or not all(isinstance(r, str) for r in requirements):
+        return None, f"\"requirements\" in {PROJECT_MANIFEST} must be a list of package names"
+    requirements_member = member_name('requirements.txt')
+    if not requirements and requirements_member:
+        requirements = parse_requirements(read_archive_file(data, ext, requirements_member).decode('utf-8', 'replace'))
+    requirements = [r.strip() for r in requirements]
+    invalid = [r for r in requirements if not REQUIREMENT_RE.match(r)]
+    if invalid:
+        return None, f"Unsupported requirements (only package names and versions): {', '.join(invalid[:5])}"
+    
+    return {'entry': entry, 'root': root, 'requirements': requirements}, None
+
+def get_project_tree(digest):
+    return os.path.join(PROJECT_CACHE_DIR, digest)
+
+def make_tree_readonly(path):
+    for dirpath, dirnames, filenames in os.walk(path):
+        for f in filenames:
+            os.chmod(os.path.join(dirpath, f), 0o444)
+        os.chmod(dirpath, 0o555)
+
+def remove_tree(path):
+    """Delete a directory tree, including the read-only trees of the project cache"""
+    for dirpath, _, _ in os.walk(path):
+        os.chmod(dirpath, 0o755)
+    shutil.rmtree(path, ignore_errors=True)
+
+def ensure_project_tree(user_id, project):
+    """Extract a project archive into the shared cache once, returning the tree path"""
+    tree = get_project_tree(project['digest'])
+    if os.path.isdir(tree):
+        try:
+            os.utime(tree)  # last use, for the janitor
+        except OSError:
+            pass
+        return tree
+    
+    import compileall
+    import tarfile
+    import zipfile
+    
+    archive_path = os.path.join(get_user_dir(user_id), project['archive'])
+    os.makedirs(PROJECT_CACHE_DIR, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=PROJECT_CACHE_DIR, prefix='.extract-')
+    try:
+        ext = get_archive_ext(project['archive'])
+        if ext == '.zip':
+            with zipfile.ZipFile(archive_path) as zf:
+                zf.extractall(tmp_dir)
+        else:
+            with tarfile.open(archive_path) as tf:
+                if hasattr(tarfile, 'data_filter'):
+                    tf.extractall(tmp_dir, filter='data')
+                else:
+                    tf.extractall(tmp_dir, members=[
+                        m for m in tf.getmembers()
+                        if (m.isfile() or m.isdir()) and not normalize_member(m.name).startswith('..')])
+        # Compile once so read-only imports never need to write __pycache__
+        compileall.compile_dir(tmp_dir, quiet=1, workers=1)
+        make_tree_readonly(tmp_dir)
+        try:
+            os.rename(tmp_dir, tree)
+        except OSError:
+            if not os.path.isdir(tree):
+                raise
+    finally:
+        if os.path.exists(tmp_dir):
+            remove_tree(tmp_dir)
+    return tree
+
+def prepare_project_overlay(user_id, project, tree):
+    """Link the shared tree into the project's writable run directory"""
+    root = os.path.join(tree, project['root']) if project['root'] else tree
+    overlay = os.path.join(RUNS_DIR, str(user_id), project['name'])
+    os.makedirs(overlay, exist_ok=True)
+    
+    # Drop links left over from a previous version of the project
+    for entry in os.listdir(overlay):
+        link = os.path.join(overlay, entry)
+        if os.path.islink(link) and os.path.realpath(link) != os.path.join(os.path.realpath(root), entry):
+            os.unlink(link)
+    
+    for entry in os.listdir(root):
+        link = os.path.join(overlay, entry)
+        if not os.path.lexists(link):
+            os.symlink(os.path.join(root, entry), link)
+    return overlay, os.path.join(root, project['entry'])
+
+def save_project(user_id, name, data, ext, info):
+    """Store a project archive and its record in the user's directory"""
+    user_dir = ensure_user_dir(user_id)
+    old = get_project(user_id, name)
+    if old and old['archive'] != name + ext:
+        try:
+            os.remove(os.path.join(user_dir, old['archive']))
+        except OSError:
+            pass
+    
+    project = {
+        'name': name,
+        'archive': name + ext,
+        'digest': hashlib.sha256(data).hexdigest(),
+        'entry': info['entry'],
+        'root': info['root'],
+        'requirements': info['requirements'],
+        'uploaded': datetime.datetime.now().isoformat()
+    }
+    with open(os.path.join(user_dir, project['archive']), 'wb') as f:
+        f.write(data)
+    with open(os.path.join(user_dir, name + PROJECT_SUFFIX), 'w') as f:
+        json.dump(project, f)
+    return project
+
+def delete_project(user_id, name):
+    project = get_project(user_id, name)
+    if not project:
+        return False
+    user_dir = get_user_dir(user_id)
+    for path in (os.path.join(user_dir, project['archive']), os.path.join(user_dir, name + PROJECT_SUFFIX)):
+        if os.path.exists(path):
+            os.remove(path)
+    shutil.rmtree(os.path.join(RUNS_DIR, str(user_id), name), ignore_errors=True)
+    return True
+
+def prefetch_project(user_id, project, on_done=None):
+    """Extract the project and install its requirements in the background"""
+    def worker():
+        results = []
+        try:
+            ensure_project_tree(user_id, project)
+        except Exception as e:
+            logger.error(f"Error extracting project {project['name']}: {e}")
+        for requirement in project['requirements']:
+            if requirement not in installed_modules:
+                results.append(install_module(requirement, user_id))
+        if on_done:
+            on_done(results)
+    submit_job('install', worker, priority=job_priority(user_id))
+
+# Script launching
+# Running scripts are also recorded in RUNNING_FILE so a bot process taking
+# over after a crash can adopt the children instead of restarting them.
+SCRIPT_TIMEOUT = 3600
+running_lock = threading.Lock()
+
+def _update_running(update):
+    with running_lock:
+        try:
+            with open(RUNNING_FILE, 'r') as f:
+                running = json.load(f)
+        except (OSError, ValueError):
+            running = {}
+        update(running)
+        write_json_atomic(RUNNING_FILE, running)
+
+def record_running(key, pid, info):
+    import psutil
+    try:
+        create_time = psutil.Process(pid).create_time()
+    except psutil.Error:
+        return
+    entry = {'pid': pid, 'create_time': create_time, 'start': info['start'], 'log_file': info['log_file']}
+    _update_running(lambda running: running.__setitem__(key, entry))
+
+def forget_running(key):
+    _update_running(lambda running: running.pop(key, None))
+
+def release_script(key, proc):
+    """Forget an exited script unless a redeployed instance has taken over its key"""
+    current = processes.get(key)
+    if current is None or current['process'] is proc:
+        processes.pop(key, None)
+        forget_running(key)
+        admission_wake.set()  # its memory may let a queued launch start
+
+def adopt_running_scripts():
+    """Take over scripts started by a previous bot process that are still alive"""
+    try:
+        with open(RUNNING_FILE, 'r') as f:
+            running = json.load(f)
+    except (OSError, ValueError):
+        return 0
+    
+    import psutil
+    adopted = 0
+    for key, entry in running.items():
+        if key in processes:
+            continue
+        try:
+            proc = psutil.Process(entry['pid'])
+            if abs(proc.create_time() - entry['create_time']) > 1:
+                raise psutil.NoSuchProcess(entry['pid'])  # pid was reused
+        except psutil.Error:
+            forget_running(key)
+            continue
+        
+        processes[key] = {
+            'process': proc,
+            'start': entry['start'],
+            'log_file': entry['log_file'],
+            'adopted': True
+        }
+        remaining = SCRIPT_TIMEOUT - (time.time() - entry['start'])
+        threading.Thread(target=watch_adopted_script, args=(key, proc, remaining),
+                         name=f"run_script:{key}").start()
+        adopted += 1
+    return adopted
+
+def watch_adopted_script(key, proc, remaining):
+    import psutil
+    try:
+        proc.wait(timeout=max(remaining, 0))
+    except psutil.TimeoutExpired:
+        proc.terminate()
+    except psutil.Error:
+        pass
+    finally:
+        release_script(key, proc)
+        charge_exit_cpu(key.split(':', 1)[0], proc.pid, None)  # not our child, no rusage to read
+        inc_metric('hosted_script_exits_total', 'adopted')
+
+def wait_for_exit(proc, timeout):
+    """Reap a spawned script, terminating it after timeout; returns its CPU seconds or None if unknown"""
+    if not hasattr(os, 'wait4'):
+        try:
+            proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.terminate()
+            proc.wait()
+        return None
+    
+    timer = threading.Timer(timeout, proc.terminate)
+    timer.daemon = True
+    timer.start()
+    try:
+        _, status, usage = os.wait4(proc.pid, 0)
+    except ChildProcessError:
+        proc.wait()  # already reaped through Popen; its rusage is gone
+        return None
+    finally:
+        timer.cancel()
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return usage.ru_utime + usage.ru_stime
+
+def launch_script(uid, filename, project=None, log_file=None, on_spawn=None):
+    """Start a hosted script in a background thread, returning an error message or None.
+    
+    With on_spawn the new process is not registered as running; on_spawn(info)
+    gets it instead and decides when it takes over (see redeploy_script).
+    """
+    path = os.path.join(UPLOAD_DIR, str(uid), filename)
+    log_file = log_file or os.path.join(LOGS_DIR, f"{uid}_{filename}.log")
+    key = f"{uid}:{filename}"
+    
+    cwd = None
+    if project:
+        cwd, path = prepare_project_overlay(uid, project, ensure_project_tree(uid, project))
+    
+    pyc_path, error = precompile_script(path)
+    if error:
+        return f"Syntax error: {error}"
+    
+    def run_script():
+        os.makedirs(LOGS_DIR, exist_ok=True)
+        
+        env = os.environ.copy()
+        env['PYTHONPATH'] = MODULES_DIR
+        env['PYTHONUNBUFFERED'] = '1'  # output reaches the log (and /attach) as it is printed
+        if project:
+            env['PYTHONDONTWRITEBYTECODE'] = '1'  # shared tree is read-only
+        
+        cmd = ['python', path]
+        if pyc_path:
+            cmd = ['python', '-c', BYTECODE_LAUNCHER, path, pyc_path]
+        
+        reset_log_index(log_file)
+        with open(log_file, 'w') as f:
+            proc = subprocess.Popen(
+                cmd,
+                stdout=f,
+                stderr=f,
+                env=env,
+                cwd=cwd
+            )
+            
+            info = {
+                'process': proc,
+                'start': time.time(),
+                'log_file': log_file
+            }
+            if on_spawn:
+                on_spawn(info)
+            else:
+                processes[key] = info
+                record_running(key, proc.pid, info)
+            inc_metric('hosted_script_starts_total')
+            
+            cpu_total = None
+            try:
+                cpu_total = wait_for_exit(proc, SCRIPT_TIMEOUT)
+            finally:
+                release_script(key, proc)
+                charge_exit_cpu(uid, proc.pid, cpu_total)
+                if proc.returncode == 0:
+                    inc_metric('hosted_script_exits_total', 'ok')
+                elif proc.returncode is None or proc.returncode < 0:
+                    inc_metric('hosted_script_exits_total', 'killed')
+                else:
+                    inc_metric('hosted_script_exits_total', 'crashed')
+    
+    threading.Thread(target=run_script, name=f"run_script:{key}").start()
+    return None
+
+def stop_script(key):
+    """Terminate a local script, returning its runtime or None if it isn't running"""
+    proc_info = processes.pop(key, None)
+    if not proc_info:
+        return None
+    proc_info['process'].terminate()
+    return time.time() - proc_info['start']
+
+# Hot redeploy
+# The new version starts next to the old one, logging to <log>.next. It is
+# ready once the given marker appears in its output, or else once it has
+# stayed up for REDEPLOY_WARMUP seconds. Only then is the old instance
+# stopped and the new one takes over the key, running record and log file.
+# If it exits or misses REDEPLOY_TIMEOUT during warm-up it is killed and the
+# old instance keeps running untouched. /stopfile during warm-up kills both,
+# and a script that stopped while the new version warmed up stays stopped.
+# Two long-polling instances don't both serve, so the downtime reported is
+# the gap from the old instance's exit to the new one's first output after
+# it (0 if it already wrote while the old one was stopping).
+REDEPLOY_WARMUP = 10
+REDEPLOY_TIMEOUT = 60
+REDEPLOY_SERVE_TIMEOUT = 30  # how long to wait for output after the handover
+REDEPLOY_SERVE_POLL = 0.01  # the downtime is only as precise as this
+REDEPLOY_STOP_TIMEOUT = 10  # grace before the old instance is killed
+REDEPLOY_POLL = 0.2
+REDEPLOY_TAIL_LINES = 10
+
+redeploying = {}  # key -> info of the instance warming up ({} until it has spawned)
+redeploy_lock = threading.Lock()  # handover vs. /stopfile
+
+def cancel_redeploy(key):
+    """Kill the instance a redeploy of key is warming up; call with redeploy_lock held"""
+    new = redeploying.get(key)
+    if new is None:
+        return
+    new['cancelled'] = True
+    if new.get('process') and new['process'].poll() is None:
+        new['process'].kill()
+
+def wait_until_ready(proc, log_file, marker):
+    """Poll a warming-up instance, returning None when ready or why it failed"""
+    started = time.monotonic()
+    offset, carry = 0, b''
+    needle = marker.encode('utf-8') if marker else None
+    while True:
+        if proc.poll() is not None:
+            return f"exited with code {proc.returncode} during warm-up"
+        elapsed = time.monotonic() - started
+        if needle:
+            try:
+                with open(log_file, 'rb') as f:
+                    f.seek(offset)
+                    chunk = f.read()
+            except OSError:
+                chunk = b''
+            offset += len(chunk)
+            if needle in carry + chunk:
+                return None
+            carry = (carry + chunk)[-len(needle):]
+            if elapsed > REDEPLOY_TIMEOUT:
+                return f"did not print {marker!r} within {REDEPLOY_TIMEOUT}s"
+        elif elapsed >= REDEPLOY_WARMUP:
+            return None
+        time.sleep(REDEPLOY_POLL)
+
+def wait_until_serving(proc, log_file, size):
+    """Wait for an instance to write past size, returning the wall time of that write or None"""
+    started = time.monotonic()
+    while time.monotonic() - started < REDEPLOY_SERVE_TIMEOUT:
+        try:
+            st = os.stat(log_file)
+            if st.st_size > size:
+                return st.st_mtime
+        except OSError:
+            pass
+        if proc.poll() is not None:
+            return None
+        time.sleep(REDEPLOY_SERVE_POLL)
+    return None
+
+def read_log_tail(path, lines=REDEPLOY_TAIL_LINES):
+    try:
+        with open(path, 'rb') as f:
+            f.seek(max(0, os.path.getsize(path) - 4096))
+            return b"\n".join(f.read().splitlines()[-lines:]).decode('utf-8', 'replace')
+    except OSError:
+        return ""
+
+def redeploy_script(uid, filename, project, marker, report):
+    """Replace a running script with the version on disk, calling report(text) with the outcome"""
+    key = f"{uid}:{filename}"
+    log_file = os.path.join(LOGS_DIR, f"{uid}_{filename}.log")
+    next_log = log_file + '.next'
+    spawned = threading.Event()
+    new = redeploying.setdefault(key, {})
+    
+    def on_spawn(info):
+        with redeploy_lock:
+            new.update(info)
+            if new.get('cancelled'):
+                info['process'].kill()
+        spawned.set()
+    
+    try:
+        deploy_started = time.monotonic()
+        error = launch_script(uid, filename, project, log_file=next_log, on_spawn=on_spawn)
+        if error:
+            cancel_admission(key)
+            inc_metric('script_redeploys_total', 'rejected')
+            return report(f"❌ Redeploy of <code>{filename}</code> rejected, the old version keeps running.\n{html_escape(error)}")
+        if not spawned.wait(REDEPLOY_TIMEOUT):
+            inc_metric('script_redeploys_total', 'rolled_back')
+            return report(f"❌ The new <code>{filename}</code> never started, the old version keeps running.")
+        
+        failure = wait_until_ready(new['process'], next_log, marker)
+        ready_at = time.monotonic()
+        with redeploy_lock:
+            old = processes.get(key)
+            if not failure and (new.get('cancelled') or not old):
+                failure = "was discarded because the script was stopped during warm-up"
+                new['process'].kill()
+            if not failure:
+                # Hand over: the new instance owns the key before the old one goes
+                processes[key] = new
+        if failure:
+            if new['process'].poll() is None:
+                new['process'].kill()
+            tail = html_escape(read_log_tail(next_log))
+            try:
+                os.remove(next_log)
+            except OSError:
+                pass
+            inc_metric('script_redeploys_total', 'rolled_back')
+            if new.get('cancelled') or not old:
+                return report(f"⏹️ Redeploy of <code>{filename}</code> cancelled: the script was stopped during warm-up.")
+            return report(f"↩️ Rolled back <code>{filename}</code>: the new version {html_escape(failure)}.\n"
+                          f"The old version keeps running.\n\n<b>Last output:</b>\n<pre>{tail or '(none)'}</pre>")
+        
+        os.replace(next_log, log_file)  # the new process keeps writing through its open descriptor
+        new['log_file'] = log_file
+        reset_log_index(log_file)
+        record_running(key, new['process'].pid, new)
+        try:
+            handover_size = os.path.getsize(log_file)
+        except OSError:
+            handover_size = 0
+        
+        old['process'].terminate()
+        try:
+            old['process'].wait(timeout=REDEPLOY_STOP_TIMEOUT)
+        except Exception:
+            old['process'].kill()
+            old['process'].wait()
+        old_stopped_at = time.monotonic()
+        old_stopped_wall = time.time()
+        
+        try:
+            stop_size = os.path.getsize(log_file)
+        except OSError:
+            stop_size = handover_size
+        if stop_size > handover_size:
+            served_at = old_stopped_wall  # it was already writing while the old one stopped
+        else:
+            served_at = wait_until_serving(new['process'], log_file, handover_size)
+        inc_metric('script_redeploys_total', 'ok')
+        if served_at is None:
+            downtime_text = f"unknown (no output within {REDEPLOY_SERVE_TIMEOUT}s of the handover)"
+        else:
+            downtime = max(0.0, served_at - old_stopped_wall)
+            observe_metric('script_redeploy_downtime_seconds', value=downtime)
+            downtime_text = f"{downtime:.2f}s until the new instance's first output"
+        report(f"""
+✅ Redeployed <code>{filename}</code>
+
+Warm-up: {ready_at - deploy_started:.1f}s ({'marker seen' if marker else f'stayed up {REDEPLOY_WARMUP}s'})
+Handover: old instance stopped {old_stopped_at - ready_at:.2f}s after the new one was ready
+Downtime: {downtime_text}
+""")
+    except Exception as e:
+        logger.error(f"Error redeploying {key}: {e}")
+        report(f"❌ Redeploy of <code>{filename}</code> failed. Please check /listfiles.")
+    finally:
+        redeploying.pop(key, None)
+
+# Cluster
+# With CLUSTER_LISTEN set this process is the control plane: worker agents
+# (worker_agent.py) report heartbeats here and hosted scripts run on them.
+# Users hash onto a ring of workers; a script goes to the least loaded of the
+# user's first CLUSTER_CANDIDATES workers on the ring that has capacity left.
+# RPC is one JSON object per line over TCP ("host:port") or a Unix socket
+# ("unix:/path"). Every request is signed with HMAC-SHA256 under the shared
+# CLUSTER_SECRET and carries its send time; unsigned, forged or stale
+# requests are refused before they reach a handler.
+CLUSTER_LISTEN = os.getenv("CLUSTER_LISTEN")
+CLUSTER_SECRET = os.getenv("CLUSTER_SECRET", "")
+CLUSTER_RPC_MAX_AGE = 60  # seconds a signed request stays valid
+CLUSTER_HEARTBEAT_INTERVAL = 5
+CLUSTER_WORKER_TIMEOUT = 3 * CLUSTER_HEARTBEAT_INTERVAL
+CLUSTER_CANDIDATES = 2
+CLUSTER_VNODES = 64
+CLUSTER_MAX_LOG_BYTES = 20 * 1024 * 1024  # tail of the log a worker returns for /getlog
+
+workers = {}  # worker_id -> last heartbeat
+cluster_scripts = UserKeyedDict()  # running "uid:filename" -> worker_id
+cluster_placements = {}  # "uid:filename" -> worker it last ran on, for /getlog
+cluster_pending = {}  # "uid:filename" -> time it was placed, until a heartbeat confirms it
+cluster_ring = []  # sorted (hash, worker_id)
+cluster_lock = threading.Lock()
+
+def cluster_enabled():
+    return bool(CLUSTER_LISTEN)
+
+def parse_address(address):
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    host, port = address.rsplit(':', 1)
+    return socket.AF_INET, (host, int(port))
+
+def sign_rpc(request):
+    """Wrap request in a signed envelope line"""
+    body = json.dumps(dict(request, ts=time.time()), sort_keys=True)
+    mac = hmac.new(CLUSTER_SECRET.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).hexdigest()
+    return json.dumps({'body': body, 'mac': mac}).encode('utf-8') + b'\n'
+
+def verify_rpc(line):
+    """Return the request in a signed envelope line, or None if it is forged or stale"""
+    try:
+        envelope = json.loads(line)
+        body, mac = envelope['body'], envelope['mac']
+        if not isinstance(body, str) or not isinstance(mac, str):
+            return None
+        expected = hmac.new(CLUSTER_SECRET.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(mac, expected):
+            return None
+        request = json.loads(body)
+    except (ValueError, TypeError, KeyError):
+        return None
+    sent = request.get('ts') if isinstance(request, dict) else None
+    if not isinstance(sent, (int, float)) or abs(time.time() - sent) > CLUSTER_RPC_MAX_AGE:
+        return None
+    return request
+
+def serve_rpc(address, handle):
+    """Answer signed JSON line requests on address with handle(request) -> response"""
+    if not CLUSTER_SECRET:
+        raise RuntimeError("CLUSTER_SECRET must be set to serve cluster RPCs")
+    family, addr = parse_address(address)
+    if family == socket.AF_UNIX and os.path.exists(addr):
+        os.remove(addr)
+    server = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_INET:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(addr)
+    server.listen(64)
+    
+    def serve_connection(conn):
+        with conn, conn.makefile('rwb') as stream:
+            for line in stream:
+                request = verify_rpc(line)
+                if request is None:
+                    logger.error(f"Refused an unauthenticated RPC on {address}")
+                    stream.write(json.dumps({'ok': False, 'error': 'unauthorized'}).encode('utf-8') + b'\n')
+                    stream.flush()
+                    return
+                try:
+                    response = handle(request)
+                except Exception as e:
+                    logger.error(f"Error handling RPC on {address}: {e}")
+                    response = {'ok': False, 'error': str(e)}
+                stream.write(json.dumps(response).encode('utf-8') + b'\n')
+                stream.flush()
+    
+    def accept_loop():
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=serve_connection, args=(conn,), daemon=True).start()
+    
+    threading.Thread(target=accept_loop, name=f"rpc:{address}", daemon=True).start()
+    return server
+
+def rpc_call(address, request, timeout=30):
+    family, addr = parse_address(address)
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(addr)
+        with sock.makefile('rwb') as stream:
+            stream.write(sign_rpc(request))
+            stream.flush()
+            line = stream.readline()
+    if not line:
+        raise ConnectionError(f"No response from {address}")
+    return json.loads(line)
+
+def _ring_hash(value):
+    return int(hashlib.md5(str(value).encode('utf-8')).hexdigest()[:16], 16)
+
+def rebuild_ring():
+    global cluster_ring
+    cluster_ring = sorted((_ring_hash(f"{worker_id}#{i}"), worker_id)
+                          for worker_id in workers for i in range(CLUSTER_VNODES))
+
+def get_candidate_workers(uid, count=CLUSTER_CANDIDATES):
+    """The first count distinct workers clockwise from the user's point on the ring"""
+    if not cluster_ring:
+        return []
+    start = bisect.bisect(cluster_ring, (_ring_hash(uid), ''))
+    candidates = []
+    for i in range(len(cluster_ring)):
+        worker_id = cluster_ring[(start + i) % len(cluster_ring)][1]
+        if worker_id not in candidates:
+            candidates.append(worker_id)
+            if len(candidates) == count:
+                break
+    return candidates
+
+def pick_worker(uid):
+    with cluster_lock:
+        def load(worker_id):
+            return workers[worker_id]['running'] / max(workers[worker_id]['capacity'], 1)
+        
+        available = [w for w in get_candidate_workers(uid) if load(w) < 1]
+        if not available:
+            available = [w for w in workers if load(w) < 1]
+        if not available:
+            return None
+        worker_id = min(available, key=load)
+        workers[worker_id]['running'] += 1  # until the next heartbeat corrects it
+        return worker_id
+
+def handle_control_rpc(request):
+    if request.get('op') != 'heartbeat':
+        return {'ok': False, 'error': f"Unknown op {request.get('op')}"}
+    
+    worker_id = request['worker_id']
+    running = set(request.get('running', []))
+    now = time.time()
+    with cluster_lock:
+        is_new = worker_id not in workers
+        workers[worker_id] = {
+            'address': request['address'],
+            'capacity': request.get('capacity', 0),
+            'running': len(running),
+            'memory_percent': request.get('memory_percent', 0),
+            'last_seen': now
+        }
+        for key, owner in list(cluster_scripts.items()):
+            if owner == worker_id and key not in running and now - cluster_pending.get(key, 0) > 2 * CLUSTER_HEARTBEAT_INTERVAL:
+                cluster_scripts.pop(key, None)
+                cluster_pending.pop(key, None)
+        for key in running:
+            cluster_scripts[key] = worker_id
+            cluster_placements[key] = worker_id
+        if is_new:
+            logger.info(f"Worker {worker_id} joined at {request['address']}")
+            rebuild_ring()
+    # Workers install these into their own MODULES_DIR
+    return {'ok': True, 'modules': sorted(installed_modules)}
+
+def expire_workers():
+    while True:
+        time.sleep(CLUSTER_HEARTBEAT_INTERVAL)
+        now = time.time()
+        with cluster_lock:
+            dead = [w for w, info in workers.items() if now - info['last_seen'] > CLUSTER_WORKER_TIMEOUT]
+            for worker_id in dead:
+                logger.error(f"Worker {worker_id} missed its heartbeats, dropping it")
+                workers.pop(worker_id, None)
+                for key, owner in list(cluster_scripts.items()):
+                    if owner == worker_id:
+                        cluster_scripts.pop(key, None)
+            if dead:
+                rebuild_ring()
+
+def start_cluster():
+    serve_rpc(CLUSTER_LISTEN, handle_control_rpc)
+    threading.Thread(target=expire_workers, name='cluster-expiry', daemon=True).start()
+    logger.info(f"🛰️ Control plane listening for workers on {CLUSTER_LISTEN}")
+
+def cluster_start_script(uid, filename, project=None):
+    """Place a script on a worker, returning an error message or None"""
+    worker_id = pick_worker(uid)
+    if not worker_id:
+        return "No worker has free capacity right now. Please try again later."
+    
+    source = os.path.join(get_user_dir(uid), project['archive'] if project else filename)
+    with open(source, 'rb') as f:
+        content = f.read()
+    request = {
+        'op': 'start',
+        'uid': str(uid),
+        'filename': filename,
+        'digest': project['digest'] if project else script_digest(content),
+        'project': project,
+        'modules': sorted(installed_modules)
+    }
+    
+    address = workers[worker_id]['address']
+    try:
+        response = rpc_call(address, request)
+        if response.get('need_content'):
+            # The worker has no copy of this version yet; ship it once
+            request['content'] = base64.b64encode(content).decode('ascii')
+            response = rpc_call(address, request)
+    except OSError as e:
+        logger.error(f"Error starting {filename} on worker {worker_id}: {e}")
+        return f"Worker {worker_id} is unreachable. Please try again."
+    
+    if not response.get('ok'):
+        return response.get('error') or "Worker refused to start the script"
+    
+    key = f"{uid}:{filename}"
+    with cluster_lock:
+        cluster_scripts[key] = worker_id
+        cluster_placements[key] = worker_id
+        cluster_pending[key] = time.time()
+    inc_metric('hosted_script_starts_total')
+    return None
+
+def _cluster_request(worker_id, request):
+    info = workers.get(worker_id)
+    if not info:
+        return None
+    try:
+        return rpc_call(info['address'], request)
+    except OSError as e:
+        logger.error(f"Error calling worker {worker_id}: {e}")
+        return None
+
+def cluster_stop_script(key):
+    """Stop a script on its worker, returning its runtime or None if the worker is unreachable"""
+    uid, filename = key.split(':', 1)
+    response = _cluster_request(cluster_scripts.get(key), {'op': 'stop', 'uid': uid, 'filename': filename})
+    if response is None:
+        return None
+    with cluster_lock:
+        cluster_scripts.pop(key, None)
+        cluster_pending.pop(key, None)
+    return response.get('runtime') or 0
+
+def cluster_get_log(key):
+    """Fetch a script's log from the worker that ran it, or None"""
+    uid, filename = key.split(':', 1)
+    order = [cluster_placements.get(key)] + get_candidate_workers(uid) + list(workers)
+    tried = set()
+    for worker_id in order:
+        if not worker_id or worker_id in tried:
+            continue
+        tried.add(worker_id)
+        response = _cluster_request(worker_id, {'op': 'getlog', 'uid': uid, 'filename': filename})
+        if response and response.get('ok'):
+            cluster_placements[key] = worker_id
+            return base64.b64decode(response['content'])
+    return None
+
+def cluster_delete_script(key):
+    uid, filename = key.split(':', 1)
+    for worker_id in list(workers):
+        _cluster_request(worker_id, {'op': 'delete', 'uid': uid, 'filename': filename})
+    with cluster_lock:
+        cluster_scripts.pop(key, None)
+        cluster_placements.pop(key, None)
+
+# Scheduler
+# Scripts with a cron expression are started by one scheduler thread instead
+# of sleeping in a loop between runs. The heap holds (fire time, key) and is
+# lazily invalidated: an entry only fires if it still matches schedules[key].
+# A run counts against the user's limit while it executes, like /startfile.
+# Occurrences missed while the bot was down run once if they are at most
+# SCHEDULE_CATCH_UP seconds late and are skipped otherwise. schedule_lock
+# guards schedules and its entries between handlers, the scheduler thread
+# and save_data; it is never held while a script starts.
+SCHEDULE_MAX_CONCURRENT = 20  # scheduled runs executing at once, across all users
+SCHEDULE_JITTER = 30  # seconds of random delay so "* * * * *" jobs don't all start together
+SCHEDULE_CATCH_UP = 300
+CRON_FIELDS = [
+    ('minute', 0, 59),
+    ('hour', 0, 23),
+    ('day of month', 1, 31),
+    ('month', 1, 12),
+    ('day of week', 0, 7)
+]
+
+schedule_heap = []
+schedule_cond = threading.Condition()
+schedule_lock = threading.Lock()
+scheduler_thread = None
+
+def parse_cron(expr):
+    """Parse a 5-field cron expression into sets of allowed values, raising ValueError"""
+    fields = expr.split()
+    if len(fields) != 5:
+        raise ValueError("expected 5 fields: minute hour day month weekday")
+    
+    parsed = []
+    for field, (name, low, high) in zip(fields, CRON_FIELDS):
+        allowed = set()
+        for part in field.split(','):
+            value_range, _, step = part.partition('/')
+            step = int(step) if step else 1
+            if value_range == '*':
+                start, end = low, high
+            elif '-' in value_range:
+                start, end = (int(v) for v in value_range.split('-', 1))
+            else:
+                start = end = int(value_range)
+                if step > 1:
+                    end = high
+            if step < 1 or start < low or end > high or start > end:
+                raise ValueError(f"invalid {name}: {part}")
+            allowed.update(range(start, end + 1, step))
+        if name == 'day of week' and 7 in allowed:
+            allowed.discard(7)
+            allowed.add(0)  # 7 is Sunday too
+        parsed.append(allowed)
+    return parsed
+
+def next_cron_time(expr, after):
+    """First timestamp strictly after `after` (server local time) matching expr"""
+    minutes, hours, days, months, weekdays = parse_cron(expr)
+    fields = expr.split()
+    any_day, any_weekday = fields[2] == '*', fields[4] == '*'
+    
+    t = datetime.datetime.fromtimestamp(after).replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+    limit = t + datetime.timedelta(days=4 * 366)
+    while t < limit:
+        if t.month not in months:
+            t = (t.replace(day=1) + datetime.timedelta(days=32)).replace(day=1, hour=0, minute=0)
+            continue
+        # Like cron, a restricted day of month and day of week match either one
+        day_ok = t.day in days
+        weekday_ok = (t.weekday() + 1) % 7 in weekdays
+        if not ((day_ok and weekday_ok) if any_day or any_weekday else (day_ok or weekday_ok)):
+            t = t.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            continue
+        if t.hour not in hours:
+            t = t.replace(minute=0) + datetime.timedelta(hours=1)
+            continue
+        if t.minute not in minutes:
+            t += datetime.timedelta(minutes=1)
+            continue
+        return t.timestamp()
+    raise ValueError("expression never matches")
+
+def push_schedule(key, entry):
+    with schedule_cond:
+        heapq.heappush(schedule_heap, (entry['next'] + entry.get('jitter', 0), key, entry['next']))
+        schedule_cond.notify()
+
+def set_schedule(uid, filename, expr):
+    """Schedule a script, returning the next run time; raises ValueError on a bad expression"""
+    key = f"{uid}:{filename}"
+    entry = {
+        'cron': expr,
+        'next': next_cron_time(expr, time.time()),
+        'jitter': round(random.uniform(0, SCHEDULE_JITTER), 1),
+        'created': datetime.datetime.now().isoformat(),
+        'runs': 0,
+        'skipped': 0,
+        'last_run': None,
+        'last_status': None
+    }
+    with schedule_lock:
+        schedules[key] = entry
+    save_data()
+    push_schedule(key, entry)
+    return entry['next']
+
+def remove_schedule(uid, filename):
+    with schedule_lock:
+        if schedules.pop(f"{uid}:{filename}", None) is None:
+            return False
+    save_data()
+    return True
+
+def get_scheduled_running():
+    return sum(1 for key in schedules if key in processes or key in cluster_scripts)
+
+def run_scheduled(key, entry):
+    """Start one scheduled run, returning a status string"""
+    uid, filename = key.split(':', 1)
+    project = get_project(uid, filename)
+    if not project and not os.path.exists(os.path.join(get_user_dir(uid), filename)):
+        return 'missing'
+    if key in processes or key in cluster_scripts:
+        return 'still running'
+    if get_running_count(uid) >= get_limit(uid):
+        return 'limit reached'
+    if get_scheduled_running() >= SCHEDULE_MAX_CONCURRENT:
+        return 'scheduler busy'
+    
+    if cluster_enabled():
+        error = cluster_start_script(uid, filename, project)
+    else:
+        decision, _ = admit_script(key)
+        if decision != 'accept':
+            return 'no capacity'
+        error = launch_script(uid, filename, project)
+        if error:
+            cancel_admission(key)
+    return f"error: {error}" if error else 'started'
+
+def scheduler_loop():
+    handler_context.name = 'scheduler'
+    while True:
+        with schedule_cond:
+            while not schedule_heap or schedule_heap[0][0] > time.time():
+                schedule_cond.wait(schedule_heap[0][0] - time.time() if schedule_heap else None)
+            _, key, due = heapq.heappop(schedule_heap)
+        
+        with schedule_lock:
+            entry = schedules.get(key)
+            if not entry or entry['next'] != due:
+                continue  # removed or rescheduled since this entry was pushed
+        
+        now = time.time()
+        try:
+            if now - due > SCHEDULE_CATCH_UP + entry.get('jitter', 0):
+                status = 'missed'
+            else:
+                status = run_scheduled(key, entry)
+        except Exception as e:
+            logger.error(f"Error running scheduled script {key}: {e}")
+            status = f"error: {e}"
+        
+        with schedule_lock:
+            if schedules.get(key) is not entry:
+                pass  # removed or replaced while it ran; leave the new state alone
+            elif status == 'missing':
+                schedules.pop(key, None)
+            else:
+                if status == 'started':
+                    entry['runs'] += 1
+                    entry['last_run'] = datetime.datetime.now().isoformat()
+                else:
+                    entry['skipped'] += 1
+                entry['last_status'] = status
+                entry['next'] = next_cron_time(entry['cron'], max(now, due))
+                push_schedule(key, entry)
+        inc_metric('scheduled_runs_total', status if not status.startswith('error') else 'error')
+        save_data()
+
+def start_scheduler():
+    """Queue every stored schedule and start the scheduler thread"""
+    global scheduler_thread
+    with schedule_lock:
+        for key, entry in list(schedules.items()):
+            try:
+                entry.setdefault('next', next_cron_time(entry['cron'], time.time()))
+                push_schedule(key, entry)
+            except (KeyError, ValueError) as e:
+                logger.error(f"Dropping invalid schedule {key}: {e}")
+                schedules.pop(key, None)
+    if scheduler_thread is None:
+        scheduler_thread = threading.Thread(target=scheduler_loop, name='scheduler', daemon=True)
+        scheduler_thread.start()
+    logger.info(f"⏰ Scheduler started with {len(schedules)} schedules")
+
+# Resource sampling
+# One thread samples every tracked script per RESOURCE_SAMPLE_INTERVAL, reading
+# each pid's counters in a single psutil oneshot() pass. Samples go into a
+# fixed-size ring buffer per script; /top only renders what is already there.
+# CPU time is metered per pid from zero for children this process started
+# (from where it stands for adopted ones); whatever a child used after its
+# last sample is charged from its wait4() rusage when run_script reaps it.
+RESOURCE_SAMPLE_INTERVAL = 5
+RESOURCE_HISTORY = 60  # samples kept per script (5 minutes)
+SPARKLINE = "▁▂▃▄▅▆▇█"
+
+resource_samples = {}  # "uid:filename" -> deque of (time, cpu %, rss bytes, threads, fds)
+resource_procs = {}  # "uid:filename" -> psutil.Process, kept so cpu_percent() has a baseline
+resource_cpu_metered = {}  # pid -> user + system CPU seconds metered so far; under meter_lock
+sampler_thread = None
+
+def sample_resources():
+    """Take one sample of every running local script"""
+    import psutil
+    now = time.time()
+    for key, info in list(processes.items()):
+        pid = info['process'].pid
+        proc = resource_procs.get(key)
+        if proc is None or proc.pid != pid:
+            try:
+                proc = resource_procs[key] = psutil.Process(pid)
+                proc.cpu_percent(None)  # first call only sets the baseline
+                cpu_times = proc.cpu_times()
+            except psutil.Error:
+                continue
+            with meter_lock:
+                # Unless it exited and was charged since the list was taken
+                if processes.get(key) is info:
+                    # An adopted script's CPU so far was metered by the process that started it
+                    resource_cpu_metered.setdefault(pid, cpu_times.user + cpu_times.system if info.get('adopted') else 0.0)
+            resource_samples[key] = collections.deque(maxlen=RESOURCE_HISTORY)
+            continue
+        try:
+            with proc.oneshot():
+                cpu = proc.cpu_percent(None)
+                cpu_times = proc.cpu_times()
+                rss = proc.memory_info().rss
+                threads = proc.num_threads()
+                fds = proc.num_fds() if hasattr(proc, 'num_fds') else proc.num_handles()
+        except psutil.Error:
+            continue
+        resource_samples[key].append((now, cpu, rss, threads, fds))
+        note_script_rss(key, rss)
+        cpu_total = cpu_times.user + cpu_times.system
+        with meter_lock:
+            if pid not in resource_cpu_metered:
+                continue  # exited and charged meanwhile
+            cpu_delta = max(0.0, cpu_total - resource_cpu_metered[pid])
+            resource_cpu_metered[pid] = cpu_total
+        record_meter_sample(now, key.split(':', 1)[0], cpu_delta, rss)
+    
+    for key in list(resource_procs):
+        if key not in processes:
+            resource_procs.pop(key, None)
+            resource_samples.pop(key, None)
+            finish_script_rss(key)
+
+def charge_exit_cpu(uid, pid, cpu_total):
+    """Meter what a finished script used since its last sample; cpu_total None means unknown"""
+    with meter_lock:
+        metered = resource_cpu_metered.pop(pid, 0.0)
+    if cpu_total is not None and cpu_total > metered:
+        record_meter_sample(time.time(), uid, cpu_total - metered, 0)
+
+def resource_sampler_loop():
+    handler_context.name = 'resource_sampler'
+    while True:
+        try:
+            sample_resources()
+        except Exception as e:
+            logger.error(f"Error sampling script resources: {e}")
+        try:
+            # Meter files are shared with standbys; only the leader appends to them
+            if is_leader():
+                roll_up_meter(time.time())
+        except Exception as e:
+            logger.error(f"Error rolling up usage: {e}")
+        time.sleep(RESOURCE_SAMPLE_INTERVAL)
+
+def start_resource_sampler():
+    global sampler_thread
+    if sampler_thread is None:
+        sampler_thread = threading.Thread(target=resource_sampler_loop, name='resource_sampler', daemon=True)
+        sampler_thread.start()
+
+def sparkline(values):
+    if not values:
+        return ""
+    top = max(max(values), 1)
+    return "".join(SPARKLINE[min(len(SPARKLINE) - 1, int(v / top * len(SPARKLINE)))] for v in values)
+
+def format_top(keys, sort='cpu', limit=15, show_user=False):
+    """Render the latest samples of keys, busiest first"""
+    rows = []
+    for key in keys:
+        history = resource_samples.get(key)
+        if history:
+            rows.append((key, history))
+    index = 2 if sort == 'mem' else 1
+    rows.sort(key=lambda row: row[1][-1][index], reverse=True)
+    
+    result = []
+    for key, history in rows[:limit]:
+        uid, filename = key.split(':', 1)
+        _, cpu, rss, threads, fds = history[-1]
+        avg = sum(sample[1] for sample in history) / len(history)
+        uptime = format_time(time.time() - processes[key]['start']) if key in processes else "-"
+        owner = f" (user {uid})" if show_user else ""
+        result.append(f"• <code>{html_escape(filename)}</code>{owner}\n"
+                      f"  CPU {cpu:.1f}% (avg {avg:.1f}%) {sparkline([s[1] for s in list(history)[-12:]])}\n"
+                      f"  RSS {rss / 1024 / 1024:.1f} MB | Threads {threads} | FDs {fds} | Up {uptime}")
+    return result
+
+# Resource metering
+# Every resource sample also lands in a flat array ring as (time, user, CPU
+# seconds since the last sample, RSS). Once a minute the new ring entries are
+# summed per user into minute records; minutes add up into hours and hours
+# into days. Memory and disk are kept as byte-seconds so every level is a
+# plain sum. Each level is an append-only file of fixed-width records in
+# time order, so a query bisects to its start instead of reading the file.
+# Disk is walked every METER_DISK_INTERVAL and only charged at the hour level.
+METER_RAW_CAPACITY = 65536  # samples held between rollups
+METER_RAW_FIELDS = 4
+METER_DISK_INTERVAL = 300
+METER_RECORD = struct.Struct('<Iqfdd')  # bucket start, user, CPU seconds, memory byte-seconds, disk byte-seconds
+METER_LEVELS = {
+    # level: (bucket seconds, seconds of records kept or None)
+    'minute': (60, 86400),
+    'hour': (3600, 90 * 86400),
+    'day': (86400, None)
+}
+USAGE_PERIODS = {'day': (86400, 'hour'), 'week': (7 * 86400, 'hour'), 'month': (30 * 86400, 'hour'), 'year': (365 * 86400, 'day')}
+USAGE_SORT_KEYS = {'cpu': 0, 'mem': 1, 'disk': 2}
+
+meter_raw = array.array('d', bytes(8 * METER_RAW_CAPACITY * METER_RAW_FIELDS))
+meter_raw_written = 0  # samples ever written; slot is written % capacity
+meter_raw_read = 0
+meter_lock = threading.Lock()
+meter_pending = {}  # level -> {'start': bucket start, 'users': {uid: [cpu, mem, disk]}} not yet written to that level
+meter_disk = {}  # uid -> bytes at the last disk walk
+meter_recent = {}  # uid -> deque of (hour start, [cpu, mem, disk]) written in the last day, for /user
+meter_disk_checked = 0
+
+def record_meter_sample(now, uid, cpu_seconds, rss):
+    global meter_raw_written
+    with meter_lock:
+        base = (meter_raw_written % METER_RAW_CAPACITY) * METER_RAW_FIELDS
+        meter_raw[base:base + METER_RAW_FIELDS] = array.array('d', (now, float(uid), cpu_seconds, float(rss)))
+        meter_raw_written += 1
+
+def get_meter_path(level):
+    return os.path.join(METER_DIR, f"{level}.bin")
+
+def append_meter_records(level, start, users):
+    if not users:
+        return
+    os.makedirs(METER_DIR, exist_ok=True)
+    with open(get_meter_path(level), 'ab') as f:
+        f.write(b''.join(METER_RECORD.pack(int(start), int(uid), *totals) for uid, totals in users.items()))
+
+def read_meter_records(level, since):
+    """Yield (start, uid, cpu, mem, disk) records of level with start >= since"""
+    try:
+        f = open(get_meter_path(level), 'rb')
+    except FileNotFoundError:
+        return
+    with f:
+        count = os.fstat(f.fileno()).st_size // METER_RECORD.size  # ignores a record being appended
+        
+        def start_at(i):
+            f.seek(i * METER_RECORD.size)
+            return METER_RECORD.unpack(f.read(METER_RECORD.size))[0]
+        
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if start_at(mid) < since:
+                lo = mid + 1
+            else:
+                hi = mid
+        f.seek(lo * METER_RECORD.size)
+        yield from METER_RECORD.iter_unpack(f.read((count - lo) * METER_RECORD.size))
+
+def trim_meter_file(level, now):
+    """Drop records older than the level's retention"""
+    keep = METER_LEVELS[level][1]
+    if keep is None:
+        return
+    records = list(read_meter_records(level, now - keep))
+    tmp = get_meter_path(level) + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(b''.join(METER_RECORD.pack(*record) for record in records))
+    os.replace(tmp, get_meter_path(level))
+
+def add_usage(users, uid, cpu, mem, disk):
+    totals = users.setdefault(uid, [0.0, 0.0, 0.0])
+    totals[0] += cpu
+    totals[1] += mem
+    totals[2] += disk
+
+def restore_meter_pending(now):
+    """Rebuild the unflushed hour and day totals from the finer files after a restart"""
+    for level, finer in (('hour', 'minute'), ('day', 'hour')):
+        size = METER_LEVELS[level][0]
+        start = now // size * size
+        users = {}
+        for _, uid, cpu, mem, disk in read_meter_records(finer, start):
+            add_usage(users, uid, cpu, mem, disk)
+        meter_pending[level] = {'start': start, 'users': users}
+    meter_pending['minute'] = {'start': now // 60 * 60, 'users': {}}
+    for start, uid, cpu, mem, disk in read_meter_records('hour', now - 86400):
+        meter_recent.setdefault(uid, collections.deque()).append((start, [cpu, mem, disk]))
+
+def walk_user_disk():
+    usage = {}
+    if os.path.isdir(UPLOAD_DIR):
+        for name in os.listdir(UPLOAD_DIR):
+            if name.lstrip('-').isdigit():
+                usage[int(name)] = int(_get_storage_usage(name) * 1024 * 1024)
+    return usage
+
+def roll_up_meter(now):
+    """Fold new raw samples into the current minute and flush every level whose bucket has ended"""
+    global meter_raw_read, meter_disk, meter_disk_checked
+    if now - meter_disk_checked >= METER_DISK_INTERVAL:
+        meter_disk = walk_user_disk()
+        meter_disk_checked = now
+    
+    trim = False
+    with meter_lock:
+        if not meter_pending:
+            restore_meter_pending(now)
+        written = meter_raw_written
+        if written - meter_raw_read > METER_RAW_CAPACITY:
+            logger.error(f"Usage ring overflowed, {written - meter_raw_read - METER_RAW_CAPACITY} samples lost")
+            meter_raw_read = written - METER_RAW_CAPACITY
+        samples = [meter_raw[(i % METER_RAW_CAPACITY) * METER_RAW_FIELDS:(i % METER_RAW_CAPACITY + 1) * METER_RAW_FIELDS]
+                   for i in range(meter_raw_read, written)]
+        meter_raw_read = written
+        
+        minute = meter_pending['minute']
+        for _, uid, cpu, rss in samples:
+            add_usage(minute['users'], int(uid), cpu, rss * RESOURCE_SAMPLE_INTERVAL, 0.0)
+        
+        # Flushed under the lock so a reader never sees a bucket in both the file and memory, or in neither
+        levels = list(METER_LEVELS)
+        for i, level in enumerate(levels):
+            size = METER_LEVELS[level][0]
+            pending = meter_pending[level]
+            if now // size * size == pending['start']:
+                break
+            if level == 'hour':
+                for uid, disk in meter_disk.items():
+                    add_usage(pending['users'], uid, 0.0, 0.0, disk * size)
+            append_meter_records(level, pending['start'], pending['users'])
+            if level == 'hour':
+                for uid, totals in pending['users'].items():
+                    recent = meter_recent.setdefault(uid, collections.deque())
+                    recent.append((pending['start'], list(totals)))
+                    while recent[0][0] < now - 86400:
+                        recent.popleft()
+            if i + 1 < len(levels):
+                coarser = meter_pending[levels[i + 1]]['users']
+                for uid, totals in pending['users'].items():
+                    add_usage(coarser, uid, *totals)
+            meter_pending[level] = {'start': now // size * size, 'users': {}}
+            if level == 'day':
+                trim = True
+                for uid in [uid for uid, recent in meter_recent.items() if recent[-1][0] < now - 86400]:
+                    del meter_recent[uid]
+    
+    if trim:
+        for old in ('minute', 'hour'):
+            trim_meter_file(old, now)
+
+def get_usage(period, uid=None):
+    """{uid: [cpu seconds, memory byte-seconds, disk byte-seconds]} over the last period"""
+    seconds, level = USAGE_PERIODS[period]
+    since = time.time() - seconds
+    users = {}
+    finer = ['minute', 'hour', 'day'][:['minute', 'hour', 'day'].index(level)]
+    with meter_lock:
+        for _, user, cpu, mem, disk in read_meter_records(level, since):
+            if uid is None or user == uid:
+                add_usage(users, user, cpu, mem, disk)
+        # Buckets not yet written at this level
+        for pending_level in finer + [level]:
+            for user, totals in meter_pending.get(pending_level, {}).get('users', {}).items():
+                if uid is None or user == uid:
+                    add_usage(users, user, *totals)
+    return users
+
+def get_user_day_usage(uid):
+    """Usage of one user over the last day, from memory instead of the meter files"""
+    since = time.time() - 86400
+    totals = [0.0, 0.0, 0.0]
+    with meter_lock:
+        for start, hour in meter_recent.get(uid, ()):
+            if start >= since:
+                totals = [a + b for a, b in zip(totals, hour)]
+        for level in ('minute', 'hour'):
+            pending = meter_pending.get(level, {}).get('users', {}).get(uid)
+            if pending:
+                totals = [a + b for a, b in zip(totals, pending)]
+    return totals
+
+def get_hourly_cpu(uid, hours=24):
+    """CPU seconds of uid per hour, oldest first, for a sparkline"""
+    now = time.time()
+    first = (now // 3600 - hours + 1) * 3600
+    values = [0.0] * hours
+    with meter_lock:
+        for start, user, cpu, _, _ in read_meter_records('hour', first):
+            if user == uid:
+                values[int((start - first) // 3600)] += cpu
+        for level in ('minute', 'hour'):
+            values[-1] += meter_pending.get(level, {}).get('users', {}).get(uid, [0.0])[0]
+    return values
+
+def format_usage(totals):
+    cpu, mem, disk = totals
+    return (f"CPU {format_time(cpu)} | RAM {mem / 1024 ** 3 / 3600:.2f} GB·h | "
+            f"Disk {disk / 1024 ** 3 / 3600:.2f} GB·h")
+
+# Admission control
+# Local launches (/startfile, scheduled runs, the second instance of a
+# redeploy) only start if the host can hold them. Available memory, minus
+# the headroom admins reserve for the bot and minus what scripts admitted in
+# the last ADMISSION_SETTLE seconds are still expected to grow into, must
+# cover the script's estimate, and the load average per CPU must be under
+# ADMISSION_MAX_LOAD. The estimate is the peak RSS the resource sampler saw
+# in the script's last run (decaying by half at most per run, so one short
+# run doesn't undo it), or ADMISSION_DEFAULT_ESTIMATE before its first run.
+# A /startfile that doesn't fit waits in a FIFO queue that the admission
+# thread drains whenever a script exits, or every ADMISSION_RECHECK seconds.
+# One that couldn't fit even with nothing else running is refused.
+ADMISSION_DEFAULT_ESTIMATE = 64 * 1024 * 1024
+ADMISSION_DEFAULT_RESERVE = int(os.getenv("ADMISSION_RESERVE_MB", "256")) * 1024 * 1024
+ADMISSION_MAX_LOAD = float(os.getenv("ADMISSION_MAX_LOAD", "2.0"))  # 1-minute load average per CPU
+ADMISSION_ESTIMATE_DECAY = 0.5
+ADMISSION_SETTLE = 30
+ADMISSION_RECHECK = 5
+ADMISSION_QUEUE_MAX = 100
+ADMISSION_QUEUE_TIMEOUT = 1800
+
+admission = {'reserve': ADMISSION_DEFAULT_RESERVE, 'estimates': {}}  # persisted in ADMISSION_FILE
+admission_queue = collections.deque()  # {'key', 'uid', 'filename', 'project', 'chat_id', 'queued'}
+admission_recent = {}  # key -> (admitted at, estimate)
+admission_peaks = {}  # key -> peak RSS of the current run
+admission_lock = threading.Lock()
+admission_wake = threading.Event()
+admission_thread = None
+
+def format_mb(size):
+    return f"{size / 1024 / 1024:.0f} MB"
+
+def save_admission():
+    with admission_lock:
+        data = {'reserve': admission['reserve'], 'estimates': dict(admission['estimates'])}
+    try:
+        write_json_atomic(ADMISSION_FILE, data)
+    except Exception as e:
+        logger.error(f"Error saving admission state: {e}")
+
+def get_memory_estimate(key):
+    return admission['estimates'].get(key, ADMISSION_DEFAULT_ESTIMATE)
+
+def note_script_rss(key, rss):
+    """Track the peak RSS of the current run of key (called by the sampler)"""
+    if rss > admission_peaks.get(key, 0):
+        admission_peaks[key] = rss
+
+def finish_script_rss(key):
+    """Make the peak of a finished run the estimate for the next one"""
+    peak = admission_peaks.pop(key, None)
+    if not peak:
+        return
+    with admission_lock:
+        previous = admission['estimates'].get(key, 0)
+        admission['estimates'][key] = max(peak, int(previous * ADMISSION_ESTIMATE_DECAY))
+    save_admission()
+
+def reserved_memory(now):
+    """Memory recently admitted scripts are still expected to take; call with admission_lock held"""
+    total = 0
+    for key, (admitted, estimate) in list(admission_recent.items()):
+        if now - admitted > ADMISSION_SETTLE:
+            admission_recent.pop(key, None)
+            continue
+        history = resource_samples.get(key)
+        total += max(0, estimate - (history[-1][2] if history else 0))
+    return total
+
+def get_host_capacity(now=None):
+    """Return (total, available after reserves, bot RSS, load per CPU) for admission decisions"""
+    import psutil
+    now = now or time.time()
+    memory = psutil.virtual_memory()
+    bot_rss = psutil.Process().memory_info().rss
+    load = psutil.getloadavg()[0] / (psutil.cpu_count() or 1)
+    free = memory.available - admission['reserve'] - reserved_memory(now)
+    return memory.total, free, bot_rss, load
+
+def admit_script(key, queued=False):
+    """Decide on launching key locally: ('accept' | 'queue' | 'reject', reason).
+    
+    An accepted launch is counted as reserved memory until it has settled.
+    queued is True for the head of the queue, which new launches wait behind.
+    """
+    now = time.time()
+    estimate = get_memory_estimate(key)
+    with admission_lock:
+        total, free, bot_rss, load = get_host_capacity(now)
+        if estimate > total - admission['reserve'] - bot_rss:
+            decision, reason = 'reject', (f"it needs about {format_mb(estimate)} and this host can give at most "
+                                          f"{format_mb(max(0, total - admission['reserve'] - bot_rss))}")
+        elif admission_queue and not queued:
+            decision, reason = 'queue', f"launches queued ahead of it: {len(admission_queue)}"
+        elif free < estimate:
+            decision, reason = 'queue', f"it needs about {format_mb(estimate)} and {format_mb(max(0, free))} is free"
+        elif load > ADMISSION_MAX_LOAD:
+            decision, reason = 'queue', f"the host is busy (load {load:.1f} per CPU)"
+        else:
+            decision, reason = 'accept', None
+            admission_recent[key] = (now, estimate)
+    inc_metric('admission_decisions_total', decision)
+    return decision, reason
+
+def cancel_admission(key):
+    """Drop the memory reserved for key after its launch failed"""
+    with admission_lock:
+        admission_recent.pop(key, None)
+
+def queue_launch(uid, filename, project, chat_id):
+    """Queue a launch until there is capacity; returns its position, or None if the queue is full"""
+    with admission_lock:
+        if len(admission_queue) >= ADMISSION_QUEUE_MAX:
+            return None
+        admission_queue.append({'key': f"{uid}:{filename}", 'uid': uid, 'filename': filename,
+                                'project': project, 'chat_id': chat_id, 'queued': time.time()})
+        return len(admission_queue)
+
+def cancel_queued_launch(key):
+    with admission_lock:
+        for entry in admission_queue:
+            if entry['key'] == key:
+                admission_queue.remove(entry)
+                return True
+    return False
+
+def get_queued_count(uid):
+    prefix = f"{uid}:"
+    with admission_lock:
+        return sum(1 for entry in admission_queue if entry['key'].startswith(prefix))
+
+def is_queued(key):
+    with admission_lock:
+        return any(entry['key'] == key for entry in admission_queue)
+
+def notify_queued_launch(entry, text):
+    try:
+        bot.send_message(entry['chat_id'], text)
+    except Exception as e:
+        logger.error(f"Error notifying about queued launch {entry['key']}: {e}")
+
+def drain_admission_queue():
+    """Start queued launches in order for as long as the head fits"""
+    while True:
+        with admission_lock:
+            if not admission_queue:
+                return
+            entry = admission_queue[0]
+        key, filename = entry['key'], entry['filename']
+        waited = time.time() - entry['queued']
+        
+        if waited > ADMISSION_QUEUE_TIMEOUT:
+            decision, reason = 'reject', f"there was no room for it within {format_time(ADMISSION_QUEUE_TIMEOUT)}"
+        elif key in processes or key in cluster_scripts:
+            decision, reason = 'reject', "it is already running"
+        elif get_running_count(entry['uid']) >= get_limit(entry['uid']):
+            decision, reason = 'reject', f"your script limit ({get_limit(entry['uid'])}) is reached"
+        else:
+            decision, reason = admit_script(key, queued=True)
+            if decision == 'queue':
+                return
+        
+        with admission_lock:
+            if not admission_queue or admission_queue[0] is not entry:
+                if decision == 'accept':
+                    admission_recent.pop(key, None)  # lock already held, so not cancel_admission()
+                continue  # cancelled with /stopfile meanwhile
+            admission_queue.popleft()
+        
+        if decision == 'reject':
+            notify_queued_launch(entry, f"❌ Gave up starting queued <code>{html_escape(filename)}</code>: {reason}.")
+            continue
+        
+        observe_metric('admission_wait_seconds', value=waited)
+        error = launch_script(entry['uid'], filename, entry['project'])
+        if error:
+            cancel_admission(key)
+            notify_queued_launch(entry, f"❌ Could not start queued <code>{html_escape(filename)}</code>\n{html_escape(error)}")
+        else:
+            notify_queued_launch(entry, f"✅ Started queued script <code>{html_escape(filename)}</code> "
+                                        f"after {format_time(waited)}.\nStop it with /stopfile {filename}")
+
+def admission_loop():
+    handler_context.name = 'admission'
+    while True:
+        admission_wake.wait(ADMISSION_RECHECK)
+        admission_wake.clear()
+        try:
+            drain_admission_queue()
+        except Exception as e:
+            logger.error(f"Error draining the launch queue: {e}")
+
+def start_admission_controller():
+    global admission_thread
+    if admission_thread is None:
+        admission_thread = threading.Thread(target=admission_loop, name='admission', daemon=True)
+        admission_thread.start()
+
+def collect_admission_metrics():
+    set_metric('admission_queue_depth', value=len(admission_queue))
+
+metric_collectors.append(collect_admission_metrics)
+
+# Storage janitor
+# BACKUP_DIR, MEDIA_DIR and TEMP_DIR only ever grow on their own. A low
+# priority thread (nice 19, idle IO class) walks them every JANITOR_INTERVAL
+# in small batches and deletes files past their age, then the oldest files of
+# users over their share, then the oldest files of a directory over its size.
+# When free disk space drops under JANITOR_MIN_FREE, or a write fails with
+# ENOSPC, it runs at once and also evicts young files until space is back.
+# The caches (compiled scripts, extracted projects, project run directories
+# and log indexes) are keyed by what they were built from; an entry that no
+# stored script, project or log refers to any more is removed once it has
+# been unused for CACHE_UNUSED_AGE.
+JANITOR_INTERVAL = 600
+JANITOR_BATCH = 200  # files stat'ed before yielding
+JANITOR_PAUSE = 0.05
+JANITOR_MIN_FREE = 500 * 1024 * 1024
+STORAGE_RETENTION = {
+    # dir: (max age in seconds, max total bytes, max bytes per user or None); cheapest to lose first
+    TEMP_DIR: (3600, 200 * 1024 * 1024, None),
+    MEDIA_DIR: (24 * 3600, 500 * 1024 * 1024, None),
+    BACKUP_DIR: (7 * 24 * 3600, 2 * 1024 ** 3, 200 * 1024 * 1024)
+}
+BACKUP_USER_PATTERN = re.compile(r'^user_(-?\d+)_')
+CACHE_UNUSED_AGE = 24 * 3600  # must stay above SCRIPT_TIMEOUT: a running script may use an old project tree
+CACHE_DIRS = {
+    # dir: depth of the entries it holds (runs/ is <uid>/<project>)
+    PYCACHE_DIR: 1,
+    PROJECT_CACHE_DIR: 1,
+    RUNS_DIR: 2,
+    LOG_INDEX_DIR: 1
+}
+
+janitor_wake = threading.Event()
+janitor_thread = None
+janitor_reclaimed = {}  # dir name -> bytes reclaimed since start
+
+def note_disk_error(error):
+    """Wake the janitor early if error means the disk is full"""
+    if getattr(error, 'errno', None) in (errno.ENOSPC, errno.EDQUOT):
+        logger.error(f"Disk full: {error}")
+        janitor_wake.set()
+
+def get_free_space():
+    try:
+        return shutil.disk_usage(BASE_DIR).free
+    except OSError:
+        return None
+
+def scan_storage(path):
+    """Return [(mtime, size, path, owner)] for the files in path, yielding the CPU between batches"""
+    files = []
+    try:
+        entries = list(os.scandir(path))
+    except FileNotFoundError:
+        return files
+    for i, entry in enumerate(entries):
+        if i and i % JANITOR_BATCH == 0:
+            time.sleep(JANITOR_PAUSE)
+        try:
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            st = entry.stat(follow_symlinks=False)
+        except OSError:
+            continue
+        match = BACKUP_USER_PATTERN.match(entry.name)
+        files.append((st.st_mtime, st.st_size, entry.path, match.group(1) if match else None))
+    files.sort()
+    return files
+
+def select_expired(files, max_age, max_bytes, max_user_bytes, now, to_free=0):
+    """Pick files to delete under the retention rules, plus old files until to_free bytes are freed"""
+    doomed = set()
+    for mtime, size, path, owner in files:
+        if now - mtime > max_age:
+            doomed.add(path)
+    
+    if max_user_bytes:
+        per_user = {}
+        for mtime, size, path, owner in reversed(files):  # newest first: keep those
+            if owner is None or path in doomed:
+                continue
+            per_user[owner] = per_user.get(owner, 0) + size
+            if per_user[owner] > max_user_bytes:
+                doomed.add(path)
+    
+    total = sum(size for _, size, path, _ in files if path not in doomed)
+    freed = sum(size for _, size, path, _ in files if path in doomed)
+    for mtime, size, path, owner in files:
+        if total <= max_bytes and freed >= to_free:
+            break
+        if path not in doomed:
+            doomed.add(path)
+            total -= size
+            freed += size
+    return [(size, path) for _, size, path, _ in files if path in doomed]
+
+def run_janitor(to_free=0):
+    """One pass over the managed directories, returning bytes reclaimed"""
+    reclaimed_total = 0
+    now = time.time()
+    for path, (max_age, max_bytes, max_user_bytes) in STORAGE_RETENTION.items():
+        name = os.path.basename(path)
+        files = scan_storage(path)
+        reclaimed = 0
+        removed = 0
+        expired = select_expired(files, max_age, max_bytes, max_user_bytes, now, max(0, to_free - reclaimed_total))
+        for i, (size, file_path) in enumerate(expired):
+            if i and i % JANITOR_BATCH == 0:
+                time.sleep(JANITOR_PAUSE)
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                logger.error(f"Error removing {file_path}: {e}")
+                continue
+            reclaimed += size
+            removed += 1
+        if removed:
+            inc_metric('storage_reclaimed_bytes_total', name, value=reclaimed)
+            inc_metric('storage_files_removed_total', name, value=removed)
+            janitor_reclaimed[name] = janitor_reclaimed.get(name, 0) + reclaimed
+            logger.info(f"🧹 Removed {removed} files ({reclaimed / 1024 / 1024:.1f} MB) from {name}")
+        set_metric('storage_dir_bytes', name, value=sum(f[1] for f in files) - reclaimed)
+        reclaimed_total += reclaimed
+    
+    try:
+        reclaimed_total += evict_caches(now)
+    except Exception as e:
+        logger.error(f"Error evicting caches: {e}")
+    return reclaimed_total
+
+def find_cache_references():
+    """Return {cache dir: entry names still referred to by stored scripts, projects and logs}"""
+    references = {path: set() for path in CACHE_DIRS}
+    user_ids = os.listdir(UPLOAD_DIR) if os.path.isdir(UPLOAD_DIR) else []
+    for user_id in user_ids:
+        user_dir = get_user_dir(user_id)
+        if not os.path.isdir(user_dir):
+            continue
+        for i, name in enumerate(os.listdir(user_dir)):
+            if i and i % JANITOR_BATCH == 0:
+                time.sleep(JANITOR_PAUSE)
+            if name.endswith('.py'):
+                try:
+                    with open(os.path.join(user_dir, name), 'rb') as f:
+                        digest = script_digest(f.read())
+                except OSError:
+                    continue
+                references[PYCACHE_DIR].add(os.path.basename(get_bytecode_path(digest)))
+            elif name.endswith(PROJECT_SUFFIX):
+                # The run directory holds the project's own files, so keep it
+                # even if the record can't be read right now
+                references[RUNS_DIR].add(os.path.join(user_id, name[:-len(PROJECT_SUFFIX)]))
+                project = get_project(user_id, name[:-len(PROJECT_SUFFIX)])
+                if project:
+                    references[PROJECT_CACHE_DIR].add(project['digest'])
+    
+    log_names = os.listdir(LOGS_DIR) if os.path.isdir(LOGS_DIR) else []
+    references[LOG_INDEX_DIR] = {os.path.basename(get_log_index_path(n)) for n in log_names}
+    return references
+
+def list_cache_entries(path, depth):
+    """Return [(name relative to path, full path)] for the entries depth levels below path"""
+    entries = [('', path)]
+    for _ in range(depth):
+        below = []
+        for name, entry_path in entries:
+            if not os.path.isdir(entry_path) or os.path.islink(entry_path):
+                continue
+            for entry in os.scandir(entry_path):
+                below.append((os.path.join(name, entry.name), entry.path))
+        entries = below
+    return entries
+
+def get_path_size(path):
+    if os.path.islink(path) or not os.path.isdir(path):
+        return os.lstat(path).st_size
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for f in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, f)).st_size
+            except OSError:
+                pass
+    return total
+
+def evict_caches(now):
+    """Remove cache entries nothing refers to that have been unused for CACHE_UNUSED_AGE, returning bytes reclaimed"""
+    references = find_cache_references()
+    reclaimed_total = 0
+    for path, depth in CACHE_DIRS.items():
+        name = os.path.basename(path)
+        reclaimed = 0
+        removed = 0
+        for i, (entry, entry_path) in enumerate(list_cache_entries(path, depth)):
+            if i and i % JANITOR_BATCH == 0:
+                time.sleep(JANITOR_PAUSE)
+            if entry in references[path]:
+                continue
+            try:
+                if now - os.lstat(entry_path).st_mtime <= CACHE_UNUSED_AGE:
+                    continue
+                size = get_path_size(entry_path)
+                if os.path.isdir(entry_path) and not os.path.islink(entry_path):
+                    remove_tree(entry_path)
+                else:
+                    os.remove(entry_path)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                logger.error(f"Error removing {entry_path}: {e}")
+                continue
+            reclaimed += size
+            removed += 1
+        
+        # Drop the per-user directories of runs/ once they are empty
+        for _, parent_path in list_cache_entries(path, depth - 1) if depth > 1 else []:
+            try:
+                if now - os.lstat(parent_path).st_mtime > CACHE_UNUSED_AGE:
+                    os.rmdir(parent_path)
+            except OSError:
+                pass
+        
+        if removed:
+            inc_metric('storage_reclaimed_bytes_total', name, value=reclaimed)
+            inc_metric('storage_files_removed_total', name, value=removed)
+            janitor_reclaimed[name] = janitor_reclaimed.get(name, 0) + reclaimed
+            logger.info(f"🧹 Removed {removed} unused entries ({reclaimed / 1024 / 1024:.1f} MB) from {name}")
+        reclaimed_total += reclaimed
+    return reclaimed_total
+
+def lower_thread_priority():
+    """Make the calling thread nice 19 with idle IO priority, where the OS allows it"""
+    tid = threading.get_native_id()
+    try:
+        os.setpriority(os.PRIO_PROCESS, tid, 19)  # on Linux this applies to the thread only
+    except (AttributeError, OSError):
+        pass
+    try:
+        import psutil
+        psutil.Process(tid).ionice(psutil.IOPRIO_CLASS_IDLE)
+    except Exception:
+        pass
+
+def janitor_loop():
+    handler_context.name = 'janitor'
+    lower_thread_priority()
+    while True:
+        free = get_free_space()
+        try:
+            run_janitor(JANITOR_MIN_FREE - free if free is not None and free < JANITOR_MIN_FREE else 0)
+        except Exception as e:
+            logger.error(f"Error in storage janitor: {e}")
+        janitor_wake.wait(JANITOR_INTERVAL)
+        janitor_wake.clear()
+
+def start_janitor():
+    global janitor_thread
+    if janitor_thread is None:
+        janitor_thread = threading.Thread(target=janitor_loop, name='janitor', daemon=True)
+        janitor_thread.start()
+
+# Log search
+# Logs are cut into line-aligned LOG_SEGMENT_SIZE segments (a longer line
+# makes a longer segment), each summarised by a bloom filter of its
+# lowercased byte trigrams. A search ANDs the pattern's trigram mask against
+# every filter (one big-int operation per segment) and only reads the
+# segments that may match, plus the unindexed tail of each log. The indexer thread appends new segments as logs grow; the filters are
+# also appended to a sidecar file in LOG_INDEX_DIR so restarts don't rebuild.
+# Only the leader indexes: a standby appending to the same sidecars would
+# interleave records and corrupt them.
+LOG_SEGMENT_SIZE = 256 * 1024
+LOG_BLOOM_BITS_LOG2 = 17  # 16KB filter per 256KB segment, ~2% false positives per trigram
+LOG_BLOOM_HASHES = (0x9E3779B1, 0x85EBCA77, 0xC2B2AE3D, 0x27D4EB2F)
+LOG_INDEX_INTERVAL = 10
+LOG_INDEX_HEADER = struct.Struct('<Q')  # inode of the indexed log
+LOG_INDEX_RECORD = struct.Struct('<QQ')  # segment start, end; followed by the filter
+SEARCH_PAGE_SIZE = 10
+SEARCH_CONTEXT = 1  # lines shown around each match
+SEARCH_MAX_SESSIONS = 200
+SEARCH_READ_CHUNK = 1024 * 1024  # a range is read in pieces this big, never whole
+
+log_indexes = {}  # log path -> {'ino', 'offset', 'segments': [(start, end, filter as int)]}
+log_index_lock = threading.Lock()
+log_searches = collections.OrderedDict()  # token -> paging state of a search
+log_indexer_thread = None
+
+def trigram_bits(trigram):
+    value = int.from_bytes(trigram, 'little')
+    return [((value * multiplier) & 0xFFFFFFFF) >> (32 - LOG_BLOOM_BITS_LOG2) for multiplier in LOG_BLOOM_HASHES]
+
+def build_log_filter(data):
+    bits = bytearray(1 << (LOG_BLOOM_BITS_LOG2 - 3))
+    data = data.lower()
+    for trigram in {data[i:i + 3] for i in range(len(data) - 2)}:
+        for pos in trigram_bits(trigram):
+            bits[pos >> 3] |= 1 << (pos & 7)
+    return bytes(bits)
+
+def get_search_mask(needle):
+    """Filter bits a segment must have to contain needle; 0 if needle is too short to use the index"""
+    mask = 0
+    for i in range(len(needle) - 2):
+        for pos in trigram_bits(needle[i:i + 3]):
+            mask |= 1 << pos
+    return mask
+
+def get_log_index_path(path):
+    return os.path.join(LOG_INDEX_DIR, os.path.basename(path) + '.idx')
+
+def reset_log_index(path):
+    """Forget the index of a log that is being truncated or deleted"""
+    with log_index_lock:
+        log_indexes.pop(path, None)
+        try:
+            os.remove(get_log_index_path(path))
+        except OSError:
+            pass
+
+def load_log_index(path, st):
+    """Read a log's sidecar index, or start a fresh one if it belongs to another file"""
+    index = {'ino': st.st_ino, 'offset': 0, 'segments': []}
+    record_size = LOG_INDEX_RECORD.size + (1 << (LOG_BLOOM_BITS_LOG2 - 3))
+    try:
+        with open(get_log_index_path(path), 'rb') as f:
+            header = f.read(LOG_INDEX_HEADER.size)
+            if len(header) == LOG_INDEX_HEADER.size and LOG_INDEX_HEADER.unpack(header)[0] == st.st_ino:
+                while True:
+                    record = f.read(record_size)
+                    if len(record) < record_size:
+                        break
+                    start, end = LOG_INDEX_RECORD.unpack_from(record)
+                    if end > st.st_size or start != index['offset']:
+                        break  # the log was rewritten; drop the rest
+                    index['segments'].append((start, end, int.from_bytes(record[LOG_INDEX_RECORD.size:], 'little')))
+                    index['offset'] = end
+                return index
+    except OSError:
+        pass
     
+    os.makedirs(LOG_INDEX_DIR, exist_ok=True)
+    with open(get_log_index_path(path), 'wb') as f:
+        f.write(LOG_INDEX_HEADER.pack(st.st_ino))
+    return index
+
+def index_log(path):
+    """Index the complete segments appended to a log since the last pass"""
     try:
-        if os.path.exists(BROADCAST_HISTORY_FILE):
-            with open(BROADCAST_HISTORY_FILE, 'r') as f:
-                broadcast_history = json.load(f)
-    except Exception as e:
-        logger.error(f"Error loading broadcast history: {e}")
-        broadcast_history = []
+        st = os.stat(path)
+    except FileNotFoundError:
+        reset_log_index(path)
+        return
     
-    try:
-        if os.path.exists(MODULES_FILE):
-            with open(MODULES_FILE, 'r') as f:
-                installed_modules = json.load(f)
-    except Exception as e:
-        logger.error(f"Error loading modules: {e}")
-        installed_modules = {}
+    index = log_indexes.get(path)
+    if index is None or index['ino'] != st.st_ino or st.st_size < index['offset']:
+        index = load_log_index(path, st)
+    
+    records = []
+    segments = []
+    pos = index['offset']
+    with open(path, 'rb') as f:
+        while st.st_size - pos >= LOG_SEGMENT_SIZE:
+            f.seek(pos)
+            chunk = bytearray(f.read(LOG_SEGMENT_SIZE))
+            cut = chunk.rfind(b'\n') + 1
+            while not cut:
+                # A line longer than a segment: run on to its end, since a
+                # match split across two filters would be in neither
+                more = f.read(LOG_SEGMENT_SIZE)
+                if not more:
+                    break
+                newline = more.find(b'\n')
+                if newline >= 0:
+                    cut = len(chunk) + newline + 1
+                chunk += more
+            if not cut:
+                break  # the line isn't finished yet; searches scan it as part of the tail
+            bloom = build_log_filter(bytes(chunk[:cut]))
+            records.append(LOG_INDEX_RECORD.pack(pos, pos + cut) + bloom)
+            segments.append((pos, pos + cut, int.from_bytes(bloom, 'little')))
+            pos += cut
+            time.sleep(0)  # let handler threads run between segments
+    
+    if records:
+        with open(get_log_index_path(path), 'ab') as f:
+            f.write(b''.join(records))
+    with log_index_lock:
+        index['segments'] = index['segments'] + segments
+        index['offset'] = pos
+        log_indexes[path] = index
 
-def save_data():
+def log_indexer_loop():
+    handler_context.name = 'log_indexer'
+    lower_thread_priority()
+    while True:
+        if is_leader():
+            try:
+                names = [n for n in os.listdir(LOGS_DIR) if n.endswith('.log')] if os.path.isdir(LOGS_DIR) else []
+                for name in names:
+                    index_log(os.path.join(LOGS_DIR, name))
+                for path in set(log_indexes) - {os.path.join(LOGS_DIR, n) for n in names}:
+                    reset_log_index(path)
+            except Exception as e:
+                logger.error(f"Error indexing logs: {e}")
+        time.sleep(LOG_INDEX_INTERVAL)
+
+def start_log_indexer():
+    global log_indexer_thread
+    if log_indexer_thread is None:
+        log_indexer_thread = threading.Thread(target=log_indexer_loop, name='log_indexer', daemon=True)
+        log_indexer_thread.start()
+
+def get_candidate_ranges(path, mask):
+    """Byte ranges of a log that may contain the pattern: matching segments, then the unindexed tail"""
+    with log_index_lock:
+        index = log_indexes.get(path)
+        segments = list(index['segments']) if index else []
+        offset = index['offset'] if index else 0
+    ranges = [(start, end) for start, end, bloom in segments if bloom & mask == mask]
     try:
-        with open(LIMITS_FILE, 'w') as f:
-            json.dump(user_limits, f)
-    except Exception as e:
-        logger.error(f"Error saving limits: {e}")
+        size = os.path.getsize(path)
+    except OSError:
+        return [], len(segments)
+    if size > offset:
+        ranges.append((offset, size))
+    return ranges, len(segments)
+
+def search_logs(paths, pattern, cursor=(0, 0), limit=SEARCH_PAGE_SIZE):
+    """Find lines containing pattern (case-insensitive) from cursor on.
     
-    try:
-        with open(USERS_FILE, 'w') as f:
-            json.dump(list(known_users), f)
-    except Exception as e:
-        logger.error(f"Error saving users: {e}")
+    Returns (matches, next cursor or None, stats) where each match is
+    (path, byte offset, context lines) and cursor is (path index, offset).
+    Stops as soon as limit matches have their context; the cursor is then
+    the line after the last match.
+    """
+    needle = pattern.encode('utf-8').lower()
+    mask = get_search_mask(needle)
+    matches = []
+    stats = {'segments': 0, 'scanned': 0}
     
-    try:
-        with open(BROADCAST_HISTORY_FILE, 'w') as f:
-            json.dump(broadcast_history, f)
-    except Exception as e:
-        logger.error(f"Error saving broadcast history: {e}")
+    def result(next_cursor):
+        return [(path, offset, [c.decode('utf-8', 'replace') for c in context])
+                for path, offset, context in matches], next_cursor, stats
     
-    try:
-        with open(MODULES_FILE, 'w') as f:
-            json.dump(installed_modules, f)
-    except Exception as e:
-        logger.error(f"Error saving modules: {e}")
+    for path_index in range(cursor[0], len(paths)):
+        path = paths[path_index]
+        resume = cursor[1] if path_index == cursor[0] else 0
+        ranges, total = get_candidate_ranges(path, mask)
+        stats['segments'] += total
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            continue
+        with f:
+            for start, end in ranges:
+                if end <= resume:
+                    continue
+                stats['scanned'] += 1
+                before = collections.deque(maxlen=SEARCH_CONTEXT)
+                pending = []  # [context, lines of context still to come] of recent matches
+                # resume is always a line start, so a range can be entered there
+                for line_start, line in iter_range_lines(f, max(start, resume), end):
+                    for entry in pending:
+                        entry[0].append(line)
+                        entry[1] -= 1
+                    pending = [entry for entry in pending if entry[1] > 0]
+                    if len(matches) == limit and not pending:
+                        return result((path_index, line_start))
+                    if len(matches) < limit and needle in line.lower():
+                        context = list(before) + [line]
+                        matches.append((path, line_start, context))
+                        if SEARCH_CONTEXT:
+                            pending.append([context, SEARCH_CONTEXT])
+                    before.append(line)
+                if len(matches) == limit:
+                    return result((path_index, end))
+    return result(None)
 
-load_data()
+def iter_range_lines(f, start, end, chunk_size=SEARCH_READ_CHUNK):
+    """Yield (offset, line) for the lines of f between start and end, reading chunk_size bytes at a time"""
+    f.seek(start)
+    pos = line_start = start
+    carry = b''
+    while pos < end:
+        chunk = f.read(min(chunk_size, end - pos))
+        if not chunk:
+            break
+        pos += len(chunk)
+        lines = (carry + chunk).split(b'\n')
+        carry = lines.pop()
+        for line in lines:
+            yield line_start, line
+            line_start += len(line) + 1
+    if carry:
+        yield line_start, carry
 
-# Utility functions
-def get_user_dir(user_id):
-    return os.path.join(UPLOAD_DIR, str(user_id))
+def start_log_search(user_id, paths, pattern):
+    """Register a search for paging and return its token"""
+    token = format(random.getrandbits(32), '08x')
+    log_searches[token] = {'uid': user_id, 'paths': paths, 'pattern': pattern, 'cursor': (0, 0)}
+    while len(log_searches) > SEARCH_MAX_SESSIONS:
+        log_searches.popitem(last=False)
+    return token
 
-def ensure_user_dir(user_id):
-    path = get_user_dir(user_id)
-    os.makedirs(path, exist_ok=True)
-    return path
+def render_log_search(token):
+    """Run the next page of a registered search, returning (text, markup)"""
+    search = log_searches.get(token)
+    if not search:
+        return "⌛ This search has expired. Run /searchlog again.", None
+    
+    started = time.perf_counter()
+    first_page = search['cursor'] == (0, 0)
+    matches, cursor, stats = search_logs(search['paths'], search['pattern'], search['cursor'])
+    elapsed = (time.perf_counter() - started) * 1000
+    search['cursor'] = cursor
+    
+    if not matches:
+        return f"🔍 No {'' if first_page else 'more '}matches for <code>{html_escape(search['pattern'])}</code>", None
+    
+    lines = [f"<b>🔍 Matches for</b> <code>{html_escape(search['pattern'])}</code>"]
+    for path, offset, context in matches:
+        name = os.path.basename(path)[:-len('.log')]
+        if search['uid'] not in ADMIN_IDS:
+            name = name.split('_', 1)[1]
+        snippet = "\n".join(line[:300] for line in context)
+        lines.append(f"\n📄 {html_escape(name)} @{offset}\n<code>{html_escape(snippet)}</code>")
+    lines.append(f"\n<i>{elapsed:.0f} ms, read {stats['scanned']} of {stats['segments']} indexed segments plus unindexed tails</i>")
+    
+    markup = None
+    if cursor:
+        markup = types.InlineKeyboardMarkup()
+        markup.add(types.InlineKeyboardButton("➡️ More", callback_data=f"searchlog:{token}"))
+    return "\n".join(lines), markup
 
-def get_limit(user_id):
-    return user_limits.get(str(user_id), 2)
+# Live output
+# /attach forwards what a running script prints to its owner's chat. One
+# thread tails every attached log each ATTACH_POLL_INTERVAL and buffers new
+# lines; each chat then gets at most one API call per ATTACH_EDIT_INTERVAL,
+# which edits the current page message with everything buffered (or starts
+# a new page once it is full). A chatty script can't build a backlog: at
+# most ATTACH_READ_MAX bytes are read per poll and ATTACH_BUFFER_LINES
+# buffered, and whatever is passed over is summarised as a skipped count.
+ATTACH_POLL_INTERVAL = 1
+ATTACH_EDIT_INTERVAL = 3
+ATTACH_PAGE_CHARS = 3500
+ATTACH_BUFFER_LINES = 200
+ATTACH_READ_MAX = 64 * 1024
+ATTACH_LINE_CHARS = 300
+ATTACH_MAX_PER_USER = 3
 
-def get_running_count(user_id):
-    return sum(1 for k in processes if k.startswith(f"{user_id}:"))
+attachments = {}  # "uid:filename" -> tail state and the page message being edited
+attach_lock = threading.Lock()
+attach_last_call = {}  # chat id -> monotonic time of the last API call for it
+attach_thread = None
 
-def get_uploaded_count(user_id):
-    path = get_user_dir(user_id)
-    if not os.path.exists(path):
-        return 0
-    return len([f for f in os.listdir(path) if f.endswith('.py')])
+def attach_script(chat_id, key):
+    """Start forwarding new output of a running script to chat_id"""
+    global attach_thread
+    uid, filename = key.split(':', 1)
+    path = os.path.join(LOGS_DIR, f"{uid}_{filename}.log")
+    try:
+        st = os.stat(path)
+    except OSError:
+        st = None
+    
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("⏏️ Detach", callback_data=f"detach:{filename}"))
+    header = f"<b>📟 {html_escape(filename)}</b>"
+    msg = bot.send_message(chat_id, f"{header}\n<i>Attached. New output will appear here.</i>", reply_markup=markup)
+    with attach_lock:
+        attachments[key] = {
+            'chat': chat_id,
+            'path': path,
+            'ino': st.st_ino if st else None,
+            'offset': st.st_size if st else 0,
+            'partial': b'',
+            'lines': collections.deque(),
+            'skipped': 0,  # lines dropped from the buffer
+            'skipped_bytes': 0,  # output never read
+            'header': header,
+            'markup': markup,
+            'page': "",
+            'message_id': msg.message_id,
+            'flushed': 0.0
+        }
+        if attach_thread is None:
+            attach_thread = threading.Thread(target=attach_loop, name='attach', daemon=True)
+            attach_thread.start()
 
-def get_storage_usage(user_id):
-    user_dir = get_user_dir(user_id)
-    if not os.path.exists(user_dir):
-        return 0
-    total_size = 0
-    for dirpath, _, filenames in os.walk(user_dir):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            total_size += os.path.getsize(fp)
-    return total_size / (1024 * 1024)  # MB
+def detach_script(key):
+    with attach_lock:
+        return attachments.pop(key, None) is not None
 
-def get_server_stats():
-    try:
-        cpu = psutil.cpu_percent(interval=1)
-        memory = psutil.virtual_memory().percent
-        disk = psutil.disk_usage('/').percent
-        uptime = str(datetime.timedelta(seconds=time.time() - start_time))
-        return cpu, memory, disk, uptime
-    except Exception as e:
-        logger.error(f"Error getting server stats: {e}")
-        return 0, 0, 0, "Unknown"
+def buffer_line(att, line):
+    if len(att['lines']) >= ATTACH_BUFFER_LINES:
+        att['lines'].popleft()
+        att['skipped'] += 1
+    att['lines'].append(line.decode('utf-8', 'replace')[:ATTACH_LINE_CHARS])
 
-def create_image_with_text(text, filename="broadcast_image.jpg"):
-    """Create an image with text for broadcast messages"""
+def read_attached_output(att):
+    """Buffer the lines appended to an attached log since the last poll"""
     try:
-        img = Image.new('RGB', (800, 600), color=(29, 29, 29))  # Dark background
-        d = ImageDraw.Draw(img)
-        try:
-            font = ImageFont.truetype("arial.ttf", 24)
-        except:
-            font = ImageFont.load_default()
-        
-        lines = textwrap.wrap(text, width=40)
-        y_text = 50
-        for line in lines:
-            width, height = font.getsize(line)
-            d.text(((800 - width) / 2, y_text), line, font=font, fill=(255, 255, 255))
-            y_text += height + 10
-        
-        watermark = "ULTIMINE Hosting"
-        d.text((20, 570), watermark, font=font, fill=(200, 200, 200))
-        
-        img_path = os.path.join(MEDIA_DIR, filename)
-        img.save(img_path)
-        return img_path
-    except Exception as e:
-        logger.error(f"Error creating image: {e}")
-        return None
+        st = os.stat(att['path'])
+    except OSError:
+        return
+    if st.st_ino != att['ino'] or st.st_size < att['offset']:
+        att['ino'], att['offset'], att['partial'] = st.st_ino, 0, b''  # the script was restarted
+        buffer_line(att, "🔄 log restarted".encode())
+    
+    pending = st.st_size - att['offset']
+    if pending <= 0:
+        return
+    if pending > ATTACH_READ_MAX:
+        att['skipped_bytes'] += pending - ATTACH_READ_MAX
+        att['offset'] = st.st_size - ATTACH_READ_MAX
+        att['partial'] = None  # resume at the next full line
+    
+    with open(att['path'], 'rb') as f:
+        f.seek(att['offset'])
+        data = f.read(ATTACH_READ_MAX)
+    att['offset'] += len(data)
+    
+    if att['partial'] is None:
+        cut = data.find(b'\n') + 1
+        data = data[cut:] if cut else b''
+        att['partial'] = b''
+    lines = (att['partial'] + data).split(b'\n')
+    att['partial'] = lines.pop()[-ATTACH_READ_MAX:]
+    for line in lines:
+        buffer_line(att, line.rstrip(b'\r'))
 
-def create_qr_code(data, filename="qrcode.png"):
-    try:
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(data)
-        qr.make(fit=True)
-        img = qr.make_image(fill_color="black", back_color="white")
-        img_path = os.path.join(TEMP_DIR, filename)
-        img.save(img_path)
-        return img_path
-    except Exception as e:
-        logger.error(f"Error creating QR code: {e}")
-        return None
+def take_attached_output(att, room):
+    """Pop buffered output as escaped text of at most room characters, newest lines kept"""
+    notes = []
+    if att['skipped_bytes']:
+        notes.append(f"… {att['skipped_bytes'] / 1024:.0f} KB of output skipped")
+    if att['skipped']:
+        notes.append(f"… {att['skipped']} lines skipped")
+    att['skipped'] = att['skipped_bytes'] = 0
+    
+    lines = [html_escape(line) for line in att['lines']]
+    att['lines'].clear()
+    kept = []
+    size = sum(len(note) + 1 for note in notes)
+    for line in reversed(lines):
+        if size + len(line) + 1 > room:
+            notes.append(f"… {len(lines) - len(kept)} lines skipped")
+            break
+        kept.append(line)
+        size += len(line) + 1
+    return "\n".join(notes + kept[::-1])
 
-def backup_user_data(user_id):
-    try:
-        user_dir = get_user_dir(user_id)
-        if not os.path.exists(user_dir) or not os.listdir(user_dir):
-            return None
+def flush_attachment(att):
+    """Edit the page with the buffered output, or start a new page when it is full"""
+    text = take_attached_output(att, ATTACH_PAGE_CHARS)
+    if att['page'] and len(att['page']) + len(text) + 1 <= ATTACH_PAGE_CHARS:
+        att['page'] += "\n" + text
+        bot.edit_message_text(f"{att['header']}\n<pre>{att['page']}</pre>", att['chat'], att['message_id'],
+                              reply_markup=att['markup'])
+    elif att['page'] or not att['message_id']:
+        att['page'] = text
+        att['message_id'] = bot.send_message(att['chat'], f"{att['header']}\n<pre>{text}</pre>",
+                                             reply_markup=att['markup']).message_id
+    else:
+        att['page'] = text  # first output replaces the "Attached" note
+        bot.edit_message_text(f"{att['header']}\n<pre>{text}</pre>", att['chat'], att['message_id'],
+                              reply_markup=att['markup'])
+
+def attach_loop():
+    handler_context.name = 'attach'
+    while True:
+        time.sleep(ATTACH_POLL_INTERVAL)
+        with attach_lock:
+            current = list(attachments.items())
         
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        backup_name = f"user_{user_id}_{timestamp}.zip"
-        backup_path = os.path.join(BACKUP_DIR, backup_name)
+        due = {}  # chat -> attachment with output waiting longest
+        for key, att in current:
+            try:
+                read_attached_output(att)
+                if key not in processes:
+                    detach_script(key)
+                    if att['lines'] or att['skipped'] or att['skipped_bytes']:
+                        flush_attachment(att)
+                    bot.send_message(att['chat'], f"⏹ {att['header']} stopped, detached.")
+                    continue
+            except Exception as e:
+                logger.error(f"Error reading attached output of {key}: {e}")
+                continue
+            if att['lines'] or att['skipped'] or att['skipped_bytes']:
+                if att['chat'] not in due or att['flushed'] < due[att['chat']]['flushed']:
+                    due[att['chat']] = att
         
-        shutil.make_archive(backup_path.replace('.zip', ''), 'zip', user_dir)
-        return backup_path
-    except Exception as e:
-        logger.error(f"Error creating backup: {e}")
-        return None
+        now = time.monotonic()
+        for chat, att in due.items():
+            if now - attach_last_call.get(chat, 0) < ATTACH_EDIT_INTERVAL:
+                continue
+            attach_last_call[chat] = att['flushed'] = now
+            try:
+                flush_attachment(att)
+            except Exception as e:
+                logger.error(f"Error forwarding output to {chat}: {e}")
 
-def format_time(seconds):
-    return str(datetime.timedelta(seconds=int(seconds)))
+# Failover
+# With HA_ENABLED=1 several bot processes can share one DATA_DIR. Only the
+# holder of the lease row in LEASE_FILE polls Telegram; the others stay warm by
+# reloading changed state files and take over once the lease expires.
+HA_ENABLED = os.getenv("HA_ENABLED", "0") == "1"
+LEASE_TTL = 6
+LEASE_RENEW_INTERVAL = 2
+LEASE_RETRY_INTERVAL = 1
+lease_held = False
 
-def sanitize_filename(filename):
-    """Sanitize filename to prevent directory traversal"""
-    if not filename:
+def is_leader():
+    """True if this process does the writing: it holds the lease, or HA is off"""
+    return not HA_ENABLED or lease_held
+
+def acquire_lease(holder):
+    """Take or renew the leader lease.
+    
+    Returns the new expiry time if this process holds it, False if another
+    process does and None if the lease couldn't be read (e.g. locked).
+    """
+    import sqlite3
+    now = time.time()
+    try:
+        conn = sqlite3.connect(LEASE_FILE, timeout=LEASE_RENEW_INTERVAL, isolation_level=None)
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS lease (id INTEGER PRIMARY KEY CHECK (id = 1), holder TEXT, expires REAL)")
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT holder, expires FROM lease WHERE id = 1").fetchone()
+            if row and row[0] != holder and row[1] > now:
+                conn.execute("ROLLBACK")
+                return False
+            conn.execute("INSERT OR REPLACE INTO lease (id, holder, expires) VALUES (1, ?, ?)", (holder, now + LEASE_TTL))
+            conn.execute("COMMIT")
+            return now + LEASE_TTL
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logger.error(f"Error acquiring leader lease: {e}")
         return None
-    filename = os.path.basename(filename)
-    if not filename.endswith('.py'):
-        filename += '.py'
-    return filename
+
+def run_with_failover():
+    global lease_held
+    holder = f"{socket.gethostname()}:{os.getpid()}"
+    logger.info(f"🕒 Standing by for the leader lease as {holder}")
+    expires = acquire_lease(holder)
+    while not expires:
+        load_data(only_changed=True)
+        time.sleep(LEASE_RETRY_INTERVAL)
+        expires = acquire_lease(holder)
+    
+    lease_held = True
+    load_data(only_changed=True)
+    adopted = adopt_running_scripts()
+    logger.info(f"👑 Became leader, adopted {adopted} running scripts")
+    start_scheduler()
+    resume_broadcast_actions()
+    
+    threading.Thread(target=bot.infinity_polling, kwargs={'long_polling_timeout': LEASE_TTL},
+                     name='polling', daemon=True).start()
+    while True:
+        time.sleep(LEASE_RENEW_INTERVAL)
+        renewed = acquire_lease(holder)
+        if renewed:
+            expires = renewed
+        elif renewed is False:
+            break
+        elif time.time() + LEASE_RENEW_INTERVAL >= expires:
+            # Can't reach the lease (e.g. a standby holds the lock) and it may
+            # run out before the next try; a standby could take over then
+            break
+    
+    # Someone else holds (or may soon take) the lease; stop polling at once so
+    # two processes never call getUpdates together. Scripts keep running for
+    # the new leader.
+    logger.error("Lost the leader lease, exiting")
+    bot.stop_polling()
+    os._exit(1)
 
 def install_module(module_name, user_id):
     """Install a Python module"""
     try:
+        # Anything but a package spec would be read by pip as an option or URL
+        if not REQUIREMENT_RE.match(module_name):
+            return False, f"Invalid module name: {module_name}"
+        
         # Check if module is already installed
         if module_name in installed_modules:
             return True, f"Module {module_name} is already installed"
         
         # Install the module
+        import pip
         pip.main(['install', module_name, '--target', MODULES_DIR])
         
         # Add to installed modules
@@ -274,6 +4053,7 @@ def uninstall_module(module_name):
             return False, f"Module {module_name} is not installed"
         
         # Uninstall the module
+        import pip
         pip.main(['uninstall', module_name, '-y'])
         
         # Remove from installed modules
@@ -297,6 +4077,268 @@ def list_installed_modules():
     
     return "\n".join(result)
 
+# Dependency detection
+# Uploaded scripts are parsed for top-level imports; any that resolve to
+# nothing (not builtin, stdlib, MODULES_DIR or the user's own files) are
+# mapped to a PyPI distribution and queued, but only if they are known:
+# listed in IMPORT_DISTRIBUTIONS or AUTO_INSTALL_DISTRIBUTIONS. Any other name
+# is as likely a module the user forgot to upload as a package, and
+# installing it blindly from PyPI into the shared MODULES_DIR would let
+# whoever registered that name run code here; those are only listed in the
+# upload reply, pointing at /installmodule. Imports guarded by
+# try/except ImportError are optional and skipped. Queued distributions are
+# deduplicated across users and installed by one job on the install queue in
+# a single pip run; anything queued while it runs goes into the next batch.
+IMPORT_DISTRIBUTIONS = {
+    'telebot': 'pyTelegramBotAPI', 'telegram': 'python-telegram-bot', 'PIL': 'Pillow',
+    'cv2': 'opencv-python', 'yaml': 'PyYAML', 'bs4': 'beautifulsoup4', 'sklearn': 'scikit-learn',
+    'dotenv': 'python-dotenv', 'dateutil': 'python-dateutil', 'Crypto': 'pycryptodome',
+    'jwt': 'PyJWT', 'serial': 'pyserial', 'docx': 'python-docx', 'pptx': 'python-pptx',
+    'discord': 'discord.py', 'attr': 'attrs', 'OpenSSL': 'pyOpenSSL', 'fitz': 'PyMuPDF',
+    'websocket': 'websocket-client', 'socks': 'PySocks', 'MySQLdb': 'mysqlclient',
+    'psycopg2': 'psycopg2-binary', 'zmq': 'pyzmq', 'nacl': 'PyNaCl', 'yt_dlp': 'yt-dlp',
+    'speech_recognition': 'SpeechRecognition', 'telethon': 'Telethon', 'Levenshtein': 'python-Levenshtein',
+    'magic': 'python-magic', 'googleapiclient': 'google-api-python-client', 'qrcode': 'qrcode',
+}
+# Distributions installed under their own import name
+AUTO_INSTALL_DISTRIBUTIONS = {
+    'requests', 'aiohttp', 'httpx', 'aiogram', 'pyrogram', 'numpy', 'pandas', 'scipy', 'matplotlib',
+    'flask', 'fastapi', 'uvicorn', 'websockets', 'psutil', 'colorama', 'termcolor', 'tqdm', 'rich',
+    'schedule', 'pytz', 'pymongo', 'motor', 'redis', 'sqlalchemy', 'pydantic', 'lxml', 'selenium',
+    'openai', 'tweepy', 'boto3', 'cryptography', 'paramiko', 'emoji', 'gtts', 'instaloader',
+    'pytube', 'faker', 'click', 'jinja2', 'ujson', 'orjson', 'cloudscraper', 'pyfiglet', 'wikipedia',
+}
+IMPORT_ERRORS = {'ImportError', 'ModuleNotFoundError', 'Exception', 'BaseException'}
+
+pending_dependencies = {}  # distribution -> [(key, callback)] waiting for it
+waiting_scripts = {}  # "uid:filename" -> distributions it still waits for
+dependency_lock = threading.Lock()
+dependency_job_queued = False
+
+def find_imports(source):
+    """Top-level names of the absolute, non-optional imports in source"""
+    import ast
+    names = set()
+    
+    def visit(node, optional):
+        if isinstance(node, ast.Try):
+            catches = any(h.type is None or any(isinstance(n, ast.Name) and n.id in IMPORT_ERRORS
+                                                 or isinstance(n, ast.Attribute) and n.attr in IMPORT_ERRORS
+                                                 for n in ast.walk(h.type)) for h in node.handlers)
+            for child in node.body:
+                visit(child, optional or catches)
+            for child in node.handlers + node.orelse + node.finalbody:
+                visit(child, optional)
+            return
+        if not optional:
+            if isinstance(node, ast.Import):
+                names.update(alias.name.split('.')[0] for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+                names.add(node.module.split('.')[0])
+        for child in ast.iter_child_nodes(node):
+            visit(child, optional)
+    
+    visit(ast.parse(source), False)
+    return names
+
+def find_missing_distributions(source, user_dir):
+    """Return ({distribution: import name} safe to install, [unknown import names]) for what source lacks"""
+    import importlib.machinery
+    search_path = [user_dir, MODULES_DIR] + [p for p in sys.path if p]
+    missing = {}
+    unknown = []
+    for name in sorted(find_imports(source)):
+        if name in sys.builtin_module_names or name == '__future__':
+            continue
+        if importlib.machinery.PathFinder.find_spec(name, search_path):
+            continue
+        if name in IMPORT_DISTRIBUTIONS:
+            missing[IMPORT_DISTRIBUTIONS[name]] = name
+        elif name in AUTO_INSTALL_DISTRIBUTIONS:
+            missing[name] = name
+        else:
+            unknown.append(name)
+    return missing, unknown
+
+def run_pip_install(distributions):
+    import pip
+    return pip.main(['install', '--quiet', '--target', MODULES_DIR] + list(distributions)) == 0
+
+def install_dependency_batch():
+    """Install everything queued so far in one pip run, then tell the waiting scripts"""
+    global dependency_job_queued
+    with dependency_lock:
+        batch = dict(pending_dependencies)
+        pending_dependencies.clear()
+        dependency_job_queued = False
+    if not batch:
+        return
+    
+    started = time.perf_counter()
+    names = sorted(batch)
+    if run_pip_install(names):
+        results = {name: True for name in names}
+    else:
+        # One bad name fails the whole resolve; retry one by one to find it
+        results = {name: run_pip_install([name]) for name in names}
+    logger.info(f"Installed dependency batch {names} in {time.perf_counter() - started:.1f}s: {results}")
+    
+    waiters = {}
+    for name, ok in results.items():
+        if ok:
+            requester = batch[name][0][0].split(':', 1)[0]
+            installed_modules[name] = {'installed_by': requester, 'date': datetime.datetime.now().isoformat()}
+        inc_metric('dependency_installs_total', 'ok' if ok else 'failed')
+        for key, callback in batch[name]:
+            waiters.setdefault(key, (callback, {}))[1][name] = ok
+    save_data()
+    
+    for key, (callback, outcome) in waiters.items():
+        with dependency_lock:
+            remaining = waiting_scripts.get(key, set()) - set(outcome)
+            if remaining:
+                waiting_scripts[key] = remaining
+            else:
+                waiting_scripts.pop(key, None)
+        try:
+            callback(outcome)
+        except Exception as e:
+            logger.error(f"Error reporting dependencies of {key}: {e}")
+
+def queue_dependencies(key, distributions, callback, priority=JOB_PRIORITY_USER):
+    """Queue distributions for the next install batch; callback({name: ok}) runs when this script's are done"""
+    global dependency_job_queued
+    with dependency_lock:
+        for name in distributions:
+            pending_dependencies.setdefault(name, []).append((key, callback))
+        waiting_scripts[key] = waiting_scripts.get(key, set()) | set(distributions)
+        if dependency_job_queued:
+            return
+        dependency_job_queued = True
+    submit_job('install', install_dependency_batch, priority=priority)
+
+# Profiling
+# A sampling profiler over sys._current_frames(): every PROFILE_INTERVAL the
+# stacks of all threads are folded into "thread;frame;frame" keys, which is
+# the collapsed format flamegraph.pl and speedscope read directly.
+PROFILE_INTERVAL = 0.01
+PROFILE_MAX_SECONDS = 600
+
+profiler = {
+    'samples': {},
+    'started': None,
+    'stopped': None,
+    'stop_event': None,
+    'thread': None,
+    'timer': None
+}
+profiler_lock = threading.Lock()
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def _thread_group(thread):
+    # WorkerThread1, WorkerThread2... fold into one flamegraph root
+    return re.sub(r'\d+$', '', thread.name) if thread else 'unknown'
+
+def _sample_stacks(stop_event):
+    own = threading.get_ident()
+    samples = profiler['samples']
+    while not stop_event.wait(PROFILE_INTERVAL):
+        threads = {t.ident: t for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            stack.append(_thread_group(threads.get(ident)))
+            key = ';'.join(reversed(stack))
+            with profiler_lock:
+                samples[key] = samples.get(key, 0) + 1
+
+def start_profiler(seconds=60):
+    """Start sampling all threads; stops by itself after the window"""
+    if profiler['thread'] and profiler['thread'].is_alive():
+        return False
+    stop_event = threading.Event()
+    with profiler_lock:
+        profiler.update(samples={}, started=time.time(), stopped=None, stop_event=stop_event)
+    profiler['thread'] = threading.Thread(target=_sample_stacks, args=(stop_event,), name='profiler', daemon=True)
+    profiler['thread'].start()
+    profiler['timer'] = threading.Timer(min(seconds, PROFILE_MAX_SECONDS), stop_profiler)
+    profiler['timer'].daemon = True
+    profiler['timer'].start()
+    return True
+
+def stop_profiler():
+    if not (profiler['thread'] and profiler['thread'].is_alive()):
+        return False
+    if profiler['timer']:
+        profiler['timer'].cancel()  # so it can't stop a later profile early
+    profiler['stop_event'].set()
+    profiler['thread'].join()
+    profiler['stopped'] = time.time()
+    return True
+
+def get_collapsed_stacks():
+    with profiler_lock:
+        samples = dict(profiler['samples'])
+    lines = [f"{stack} {count}" for stack, count in sorted(samples.items(), key=lambda i: -i[1])]
+    return "\n".join(lines) + "\n", samples
+
+def summarize_profile(samples, top=15, limit=4096):
+    """Top-N frames by self and inclusive sample count, cut on a line boundary to fit limit characters"""
+    total = sum(samples.values())
+    if not total:
+        return "No samples collected."
+    own, inclusive = {}, {}
+    for stack, count in samples.items():
+        frames = stack.split(';')[1:]
+        if not frames:
+            continue
+        own[frames[-1]] = own.get(frames[-1], 0) + count
+        for frame in set(frames):
+            inclusive[frame] = inclusive.get(frame, 0) + count
+    
+    started = profiler['started'] or time.time()
+    duration = (profiler['stopped'] or time.time()) - started
+    result = [f"<b>🔬 Profile</b> ({total} samples over {duration:.1f}s)", "", "<u>Self time:</u>"]
+    for frame, count in sorted(own.items(), key=lambda i: -i[1])[:top]:
+        result.append(f"{count * 100 / total:5.1f}% <code>{html_escape(frame)}</code>")
+    result.append("")
+    result.append("<u>Inclusive time:</u>")
+    for frame, count in sorted(inclusive.items(), key=lambda i: -i[1])[:top]:
+        result.append(f"{count * 100 / total:5.1f}% <code>{html_escape(frame)}</code>")
+    
+    # Each line is complete markup, so dropping whole lines never splits a tag
+    text = ""
+    for line in result:
+        if len(text) + len(line) + 2 > limit:
+            return text + "…"
+        text += line + "\n"
+    return text.rstrip("\n")
+
+def html_escape(text):
+    return str(text).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def dump_threads(depth=6):
+    """Describe where every thread currently is, innermost frame first"""
+    frames = sys._current_frames()
+    result = [f"<b>🧵 Threads ({threading.active_count()})</b>"]
+    for thread in sorted(threading.enumerate(), key=lambda t: t.name):
+        frame = frames.get(thread.ident)
+        result.append(f"\n<b>{html_escape(thread.name)}</b>{' (daemon)' if thread.daemon else ''}")
+        for _ in range(depth):
+            if frame is None:
+                break
+            code = frame.f_code
+            location = f"{code.co_name} {os.path.basename(code.co_filename)}:{frame.f_lineno}"
+            result.append(f"  <code>{html_escape(location)}</code>")
+            frame = frame.f_back
+    return "\n".join(result)
+
 # Menu builders
 def build_main_menu(user_id):
     limit = get_limit(user_id)
@@ -358,6 +4400,11 @@ def build_admin_menu():
         types.InlineKeyboardButton("⚙️ Settings", callback_data='admin_settings')
     )
     
+    menu.add(
+        types.InlineKeyboardButton("🔬 Profiler", callback_data='admin_profiler'),
+        types.InlineKeyboardButton("🧵 Threads", callback_data='admin_threads')
+    )
+    
     menu.add(
         types.InlineKeyboardButton("🔙 Main Menu", callback_data='main_menu')
     )
@@ -443,6 +4490,7 @@ def build_modules_menu():
 
 # Command handlers with improved usage instructions
 @bot.message_handler(commands=['start', 'menu'])
+@track_handler('start')
 def start(message):
     if MAINTENANCE_MODE and message.from_user.id not in WHITELIST:
         return bot.send_message(message.chat.id, "🔧 Bot is under maintenance. Please try again later.")
@@ -450,7 +4498,7 @@ def start(message):
     try:
         uid = message.from_user.id
         ensure_user_dir(uid)
-        known_users.add(uid)
+        register_user(uid)
         save_data()
         
         welcome_msg = """
@@ -474,6 +4522,7 @@ Use the buttons below or type /help for all commands!
         bot.send_message(message.chat.id, "❌ An error occurred. Please try again.")
 
 @bot.message_handler(commands=['help'])
+@track_handler('help_command')
 def help_command(message):
     help_text = """
 <b>📖 ULTIMINE Hosting Help</b>
@@ -481,15 +4530,23 @@ def help_command(message):
 <u>👤 User Commands</u>
 /start or /menu - Show main menu
 /help - Show this help message
-/upload - Upload a Python script file
+/upload - Upload a Python script file or project archive
 /status - Show your hosting status
 
 <u>📁 File Management</u>
 /listfiles - List all your uploaded scripts
-/startfile <filename> - Start a script (e.g. /startfile myscript.py)
+/startfile <filename> - Start a script or project (e.g. /startfile myscript.py)
 /stopfile <filename> - Stop a running script
 /deletefile <filename> - Delete a script file
 /getlog <filename> - Get logs for a script
+/searchlog <text> [filename] - Search your script logs
+/attach <filename> - Follow a running script's output live
+/redeploy <filename> [ready text] - Swap in a new upload without stopping the bot
+/detach [filename] - Stop following output
+/schedule <filename> <cron> - Run a script on a schedule (e.g. /schedule job.py */10 * * * *)
+/top [mem] - CPU and memory use of your running scripts
+/usage - CPU, memory and disk you used over the last day, week and month
+/qr [text] - QR code for text, or for your invite link
 
 <u>🛠️ Utilities</u>
 /backup - Get backup of all your scripts
@@ -503,15 +4560,27 @@ def help_command(message):
 /adduser <user_id> <limit> - Add new user
 /broadcast <message> - Send text broadcast
 /broadcastimage - Send image broadcast (reply to image)
+/delivery <user_id> [broadcast_id] - Check which broadcasts reached a user
+/usage top [cpu|mem|disk] [period] - Top resource consumers
+/user <user_id> - Limits, scripts and usage of one user
+/editbroadcast <id> <text> - Fix a sent broadcast in every chat
+/deletebroadcast <id> - Remove a sent broadcast from every chat
+/searchlog all <text> - Search every user's script logs
 /stats - Show bot statistics
 /maintenance <on/off> - Toggle maintenance mode
 /whitelist <user_id> - Add user to whitelist
+/profile <start [seconds]|stop|dump> - Profile the bot process
+/admission [reserve <MB>] - Host capacity, launch queue and memory kept free for the bot
+/threads - Show what every bot thread is doing
+/top all [mem] - Busiest scripts across all users
+/qr invites - Send every user a QR code of their invite link
 
 <b>⚠️ Note:</b> Replace <filename> with your script name (e.g. bot.py) and <name> with module name (e.g. requests)
 """
     bot.send_message(message.chat.id, help_text)
 
 @bot.message_handler(commands=['status'])
+@track_handler('status_command')
 def status_command(message):
     try:
         uid = message.from_user.id
@@ -543,6 +4612,7 @@ Use /startfile <filename> to run a script
         bot.send_message(message.chat.id, "❌ Could not get status. Please try again.")
 
 @bot.message_handler(commands=['upload'])
+@track_handler('upload_command')
 def upload_command(message):
     if MAINTENANCE_MODE and message.from_user.id not in WHITELIST:
         return
@@ -564,6 +4634,7 @@ def upload_command(message):
 <u>⚠️ Important:</u>
 - Only standard Python scripts are allowed
 - Scripts must have .py extension
+- Multi-file projects: send a .zip or .tar.gz with the entry script as caption (e.g. main.py)
 - No malicious code allowed
 """
         bot.reply_to(message, instructions)
@@ -571,12 +4642,162 @@ def upload_command(message):
         logger.error(f"Error in upload command: {e}")
         bot.reply_to(message, "❌ Failed to process upload request. Please try again.")
 
+@bot.message_handler(content_types=['document'])
+@track_handler('handle_document')
+def handle_document(message):
+    if MAINTENANCE_MODE and message.from_user.id not in WHITELIST:
+        return
+    
+    try:
+        doc = message.document
+        if doc.file_size and doc.file_size > 20 * 1024 * 1024:
+            return bot.reply_to(message, "❌ File is too large. Max file size: 20MB")
+        
+        if doc.file_name and get_archive_ext(doc.file_name):
+            return handle_project_upload(message)
+        
+        if not doc.file_name or not doc.file_name.endswith('.py'):
+            return bot.reply_to(message, "❌ Only Python (.py) files or project archives (.zip, .tar.gz) can be uploaded.")
+        
+        uid = str(message.chat.id)
+        filename = sanitize_filename(doc.file_name)
+        path = os.path.join(ensure_user_dir(uid), filename)
+        limit = get_limit(uid)
+        
+        if not os.path.exists(path) and get_uploaded_count(uid) >= limit:
+            return bot.reply_to(message, f"🚫 You've reached your limit of {limit} scripts. Delete some files first.")
+        
+        def job():
+            try:
+                file_info = bot.get_file(doc.file_id)
+                downloaded_file = bot.download_file(file_info.file_path)
+                
+                code, error = check_script_syntax(downloaded_file, filename)
+                if error:
+                    return bot.reply_to(message, f"""
+❌ Upload rejected, syntax error in <code>{html_escape(filename)}</code>:
+{html_escape(error)}
+
+<u>What to do:</u>
+Fix the script and send it again
+""")
+                
+                with open(path, 'wb') as f:
+                    f.write(downloaded_file)
+                
+                if f"{uid}:{filename}" in processes:
+                    next_step = f"- It is running the old version; switch with /redeploy {filename}"
+                else:
+                    next_step = f"- Start it with /startfile {filename}"
+                
+                try:
+                    missing, unknown = find_missing_distributions(downloaded_file, os.path.dirname(path))
+                except Exception as e:
+                    logger.error(f"Error detecting imports of {filename}: {e}")
+                    missing, unknown = {}, []
+                if unknown:
+                    next_step = (f"- Not found: {html_escape(', '.join(unknown))}. Upload them if they are your own "
+                                 f"modules, or install the right package with /installmodule\n{next_step}")
+                if missing:
+                    listed = ", ".join(name if name == module else f"{name} (for {module})" for name, module in missing.items())
+                    next_step = f"- Installing missing packages: {html_escape(listed)}\n{next_step}"
+                    
+                    def installed(outcome):
+                        failed = [name for name, ok in outcome.items() if not ok]
+                        if failed:
+                            bot.reply_to(message, f"⚠️ Could not install {html_escape(', '.join(failed))} for <code>{filename}</code>; "
+                                                  f"it may fail with ImportError. Try /installmodule with the right package name.")
+                        else:
+                            bot.reply_to(message, f"📦 Packages for <code>{filename}</code> are installed.")
+                    
+                    queue_dependencies(f"{uid}:{filename}", missing, installed, priority=job_priority(uid))
+                
+                bot.reply_to(message, f"""
+✅ Uploaded: <code>{filename}</code>
+
+<u>Next steps:</u>
+{next_step}
+""")
+                store_bytecode(downloaded_file, code)
+            except Exception as e:
+                logger.error(f"Error handling upload: {e}")
+                bot.reply_to(message, "❌ Failed to upload file. Please try again.")
+        
+        ahead = submit_job('file_io', job, priority=job_priority(uid))
+        if ahead:
+            bot.reply_to(message, queued_text("📤 Upload", ahead))
+    except Exception as e:
+        logger.error(f"Error handling upload: {e}")
+        bot.reply_to(message, "❌ Failed to upload file. Please try again.")
+
+def handle_project_upload(message):
+    doc = message.document
+    uid = str(message.chat.id)
+    name = sanitize_project_name(doc.file_name)
+    if not name:
+        return bot.reply_to(message, "❌ Invalid project name.")
+    
+    limit = get_limit(uid)
+    if not get_project(uid, name) and get_uploaded_count(uid) >= limit:
+        return bot.reply_to(message, f"🚫 You've reached your limit of {limit} scripts. Delete some files first.")
+    
+    entry = None
+    if message.caption:
+        entry = next((w for w in message.caption.split() if w.endswith('.py')), None)
+    
+    def job():
+        try:
+            file_info = bot.get_file(doc.file_id)
+            downloaded_file = bot.download_file(file_info.file_path)
+            
+            ext = get_archive_ext(doc.file_name)
+            info, error = inspect_project_archive(downloaded_file, ext, entry)
+            if error:
+                return bot.reply_to(message, f"❌ Project upload rejected: {html_escape(error)}")
+            if not info:
+                return bot.reply_to(message, f"""
+📦 No entry point declared for <code>{name}</code>
+
+<u>To host it as a project:</u>
+Send the archive again with the entry script as caption (e.g. main.py), or add a {PROJECT_MANIFEST} with {{"entry": "main.py", "requirements": [...]}}
+
+<u>To restore a backup:</u>
+Reply to the archive with /restore
+""")
+            
+            project = save_project(uid, name, downloaded_file, ext, info)
+            
+            def report(results):
+                failed = [msg for ok, msg in results if not ok]
+                if failed:
+                    bot.send_message(uid, "⚠️ Some requirements failed to install:\n" + "\n".join(failed))
+            
+            prefetch_project(uid, project, on_done=report)
+            
+            requirements = ", ".join(project['requirements']) or "none"
+            bot.reply_to(message, f"""
+✅ Uploaded project: <code>{name}</code>
+▶️ Entry point: <code>{project['entry']}</code>
+🧩 Requirements: {requirements}
+
+<u>Next steps:</u>
+- Start it with /startfile {name}
+""")
+        except Exception as e:
+            logger.error(f"Error handling project upload: {e}")
+            bot.reply_to(message, "❌ Failed to upload project. Please try again.")
+    
+    ahead = submit_job('file_io', job, priority=job_priority(uid))
+    if ahead:
+        bot.reply_to(message, queued_text("📤 Upload", ahead))
+
 @bot.message_handler(commands=['listfiles'])
+@track_handler('list_files_command')
 def list_files_command(message):
     try:
         uid = message.chat.id
         user_dir = os.path.join(UPLOAD_DIR, str(uid))
-        running_scripts = [k.split(':')[1] for k in processes if k.startswith(f"{uid}:")]
+        running_scripts = [k.split(':', 1)[1] for k in list(processes) + list(cluster_scripts) if k.startswith(f"{uid}:")]
         
         if not os.path.exists(user_dir) or not os.listdir(user_dir):
             return bot.reply_to(message, "📁 You don't have any files yet. Use /upload to add scripts.")
@@ -587,9 +4808,16 @@ def list_files_command(message):
         for file in files:
             if file.endswith('.py'):
                 status = "🟢 Running" if file in running_scripts else "⚪ Stopped"
+                schedule = schedules.get(f"{uid}:{file}")
+                if schedule:
+                    status += f" ⏰ <code>{schedule['cron']}</code>"
                 size = os.path.getsize(os.path.join(user_dir, file)) / 1024  # KB
                 response.append(f"• <code>{file}</code> - {status} ({size:.1f} KB)")
         
+        for project in list_projects(uid):
+            status = "🟢 Running" if project['name'] in running_scripts else "⚪ Stopped"
+            response.append(f"• 📦 <code>{project['name']}</code> - {status} (entry: {project['entry']})")
+        
         response.append("\n<u>💡 Usage:</u>")
         response.append("To start: /startfile filename.py")
         response.append("To stop: /stopfile filename.py")
@@ -601,6 +4829,7 @@ def list_files_command(message):
         bot.reply_to(message, "❌ Failed to list files. Please try again.")
 
 @bot.message_handler(commands=['startfile'])
+@track_handler('start_file_command')
 def start_file_command(message):
     if MAINTENANCE_MODE and message.from_user.id not in WHITELIST:
         return
@@ -619,15 +4848,16 @@ def start_file_command(message):
 - You can run up to {limit} scripts simultaneously
 """.format(limit=get_limit(message.from_user.id)))
         
-        filename = sanitize_filename(message.text.split()[1])
+        uid = str(message.chat.id)
+        filename = sanitize_target(uid, message.text.split()[1])
         if not filename:
             return bot.reply_to(message, "❌ Invalid filename. Must end with .py")
         
-        uid = str(message.chat.id)
+        project = get_project(uid, filename)
         path = os.path.join(UPLOAD_DIR, uid, filename)
         key = f"{uid}:{filename}"
         
-        if not os.path.exists(path):
+        if not project and not os.path.exists(path):
             return bot.reply_to(message, f"""
 ❌ File not found: {filename}
 
@@ -636,10 +4866,19 @@ def start_file_command(message):
 2. Upload the file with /upload
 """)
         
-        if key in processes:
+        if key in processes or key in cluster_scripts:
             return bot.reply_to(message, f"⚠️ Script is already running: {filename}")
         
-        if get_running_count(uid) >= get_limit(uid):
+        if waiting_scripts.get(key):
+            return bot.reply_to(message, f"⏳ Still installing {html_escape(', '.join(sorted(waiting_scripts[key])))} "
+                                         f"for {filename}. I'll message you when they're ready.")
+        
+        if is_queued(key):
+            return bot.reply_to(message, f"⏳ {filename} is already queued and starts once the server has room. "
+                                         f"Cancel with /stopfile {filename}")
+        
+        # Queued launches hold a slot so a user can't queue past their limit
+        if get_running_count(uid) + get_queued_count(uid) >= get_limit(uid):
             return bot.reply_to(message, f"""
 🚫 Script limit reached ({get_limit(uid)})
 
@@ -648,34 +4887,35 @@ def start_file_command(message):
 2. Ask admin to increase your limit
 """)
         
-        def run_script():
-            log_file = os.path.join(LOGS_DIR, f"{uid}_{filename}.log")
-            
-            env = os.environ.copy()
-            env['PYTHONPATH'] = MODULES_DIR
-            
-            with open(log_file, 'w') as f:
-                proc = subprocess.Popen(
-                    ['python', path],
-                    stdout=f,
-                    stderr=f,
-                    env=env
-                )
-                
-                processes[key] = {
-                    'process': proc,
-                    'start': time.time(),
-                    'log_file': log_file
-                }
-                
-                try:
-                    proc.wait(timeout=3600)
-                except subprocess.TimeoutExpired:
-                    proc.terminate()
-                finally:
-                    processes.pop(key, None)
-        
-        threading.Thread(target=run_script).start()
+        if cluster_enabled():
+            error = cluster_start_script(uid, filename, project)
+        else:
+            decision, reason = admit_script(key)
+            if decision == 'reject':
+                return bot.reply_to(message, f"🚫 Can't start <code>{filename}</code> on this server: {reason}.")
+            if decision == 'queue':
+                position = queue_launch(uid, filename, project, message.chat.id)
+                if position is None:
+                    return bot.reply_to(message, "🚫 The server is at capacity and its launch queue is full. Please try again later.")
+                return bot.reply_to(message, f"""
+⏳ Queued <code>{filename}</code> (position {position})
+The server is short on room right now: {reason}.
+
+<u>Note:</u>
+- It starts automatically once enough memory is free; I'll message you
+- Cancel with /stopfile {filename}
+""")
+            error = launch_script(uid, filename, project)
+            if error:
+                cancel_admission(key)
+        if error:
+            return bot.reply_to(message, f"""
+❌ Could not start <code>{html_escape(filename)}</code>
+{html_escape(error)}
+
+<u>What to do:</u>
+Fix the script and upload it again with /upload
+""")
         
         bot.reply_to(message, f"""
 ✅ Started script: <code>{filename}</code>
@@ -685,10 +4925,65 @@ def start_file_command(message):
 - Stop with /stopfile {filename}
 """)
     except Exception as e:
-        logger.error(f"Error starting file: {e}")
-        bot.reply_to(message, "❌ Failed to start script. Please try again.")
+        logger.error(f"Error starting file: {e}")
+        bot.reply_to(message, "❌ Failed to start script. Please try again.")
+
+@bot.message_handler(commands=['redeploy'])
+@track_handler('redeploy_command')
+def redeploy_command(message):
+    if MAINTENANCE_MODE and message.from_user.id not in WHITELIST:
+        return
+    
+    try:
+        parts = message.text.split(None, 2)
+        if len(parts) < 2:
+            return bot.reply_to(message, f"""
+❌ <b>Usage:</b> /redeploy filename.py [ready text]
+
+<u>Example:</u>
+/redeploy mybot.py
+/redeploy mybot.py Bot started
+
+<u>Note:</u>
+- Upload the new version first; the old one keeps running meanwhile
+- The new version takes over once it prints the ready text, or after {REDEPLOY_WARMUP}s without one
+- If it crashes while warming up, the old version is left running
+- Polling bots may log a 409 Conflict until the old instance stops
+""")
+        
+        uid = str(message.chat.id)
+        filename = sanitize_target(uid, parts[1])
+        if not filename:
+            return bot.reply_to(message, "❌ Invalid filename. Must end with .py")
+        
+        key = f"{uid}:{filename}"
+        if key in cluster_scripts:
+            return bot.reply_to(message, "❌ Scripts on worker nodes can't be redeployed yet. Use /stopfile and /startfile.")
+        if key not in processes:
+            return bot.reply_to(message, f"❌ {filename} is not running. Start it with /startfile {filename}")
+        if key in redeploying:
+            return bot.reply_to(message, f"⏳ {filename} is already being redeployed.")
+        if waiting_scripts.get(key):
+            return bot.reply_to(message, f"⏳ Still installing {html_escape(', '.join(sorted(waiting_scripts[key])))} "
+                                         f"for {filename}. I'll message you when they're ready.")
+        
+        # Both versions run side by side during warm-up
+        decision, reason = admit_script(key)
+        if decision != 'accept':
+            return bot.reply_to(message, f"🚫 No room to run the new {filename} next to the old one: {reason}. Please try again later.")
+        
+        marker = parts[2].strip() if len(parts) > 2 else None
+        redeploying[key] = {}
+        threading.Thread(target=redeploy_script, name=f"redeploy:{key}",
+                         args=(uid, filename, get_project(uid, filename), marker, lambda text: bot.reply_to(message, text))).start()
+        waiting = f"it prints <code>{html_escape(marker)}</code>" if marker else f"it stays up for {REDEPLOY_WARMUP}s"
+        bot.reply_to(message, f"🚀 Starting the new <code>{filename}</code> next to the old one; it takes over once {waiting}.")
+    except Exception as e:
+        logger.error(f"Error redeploying: {e}")
+        bot.reply_to(message, "❌ Failed to redeploy. Please try again.")
 
 @bot.message_handler(commands=['stopfile'])
+@track_handler('stop_file_command')
 def stop_file_command(message):
     try:
         if len(message.text.split()) < 2:
@@ -702,13 +4997,16 @@ def stop_file_command(message):
 - Use /listfiles to see running scripts
 """)
         
-        filename = sanitize_filename(message.text.split()[1])
+        filename = sanitize_target(message.chat.id, message.text.split()[1])
         if not filename:
             return bot.reply_to(message, "❌ Invalid filename. Must end with .py")
         
         key = f"{message.chat.id}:{filename}"
         
-        if key not in processes:
+        if cancel_queued_launch(key):
+            return bot.reply_to(message, f"✅ Cancelled the queued start of <code>{filename}</code>")
+        
+        if key not in processes and key not in cluster_scripts:
             return bot.reply_to(message, f"""
 ⚠️ Script isn't running: {filename}
 
@@ -720,10 +5018,14 @@ def stop_file_command(message):
 Check status with /listfiles
 """)
         
-        proc_info = processes[key]
-        proc_info['process'].terminate()
-        runtime = time.time() - proc_info['start']
-        processes.pop(key, None)
+        if key in cluster_scripts:
+            runtime = cluster_stop_script(key)
+        else:
+            with redeploy_lock:
+                cancel_redeploy(key)  # a new version warming up goes too
+                runtime = stop_script(key)
+        if runtime is None:
+            return bot.reply_to(message, f"❌ Could not reach the worker running {filename}. Please try again.")
         
         bot.reply_to(message, f"""
 ✅ Stopped script: <code>{filename}</code>
@@ -736,7 +5038,79 @@ You can restart it with /startfile {filename}
         logger.error(f"Error stopping file: {e}")
         bot.reply_to(message, "❌ Failed to stop script. Please try again.")
 
+@bot.message_handler(commands=['schedule'])
+@track_handler('schedule_command')
+def schedule_command(message):
+    if MAINTENANCE_MODE and message.from_user.id not in WHITELIST:
+        return
+    
+    try:
+        uid = str(message.chat.id)
+        args = message.text.split()[1:]
+        
+        if not args:
+            with schedule_lock:
+                mine = [(key.split(':', 1)[1], dict(schedules[key])) for key in schedules.user_keys(uid)]
+            if not mine:
+                return bot.reply_to(message, f"""
+❌ <b>Usage:</b> /schedule filename.py minute hour day month weekday
+
+<u>Example:</u>
+/schedule report.py */15 * * * *
+/schedule backup.py 0 3 * * 1
+/schedule report.py off
+
+<u>Note:</u>
+- Times are server time ({time.strftime('%Z')})
+- A run only counts against your limit while it executes
+- A run is skipped if the previous one is still going
+""")
+            response = ["<b>⏰ Your Scheduled Scripts</b>\n"]
+            for filename, entry in sorted(mine):
+                next_run = datetime.datetime.fromtimestamp(entry['next']).strftime("%Y-%m-%d %H:%M")
+                last = f", last: {html_escape(entry['last_status'])}" if entry['last_status'] else ""
+                response.append(f"• <code>{filename}</code> <code>{entry['cron']}</code>\n"
+                                f"  Next: {next_run} | Runs: {entry['runs']} | Skipped: {entry['skipped']}{last}")
+            return bot.reply_to(message, "\n".join(response))
+        
+        filename = sanitize_target(uid, args[0])
+        if not filename:
+            return bot.reply_to(message, "❌ Invalid filename. Must end with .py")
+        
+        if args[1:] == ['off']:
+            if remove_schedule(uid, filename):
+                return bot.reply_to(message, f"✅ Removed schedule for <code>{filename}</code>")
+            return bot.reply_to(message, f"⚠️ <code>{filename}</code> isn't scheduled")
+        
+        if not get_project(uid, filename) and not os.path.exists(os.path.join(UPLOAD_DIR, uid, filename)):
+            return bot.reply_to(message, f"""
+❌ File not found: {filename}
+
+<u>What to do:</u>
+1. Check spelling with /listfiles
+2. Upload the file with /upload
+""")
+        
+        expr = ' '.join(args[1:])
+        try:
+            next_run = set_schedule(uid, filename, expr)
+        except ValueError as e:
+            return bot.reply_to(message, f"❌ Invalid schedule <code>{html_escape(expr)}</code>: {html_escape(str(e))}")
+        
+        bot.reply_to(message, f"""
+✅ Scheduled <code>{filename}</code>: <code>{expr}</code>
+⏰ Next run: {datetime.datetime.fromtimestamp(next_run).strftime("%Y-%m-%d %H:%M")}
+
+<u>Note:</u>
+- Runs start up to {SCHEDULE_JITTER}s after the scheduled minute
+- Remove it with /schedule {filename} off
+""")
+    except Exception as e:
+        logger.error(f"Error in schedule command: {e}")
+        bot.reply_to(message, "❌ Failed to update schedule. Please try again.")
+
 @bot.message_handler(commands=['deletefile'])
+@track_handler('delete_file_command')
 def delete_file_command(message):
     try:
         if len(message.text.split()) < 2:
@@ -750,11 +5124,11 @@ def delete_file_command(message):
 This will permanently delete the file!
 """)
         
-        filename = sanitize_filename(message.text.split()[1])
+        uid = message.chat.id
+        filename = sanitize_target(uid, message.text.split()[1])
         if not filename:
             return bot.reply_to(message, "❌ Invalid filename. Must end with .py")
         
-        uid = message.chat.id
         py_path = os.path.join(UPLOAD_DIR, str(uid), filename)
         log_path = os.path.join(LOGS_DIR, f"{uid}_{filename}.log")
         key = f"{uid}:{filename}"
@@ -763,15 +5137,22 @@ This will permanently delete the file!
         if key in processes:
             processes[key]['process'].terminate()
             processes.pop(key, None)
+        if cluster_enabled():
+            cluster_delete_script(key)
         
         # Delete files
         deleted = []
-        if os.path.exists(py_path):
+        if remove_schedule(uid, filename):
+            deleted.append("schedule")
+        if delete_project(uid, filename):
+            deleted.append(f"project {filename}")
+        elif os.path.exists(py_path):
             os.remove(py_path)
             deleted.append(filename)
         
         if os.path.exists(log_path):
             os.remove(log_path)
+            reset_log_index(log_path)
             deleted.append(f"{filename}.log")
         
         if deleted:
@@ -795,6 +5176,7 @@ You can upload a new version with /upload
         bot.reply_to(message, "❌ Failed to delete file. Please try again.")
 
 @bot.message_handler(commands=['getlog'])
+@track_handler('get_log_command')
 def get_log_command(message):
     try:
         if len(message.text.split()) < 2:
@@ -809,12 +5191,21 @@ def get_log_command(message):
 - Empty if script hasn't produced output
 """)
         
-        filename = sanitize_filename(message.text.split()[1])
+        filename = sanitize_target(message.chat.id, message.text.split()[1])
         if not filename:
             return bot.reply_to(message, "❌ Invalid filename. Must end with .py")
         
         log_path = os.path.join(LOGS_DIR, f"{message.chat.id}_{filename}.log")
         
+        if cluster_enabled():
+            content = cluster_get_log(f"{message.chat.id}:{filename}")
+            if content is not None:
+                log_file = io.BytesIO(content)
+                log_file.name = f"{filename}.log"
+                if len(content) > 4096:
+                    bot.send_message(message.chat.id, "⚠️ Log is large, sending as file:")
+                return bot.send_document(message.chat.id, log_file, caption=f"📜 Logs for {filename}")
+        
         if os.path.exists(log_path):
             with open(log_path, 'rb') as log_file:
                 if os.path.getsize(log_path) > 4096:
@@ -833,22 +5224,135 @@ def get_log_command(message):
         logger.error(f"Error getting logs: {e}")
         bot.reply_to(message, "❌ Failed to get logs. Please try again.")
 
-@bot.message_handler(commands=['backup'])
-def backup_command(message):
+@bot.message_handler(commands=['attach'])
+@track_handler('attach_command')
+def attach_command(message):
     try:
-        uid = message.from_user.id
-        backup_path = backup_user_data(uid)
+        uid = message.chat.id
+        if len(message.text.split()) < 2:
+            return bot.reply_to(message, f"""
+❌ <b>Usage:</b> /attach filename.py
+
+<u>Example:</u>
+/attach mybot.py
+
+<u>Note:</u>
+- Forwards what the script prints from now on
+- Updates every {ATTACH_EDIT_INTERVAL}s; very chatty output is skipped over
+- Stop with /detach or the Detach button
+""")
+        
+        filename = sanitize_target(uid, message.text.split()[1])
+        if not filename:
+            return bot.reply_to(message, "❌ Invalid filename. Must end with .py")
+        
+        key = f"{uid}:{filename}"
+        if key in cluster_scripts:
+            return bot.reply_to(message, "❌ This script runs on a worker node. Use /getlog to see its output.")
+        if key not in processes:
+            return bot.reply_to(message, f"❌ {filename} is not running. Start it with /startfile first.")
+        if key in attachments:
+            return bot.reply_to(message, f"📟 Already attached to {filename}.")
+        if sum(1 for k in attachments if k.startswith(f"{uid}:")) >= ATTACH_MAX_PER_USER:
+            return bot.reply_to(message, f"❌ You can attach to at most {ATTACH_MAX_PER_USER} scripts. /detach one first.")
+        
+        attach_script(uid, key)
+    except Exception as e:
+        logger.error(f"Error attaching to script: {e}")
+        bot.reply_to(message, "❌ Failed to attach. Please try again.")
+
+@bot.message_handler(commands=['detach'])
+@track_handler('detach_command')
+def detach_command(message):
+    try:
+        uid = message.chat.id
+        args = message.text.split()[1:]
+        if args:
+            filename = sanitize_target(uid, args[0])
+            keys = [f"{uid}:{filename}"] if filename else []
+        else:
+            keys = [k for k in list(attachments) if k.startswith(f"{uid}:")]
+        
+        detached = [key.split(':', 1)[1] for key in keys if detach_script(key)]
+        if not detached:
+            return bot.reply_to(message, "📭 Nothing to detach.")
+        bot.reply_to(message, f"⏏️ Detached from {', '.join(detached)}.")
+    except Exception as e:
+        logger.error(f"Error detaching from script: {e}")
+        bot.reply_to(message, "❌ Failed to detach. Please try again.")
+
+@bot.message_handler(commands=['searchlog'])
+@track_handler('search_log_command')
+def search_log_command(message):
+    try:
+        uid = message.chat.id
+        args = message.text.split()[1:]
+        search_all = bool(args) and args[0] == 'all' and message.from_user.id in ADMIN_IDS
+        if search_all:
+            args = args[1:]
         
-        if backup_path:
-            with open(backup_path, 'rb') as backup_file:
-                bot.send_document(uid, backup_file, caption="📦 Here's your backup!")
+        filename = None
+        if len(args) > 1 and args[-1].endswith('.py'):
+            filename = sanitize_target(uid, args.pop())
+            if not filename:
+                return bot.reply_to(message, "❌ Invalid filename. Must end with .py")
+        
+        pattern = " ".join(args)
+        if not pattern:
+            return bot.reply_to(message, """
+❌ <b>Usage:</b> /searchlog text [filename.py]
+
+<u>Example:</u>
+/searchlog Traceback
+/searchlog connection reset mybot.py
+
+<u>Note:</u>
+- Case-insensitive, matches plain text
+- Patterns of 3+ characters use the index and answer fastest
+""" + ("- Admins: /searchlog all text searches every user's logs\n" if message.from_user.id in ADMIN_IDS else ""))
+        
+        if not os.path.isdir(LOGS_DIR):
+            return bot.reply_to(message, "📭 No logs yet.")
+        if search_all:
+            prefix = ""
+        elif filename:
+            prefix = f"{uid}_{filename}.log"
         else:
-            bot.send_message(uid, "❌ No files to backup.")
+            prefix = f"{uid}_"
+        paths = sorted(os.path.join(LOGS_DIR, n) for n in os.listdir(LOGS_DIR)
+                       if n.endswith('.log') and n.startswith(prefix) and (not filename or n == prefix))
+        if not paths:
+            return bot.reply_to(message, "📭 No logs to search.")
+        
+        text, markup = render_log_search(start_log_search(uid, paths, pattern))
+        bot.reply_to(message, text, reply_markup=markup)
     except Exception as e:
-        logger.error(f"Error in backup command: {e}")
-        bot.send_message(message.chat.id, "❌ Failed to create backup. Please try again.")
+        logger.error(f"Error searching logs: {e}")
+        bot.reply_to(message, "❌ Failed to search logs. Please try again.")
+
+@bot.message_handler(commands=['backup'])
+@track_handler('backup_command')
+def backup_command(message):
+    uid = message.chat.id
+    
+    def job():
+        try:
+            backup_path = backup_user_data(uid)
+            
+            if backup_path:
+                with open(backup_path, 'rb') as backup_file:
+                    bot.send_document(uid, backup_file, caption="📦 Here's your backup!")
+            else:
+                bot.send_message(uid, "❌ No files to backup.")
+        except Exception as e:
+            logger.error(f"Error in backup command: {e}")
+            bot.send_message(uid, "❌ Failed to create backup. Please try again.")
+    
+    ahead = submit_job('file_io', job, priority=job_priority(uid))
+    bot.send_message(uid, queued_text("📦 Backup", ahead))
 
 @bot.message_handler(commands=['restore'])
+@track_handler('restore_command')
 def restore_command(message):
     try:
         if not (message.reply_to_message and message.reply_to_message.document):
@@ -870,21 +5374,37 @@ def restore_command(message):
         if not file.file_name.endswith('.zip'):
             return bot.reply_to(message, "❌ Only .zip backup files are allowed.")
         
-        # Download the file
-        file_info = bot.get_file(file.file_id)
-        downloaded_file = bot.download_file(file_info.file_path)
-        
-        # Extract to user directory
-        user_dir = ensure_user_dir(uid)
-        with zipfile.ZipFile(io.BytesIO(downloaded_file), 'r') as zip_ref:
-            zip_ref.extractall(user_dir)
+        def job():
+            try:
+                # Download the file
+                file_info = bot.get_file(file.file_id)
+                downloaded_file = bot.download_file(file_info.file_path)
+                
+                # Extract to user directory
+                import zipfile
+                user_dir = ensure_user_dir(uid)
+                with zipfile.ZipFile(io.BytesIO(downloaded_file), 'r') as zip_ref:
+                    zip_ref.extractall(user_dir)
+                
+                bot.reply_to(message, "✅ Backup restored successfully!")
+                
+                def report_invalid(path, error):
+                    bot.send_message(uid, f"⚠️ Restored script <code>{html_escape(os.path.basename(path))}</code> has a syntax error and won't start:\n{html_escape(error)}")
+                
+                scripts = [os.path.join(user_dir, f) for f in os.listdir(user_dir) if f.endswith('.py')]
+                precompile_in_background(scripts, on_error=report_invalid)
+            except Exception as e:
+                logger.error(f"Error in restore command: {e}")
+                bot.reply_to(message, "❌ Failed to restore backup. Please try again.")
         
-        bot.reply_to(message, "✅ Backup restored successfully!")
+        ahead = submit_job('file_io', job, priority=job_priority(uid))
+        bot.reply_to(message, queued_text("♻️ Restore", ahead))
     except Exception as e:
         logger.error(f"Error in restore command: {e}")
         bot.reply_to(message, "❌ Failed to restore backup. Please try again.")
 
 @bot.message_handler(commands=['installmodule'])
+@track_handler('install_module_command')
 def install_module_command(message):
     if MAINTENANCE_MODE and message.from_user.id not in WHITELIST:
         return
@@ -905,13 +5425,18 @@ def install_module_command(message):
         module_name = message.text.split()[1].strip()
         uid = message.from_user.id
         
-        success, result = install_module(module_name, uid)
-        bot.reply_to(message, result)
+        def job():
+            success, result = install_module(module_name, uid)
+            bot.reply_to(message, result)
+        
+        ahead = submit_job('install', job, priority=job_priority(uid))
+        bot.reply_to(message, queued_text(f"📦 Install of <code>{html_escape(module_name)}</code>", ahead))
     except Exception as e:
         logger.error(f"Error in installmodule command: {e}")
         bot.reply_to(message, "❌ Failed to install module. Please try again.")
 
 @bot.message_handler(commands=['uninstallmodule'])
+@track_handler('uninstall_module_command')
 def uninstall_module_command(message):
     if message.from_user.id not in ADMIN_IDS:
         return
@@ -937,6 +5462,7 @@ This will remove the module for all users!
         bot.reply_to(message, "❌ Failed to uninstall module. Please try again.")
 
 @bot.message_handler(commands=['listmodules'])
+@track_handler('list_modules_command')
 def list_modules_command(message):
     try:
         modules_list = list_installed_modules()
@@ -947,6 +5473,7 @@ def list_modules_command(message):
 
 # Admin commands
 @bot.message_handler(commands=['setlimit', 'adduser'])
+@track_handler('admin_set_limit')
 def admin_set_limit(message):
     if message.from_user.id not in ADMIN_IDS:
         return
@@ -969,7 +5496,7 @@ def admin_set_limit(message):
         limit = int(parts[2])
         
         user_limits[str(uid)] = limit
-        known_users.add(int(uid))
+        register_user(int(uid))
         save_data()
         
         bot.reply_to(message, f"✅ Set user {uid} limit to {limit}")
@@ -978,6 +5505,7 @@ def admin_set_limit(message):
         bot.reply_to(message, "❌ Failed to set limit. Usage: /setlimit <user_id> <limit>")
 
 @bot.message_handler(commands=['stats'])
+@track_handler('admin_stats')
 def admin_stats(message):
     if message.from_user.id not in ADMIN_IDS:
         return
@@ -985,7 +5513,7 @@ def admin_stats(message):
     try:
         total_users = len(known_users)
         active_users = sum(1 for uid in known_users if get_uploaded_count(uid) > 0)
-        running_scripts = len(processes)
+        running_scripts = len(processes) + len(cluster_scripts)
         cpu, mem, disk, uptime = get_server_stats()
         
         stats_text = f"""
@@ -999,13 +5527,21 @@ def admin_stats(message):
 CPU: {cpu}%
 Memory: {mem}%
 Disk: {disk}%
+🧹 Reclaimed since start: {sum(janitor_reclaimed.values()) / 1024 / 1024:.1f} MB
 """
+        if cluster_enabled():
+            stats_text += "\n<b>🛰️ Workers</b>\n"
+            for worker_id, info in sorted(workers.items()):
+                stats_text += f"{worker_id}: {info['running']}/{info['capacity']} scripts, {info['memory_percent']}% memory\n"
+            if not workers:
+                stats_text += "No workers connected\n"
         bot.reply_to(message, stats_text)
     except Exception as e:
         logger.error(f"Error getting stats: {e}")
         bot.reply_to(message, "❌ Failed to get stats. Please try again.")
 
 @bot.message_handler(commands=['broadcast'])
+@track_handler('broadcast_text')
 def broadcast_text(message):
     if message.from_user.id not in ADMIN_IDS:
         return
@@ -1023,35 +5559,12 @@ def broadcast_text(message):
                     return bot.reply_to(message, "❌ Original broadcast message not found.")
                 
                 msg = original_msg.text.replace("/broadcast", "").strip()
-                parse_mode = "HTML" if re.search(r'<[a-z][\s\S]*>', msg) else None
-                
-                markup = build_broadcast_buttons(buttons_data)
                 
-                sent = 0
-                failed = 0
-                for uid in known_users:
-                    try:
-                        bot.send_message(uid, f"📢 <b>Announcement</b>\n\n{msg}", 
-                                       parse_mode=parse_mode, 
-                                       reply_markup=markup)
-                        sent += 1
-                        time.sleep(0.1)  # Rate limiting
-                    except Exception as e:
-                        logger.error(f"Error broadcasting to {uid}: {e}")
-                        failed += 1
+                def done(broadcast_id, counts):
+                    bot.reply_to(message, f"✅ Broadcast with buttons complete!\n{format_broadcast_result(broadcast_id, counts)}")
                 
-                # Save to history
-                broadcast_history.append({
-                    'type': 'text',
-                    'content': msg,
-                    'buttons': buttons_data,
-                    'date': datetime.datetime.now().isoformat(),
-                    'sent': sent,
-                    'failed': failed
-                })
-                save_data()
-                
-                return bot.reply_to(message, f"✅ Broadcast with buttons complete!\nSent: {sent}\nFailed: {failed}")
+                ahead = deliver_broadcast('text', {'content': msg, 'buttons': buttons_data}, done)
+                return bot.reply_to(message, queued_text("📢 Broadcast", ahead))
             except json.JSONDecodeError:
                 return bot.reply_to(message, "❌ Invalid JSON format for buttons. Please try again.")
         
@@ -1081,7 +5594,161 @@ def broadcast_text(message):
         logger.error(f"Error in broadcast: {e}")
         bot.reply_to(message, "❌ Failed to broadcast. Please try again.")
 
+@bot.message_handler(commands=['user'])
+@track_handler('user_command')
+def user_command(message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    try:
+        args = message.text.split()[1:]
+        if len(args) != 1 or not args[0].lstrip('-').isdigit():
+            return bot.reply_to(message, """
+❌ <b>Usage:</b> /user user_id
+
+<u>Example:</u>
+/user 123456789
+
+<u>Note:</u>
+- Browse users with the 📋 List Users button
+""")
+        
+        user_id = int(args[0])
+        running = sorted(k.split(':', 1)[1] for k in processes.user_keys(user_id) + cluster_scripts.user_keys(user_id))
+        scheduled = sorted(k.split(':', 1)[1] for k in schedules.user_keys(user_id))
+        last = get_user_deliveries(user_id, limit=1)
+        usage = get_user_day_usage(user_id)
+        # The sampler walks every user's files each METER_DISK_INTERVAL; only
+        # fall back to walking this one before its first pass
+        storage = meter_disk.get(user_id, 0) / (1024 * 1024) if meter_disk_checked else get_storage_usage(user_id)
+        
+        lines = [
+            f"<b>👤 User <code>{user_id}</code></b>" + ("" if user_id in known_users else " (not registered)"),
+            "",
+            f"Limit: {get_limit(user_id)} | Uploaded: {get_uploaded_count(user_id)} | Storage: {storage:.2f} MB",
+            f"Running ({len(running)}): {html_escape(', '.join(running)) or '-'}",
+            f"Scheduled ({len(scheduled)}): {html_escape(', '.join(scheduled)) or '-'}",
+            f"Last day: {format_usage(usage)}",
+        ]
+        if last:
+            lines.append(f"Last broadcast: #{last[0]['broadcast_id']} {DELIVERY_LABELS[last[0]['status']]}")
+        lines.append(f"\nChange limit: /setlimit {user_id} n")
+        bot.reply_to(message, "\n".join(lines))
+    except Exception as e:
+        logger.error(f"Error in user command: {e}")
+        bot.reply_to(message, "❌ Failed to look up user. Please try again.")
+
+@bot.message_handler(commands=['delivery'])
+@track_handler('delivery_command')
+def delivery_command(message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    try:
+        args = message.text.split()[1:]
+        if not args or not all(a.lstrip('-').isdigit() for a in args):
+            return bot.reply_to(message, """
+❌ <b>Usage:</b> /delivery user_id [broadcast_id]
+
+<u>Example:</u>
+/delivery 123456789
+/delivery 123456789 42
+
+<u>Note:</u>
+- Without a broadcast id shows the user's last 10 broadcasts
+""")
+        
+        user_id = int(args[0])
+        deliveries = get_user_deliveries(user_id, int(args[1]) if len(args) > 1 else None)
+        if not deliveries:
+            return bot.reply_to(message, f"📭 No delivery records for user {user_id}.")
+        
+        lines = [f"<b>📬 Deliveries to {user_id}</b>"]
+        for d in deliveries:
+            date = datetime.datetime.fromtimestamp(d['created']).strftime("%Y-%m-%d %H:%M")
+            reason = f" ({html_escape(d['reason'])})" if d['reason'] else ""
+            lines.append(f"#{d['broadcast_id']} {d['type']} {date}: <b>{DELIVERY_LABELS[d['status']]}</b>{reason}")
+        bot.reply_to(message, "\n".join(lines))
+    except Exception as e:
+        logger.error(f"Error in delivery command: {e}")
+        bot.reply_to(message, "❌ Failed to look up deliveries. Please try again.")
+
+@bot.message_handler(commands=['editbroadcast'])
+@track_handler('edit_broadcast_command')
+def edit_broadcast_command(message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    try:
+        parts = message.text.split(None, 2)
+        if len(parts) < 3 or not parts[1].isdigit():
+            return bot.reply_to(message, """
+❌ <b>Usage:</b> /editbroadcast broadcast_id new text
+
+<u>Example:</u>
+/editbroadcast 42 Server maintenance in 2 hours!
+
+<u>Note:</u>
+- Edits the message every user already received
+- For image broadcasts the text replaces the caption
+- Buttons are kept; QR broadcasts can't be edited
+""")
+        
+        broadcast_id = int(parts[1])
+        item = get_broadcast(broadcast_id)
+        if not item:
+            return bot.reply_to(message, f"❌ Broadcast #{broadcast_id} not found.")
+        if item['type'] == 'text':
+            payload = dict(item['payload'], content=parts[2])
+        elif item['type'] == 'image':
+            payload = dict(item['payload'], caption=parts[2])
+        else:
+            return bot.reply_to(message, f"❌ {item['type']} broadcasts can't be edited, only deleted.")
+        
+        action_id = create_broadcast_action(broadcast_id, 'edit', message.from_user.id, payload)
+        bot.reply_to(message, queued_text(f"✏️ Edit of broadcast #{broadcast_id}", submit_broadcast_action(action_id)))
+    except Exception as e:
+        logger.error(f"Error editing broadcast: {e}")
+        bot.reply_to(message, "❌ Failed to edit broadcast. Please try again.")
+
+@bot.message_handler(commands=['deletebroadcast'])
+@track_handler('delete_broadcast_command')
+def delete_broadcast_command(message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    try:
+        args = message.text.split()[1:]
+        if len(args) != 1 or not args[0].isdigit():
+            return bot.reply_to(message, """
+❌ <b>Usage:</b> /deletebroadcast broadcast_id
+
+<u>Example:</u>
+/deletebroadcast 42
+
+<u>Note:</u>
+- Deletes the message from every user's chat
+- Telegram only allows deleting messages younger than 48 hours
+""")
+        
+        broadcast_id = int(args[0])
+        item = get_broadcast(broadcast_id)
+        if not item:
+            return bot.reply_to(message, f"❌ Broadcast #{broadcast_id} not found.")
+        
+        markup = types.InlineKeyboardMarkup()
+        markup.add(
+            types.InlineKeyboardButton("Yes, delete", callback_data=f"broadcast_delete:{broadcast_id}"),
+            types.InlineKeyboardButton("Cancel", callback_data='main_menu')
+        )
+        bot.reply_to(message, f"🗑 Delete broadcast #{broadcast_id} ({item['sent']} delivered) from every chat?",
+                     reply_markup=markup)
+    except Exception as e:
+        logger.error(f"Error deleting broadcast: {e}")
+        bot.reply_to(message, "❌ Failed to delete broadcast. Please try again.")
+
 @bot.message_handler(commands=['broadcastimage'])
+@track_handler('broadcast_image')
 def broadcast_image(message):
     if message.from_user.id not in ADMIN_IDS:
         return
@@ -1113,6 +5780,7 @@ def broadcast_image(message):
         bot.reply_to(message, "❌ Failed to broadcast image. Please try again.")
 
 @bot.message_handler(commands=['maintenance'])
+@track_handler('maintenance_mode')
 def maintenance_mode(message):
     if message.from_user.id not in ADMIN_IDS:
         return
@@ -1146,6 +5814,7 @@ def maintenance_mode(message):
         bot.reply_to(message, "❌ Failed to set maintenance mode. Please try again.")
 
 @bot.message_handler(commands=['whitelist'])
+@track_handler('whitelist_user')
 def whitelist_user(message):
     if message.from_user.id not in ADMIN_IDS:
         return
@@ -1170,8 +5839,231 @@ def whitelist_user(message):
         logger.error(f"Error adding to whitelist: {e}")
         bot.reply_to(message, "❌ Failed to add to whitelist. Usage: /whitelist <user_id>")
 
+@bot.message_handler(commands=['profile'])
+@track_handler('profile_command')
+def profile_command(message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    try:
+        parts = message.text.split()
+        action = parts[1].lower() if len(parts) > 1 else ''
+        
+        if action == 'start':
+            seconds = int(parts[2]) if len(parts) > 2 else 60
+            if not start_profiler(seconds):
+                return bot.reply_to(message, "⚠️ Profiler is already running. Use /profile stop")
+            return bot.reply_to(message, f"🔬 Profiling all threads for up to {min(seconds, PROFILE_MAX_SECONDS)}s. Use /profile stop or /profile dump")
+        
+        if action in ('stop', 'dump'):
+            if action == 'stop':
+                stop_profiler()
+            collapsed, samples = get_collapsed_stacks()
+            if not samples:
+                return bot.reply_to(message, "❌ No profile data. Start one with /profile start")
+            
+            profile_file = io.BytesIO(collapsed.encode('utf-8'))
+            profile_file.name = f"profile_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.collapsed"
+            bot.send_document(message.chat.id, profile_file, caption="🔥 Collapsed stacks (flamegraph.pl / speedscope)")
+            return bot.send_message(message.chat.id, summarize_profile(samples))
+        
+        running = profiler['thread'] is not None and profiler['thread'].is_alive()
+        bot.reply_to(message, f"""
+❌ <b>Usage:</b> /profile start [seconds] | stop | dump
+
+<u>Example:</u>
+/profile start 30
+
+<u>Note:</u>
+- Samples every thread every {int(PROFILE_INTERVAL * 1000)}ms
+- Profiler is currently {'running' if running else 'stopped'}
+""")
+    except Exception as e:
+        logger.error(f"Error in profile command: {e}")
+        bot.reply_to(message, "❌ Failed to run profiler. Usage: /profile <start [seconds]|stop|dump>")
+
+@bot.message_handler(commands=['admission'])
+@track_handler('admission_command')
+def admission_command(message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    try:
+        parts = message.text.split()
+        if len(parts) >= 2 and parts[1].lower() == 'reserve':
+            if len(parts) < 3 or not parts[2].isdigit():
+                return bot.reply_to(message, """
+❌ <b>Usage:</b> /admission reserve &lt;MB&gt;
+
+<u>Example:</u>
+/admission reserve 512
+
+<u>Note:</u>
+- Scripts only start if this much memory stays free for the bot
+- Launches that don't fit wait in a queue
+""")
+            with admission_lock:
+                admission['reserve'] = int(parts[2]) * 1024 * 1024
+            save_admission()
+            admission_wake.set()  # a smaller reserve may let queued launches start
+            return bot.reply_to(message, f"✅ Keeping {parts[2]} MB free for the bot from now on.")
+        
+        with admission_lock:
+            total, free, bot_rss, load = get_host_capacity()
+            queue = list(admission_queue)
+            settling = len(admission_recent)
+        now = time.time()
+        lines = [
+            "🧮 <b>Admission control</b>\n",
+            f"Memory: {format_mb(total)} total, {format_mb(max(0, free))} free for new scripts",
+            f"Reserved for the bot: {format_mb(admission['reserve'])} (bot uses {format_mb(bot_rss)})",
+            f"Load: {load:.2f} per CPU (launches wait above {ADMISSION_MAX_LOAD})",
+            f"Recently started, still settling: {settling}",
+            f"\n<u>Queue ({len(queue)}):</u>"
+        ]
+        for position, entry in enumerate(queue[:10], 1):
+            lines.append(f"{position}. <code>{html_escape(entry['filename'])}</code> (user {entry['uid']}) "
+                         f"~{format_mb(get_memory_estimate(entry['key']))}, waiting {format_time(now - entry['queued'])}")
+        if not queue:
+            lines.append("Empty")
+        elif len(queue) > 10:
+            lines.append(f"... and {len(queue) - 10} more")
+        lines.append("\n<u>Usage:</u> /admission reserve &lt;MB&gt;")
+        bot.reply_to(message, "\n".join(lines))
+    except Exception as e:
+        logger.error(f"Error showing admission state: {e}")
+        bot.reply_to(message, "❌ Failed to read admission state. Please try again.")
+
+@bot.message_handler(commands=['threads'])
+@track_handler('threads_command')
+def threads_command(message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    try:
+        dump = dump_threads()
+        if len(dump) > 4096:
+            dump_file = io.BytesIO(dump.encode('utf-8'))
+            dump_file.name = "threads.txt"
+            return bot.send_document(message.chat.id, dump_file, caption="🧵 Thread dump")
+        bot.send_message(message.chat.id, dump)
+    except Exception as e:
+        logger.error(f"Error dumping threads: {e}")
+        bot.reply_to(message, "❌ Failed to dump threads. Please try again.")
+
+@bot.message_handler(commands=['top'])
+@track_handler('top_command')
+def top_command(message):
+    if MAINTENANCE_MODE and message.from_user.id not in WHITELIST:
+        return
+    
+    try:
+        uid = message.chat.id
+        args = message.text.split()[1:]
+        sort = 'mem' if 'mem' in args else 'cpu'
+        show_all = 'all' in args and message.from_user.id in ADMIN_IDS
+        
+        keys = list(processes) if show_all else [k for k in processes if k.startswith(f"{uid}:")]
+        rows = format_top(keys, sort=sort, show_user=show_all)
+        if not rows:
+            return bot.reply_to(message, f"""
+📊 No samples yet.
+
+<u>Note:</u>
+- Only running scripts are shown
+- Samples are taken every {RESOURCE_SAMPLE_INTERVAL}s, so a script just started shows up shortly
+""")
+        
+        title = "All Scripts" if show_all else "Your Scripts"
+        header = f"<b>📊 {title} by {'Memory' if sort == 'mem' else 'CPU'}</b>\n"
+        footer = "\n<u>Usage:</u> /top [mem]" + (" [all]" if message.from_user.id in ADMIN_IDS else "")
+        bot.reply_to(message, "\n".join([header] + rows + [footer]))
+    except Exception as e:
+        logger.error(f"Error in top command: {e}")
+        bot.reply_to(message, "❌ Failed to show script resources. Please try again.")
+
+@bot.message_handler(commands=['usage'])
+@track_handler('usage_command')
+def usage_command(message):
+    if MAINTENANCE_MODE and message.from_user.id not in WHITELIST:
+        return
+    
+    try:
+        args = message.text.split()[1:]
+        is_admin = message.from_user.id in ADMIN_IDS
+        period = next((a for a in args if a in USAGE_PERIODS), 'day')
+        
+        if args and args[0] == 'top' and is_admin:
+            sort = next((a for a in args if a in USAGE_SORT_KEYS), 'cpu')
+            users = get_usage(period)
+            ranked = sorted(users.items(), key=lambda item: item[1][USAGE_SORT_KEYS[sort]], reverse=True)[:15]
+            if not ranked:
+                return bot.reply_to(message, f"📭 No usage recorded in the last {period}.")
+            lines = [f"<b>📈 Top consumers by {sort}, last {period}</b>\n"]
+            for rank, (user, totals) in enumerate(ranked, 1):
+                lines.append(f"{rank}. <code>{user}</code> (limit {get_limit(user)})\n   {format_usage(totals)}")
+            lines.append("\n<u>Usage:</u> /usage top [cpu|mem|disk] [day|week|month|year]")
+            return bot.reply_to(message, "\n".join(lines))
+        
+        uid = message.chat.id
+        if is_admin and args and args[0].lstrip('-').isdigit():
+            uid = int(args[0])
+        
+        lines = ["<b>📈 Resource Usage</b>" + (f" of <code>{uid}</code>" if uid != message.chat.id else ""), ""]
+        for name in ('day', 'week', 'month'):
+            totals = get_usage(name, uid).get(uid, [0.0, 0.0, 0.0])
+            lines.append(f"<b>Last {name}:</b>\n{format_usage(totals)}")
+        lines.append(f"\nCPU per hour (24h): {sparkline(get_hourly_cpu(uid))}")
+        lines.append(f"Running: {get_running_count(uid)}/{get_limit(uid)} | Storage: {get_storage_usage(uid):.2f} MB")
+        lines.append(f"""
+<u>Note:</u>
+- CPU and memory are sampled every {RESOURCE_SAMPLE_INTERVAL}s while scripts run here
+- GB·h is the average size times the hours it was held""" + ("""
+- Admins: /usage user_id, /usage top [cpu|mem|disk] [day|week|month|year]""" if is_admin else ""))
+        bot.reply_to(message, "\n".join(lines))
+    except Exception as e:
+        logger.error(f"Error in usage command: {e}")
+        bot.reply_to(message, "❌ Failed to show usage. Please try again.")
+
+@bot.message_handler(commands=['qr'])
+@track_handler('qr_command')
+def qr_command(message):
+    if MAINTENANCE_MODE and message.from_user.id not in WHITELIST:
+        return
+    
+    try:
+        uid = message.chat.id
+        data = message.text.split(None, 1)[1].strip() if len(message.text.split(None, 1)) > 1 else ""
+        
+        if data == 'invites' and message.from_user.id in ADMIN_IDS:
+            def done(broadcast_id, counts):
+                bot.reply_to(message, f"✅ Invite QR broadcast complete!\n{format_broadcast_result(broadcast_id, counts)}")
+            
+            ahead = deliver_broadcast('qr', {'content': 'invite links'}, done)
+            return bot.reply_to(message, queued_text("🔳 Invite QR broadcast", ahead))
+        
+        if len(data) > QR_MAX_DATA:
+            return bot.reply_to(message, f"❌ Text is too long for a QR code (max {QR_MAX_DATA} characters).")
+        
+        caption = None
+        if not data:
+            data = get_invite_link(uid)
+            caption = f"🔗 Your personal invite link:\n{data}"
+        
+        png = create_qr_code(data)
+        if not png:
+            return bot.reply_to(message, "❌ Failed to create QR code. Please try again.")
+        bot.send_photo(uid, png, caption=caption, reply_to_message_id=message.message_id)
+    except Exception as e:
+        logger.error(f"Error in qr command: {e}")
+        bot.reply_to(message, "❌ Failed to create QR code. Please try again.")
+
 # Callback handlers
+def callback_route(call):
+    return 'callback:' + call.data.split(':', 1)[0]
+
 @bot.callback_query_handler(func=lambda call: True)
+@track_handler(callback_route)
 def callback_handler(call):
     try:
         uid = call.from_user.id
@@ -1243,6 +6135,13 @@ def callback_handler(call):
         elif data == 'admin_stats' and uid in ADMIN_IDS:
             admin_stats(call.message)
         
+        elif data == 'admin_profiler' and uid in ADMIN_IDS:
+            bot.send_message(uid, "Send /profile start [seconds], then /profile stop to get a flamegraph file and summary")
+        
+        elif data == 'admin_threads' and uid in ADMIN_IDS:
+            call.message.from_user = call.from_user
+            threads_command(call.message)
+        
         elif data == 'admin_broadcast_menu' and uid in ADMIN_IDS:
             bot.edit_message_text(
                 chat_id=uid,
@@ -1256,22 +6155,69 @@ def callback_handler(call):
         elif data == 'image_broadcast' and uid in ADMIN_IDS:
             bot.send_message(uid, "Reply to an image with /broadcastimage command")
         
-        elif data == 'broadcast_history' and uid in ADMIN_IDS:
-            if not broadcast_history:
+        elif (data == 'broadcast_history' or data.startswith('broadcast_history:')) and uid in ADMIN_IDS:
+            before = int(data.split(':', 1)[1]) if ':' in data else None
+            broadcasts, has_more = list_broadcasts(before)
+            if not broadcasts:
                 bot.send_message(uid, "No broadcast history yet.")
                 return
             
             history_text = ["<b>📋 Broadcast History</b>"]
-            for i, item in enumerate(reversed(broadcast_history[-10:]), 1:
-                date = datetime.datetime.fromisoformat(item['date']).strftime("%Y-%m-%d %H:%M")
+            markup = types.InlineKeyboardMarkup()
+            for item in broadcasts:
+                date = datetime.datetime.fromtimestamp(item['created']).strftime("%Y-%m-%d %H:%M")
+                counts = f"Sent: {item['sent']} | Failed: {item['failed']} | Blocked: {item['blocked']}"
+                payload = item['payload']
                 
                 if item['type'] == 'text':
-                    preview = item['content'][:30] + ("..." if len(item['content']) > 30 else "")
-                    history_text.append(f"{i}. 📝 {date}\n{preview}\nSent: {item['sent']} | Failed: {item['failed']}")
+                    preview = payload['content'][:30] + ("..." if len(payload['content']) > 30 else "")
+                    history_text.append(f"#{item['id']} 📝 {date}\n{html_escape(preview)}\n{counts}")
+                elif item['type'] == 'image':
+                    history_text.append(f"#{item['id']} 🖼️ {date}\nCaption: {html_escape(payload['caption'])}\n{counts}")
                 else:
-                    history_text.append(f"{i}. 🖼️ {date}\nCaption: {item['caption']}\nSent: {item['sent']} | Failed: {item['failed']}")
+                    history_text.append(f"#{item['id']} 🔳 {date}\n{html_escape(payload.get('content', item['type']))}\n{counts}")
+                
+                if item['failed'] and (item['type'] != 'image' or 'file_id' in payload):
+                    markup.add(types.InlineKeyboardButton(f"🔁 Retry #{item['id']} ({item['failed']} failed)",
+                                                          callback_data=f"broadcast_retry:{item['id']}"))
+            
+            if has_more:
+                markup.add(types.InlineKeyboardButton("⬅️ Older", callback_data=f"broadcast_history:{broadcasts[-1]['id']}"))
+            bot.send_message(uid, "\n\n".join(history_text), reply_markup=markup)
+        
+        elif data.startswith('detach:'):
+            filename = data.split(':', 1)[1]
+            if detach_script(f"{uid}:{filename}"):
+                bot.answer_callback_query(call.id, f"Detached from {filename}")
+                bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
+        
+        elif data.startswith('searchlog:'):
+            token = data.split(':', 1)[1]
+            if log_searches.get(token, {}).get('uid') not in (None, uid):
+                return
+            text, markup = render_log_search(token)
+            bot.send_message(uid, text, reply_markup=markup)
+        
+        elif data.startswith('broadcast_delete:') and uid in ADMIN_IDS:
+            broadcast_id = int(data.split(':', 1)[1])
+            action_id = create_broadcast_action(broadcast_id, 'delete', uid)
+            bot.edit_message_text(
+                chat_id=call.message.chat.id,
+                message_id=call.message.message_id,
+                text=queued_text(f"🗑 Delete of broadcast #{broadcast_id}", submit_broadcast_action(action_id)))
+        
+        elif data.startswith('broadcast_retry:') and uid in ADMIN_IDS:
+            broadcast_id = int(data.split(':', 1)[1])
+            item = get_broadcast(broadcast_id)
+            recipients = get_failed_recipients(broadcast_id)
+            if not item or not recipients:
+                return bot.send_message(uid, f"✅ Broadcast #{broadcast_id} has no failed recipients to retry.")
             
-            bot.send_message(uid, "\n\n".join(history_text))
+            def done(broadcast_id, counts):
+                bot.send_message(uid, f"✅ Retry complete!\n{format_broadcast_result(broadcast_id, counts)}")
+            
+            ahead = deliver_broadcast(item['type'], item['payload'], done, recipients=recipients, broadcast_id=broadcast_id)
+            bot.send_message(uid, queued_text(f"🔁 Retry of {len(recipients)} recipients", ahead))
         
         elif data == 'user_management' and uid in ADMIN_IDS:
             bot.edit_message_text(
@@ -1290,13 +6236,16 @@ def callback_handler(call):
             bot.send_message(uid, "Send /setlimit <user_id> <limit> to change user limits")
         
         elif data == 'list_users' and uid in ADMIN_IDS:
-            users_list = ["<b>👥 Registered Users</b>"]
-            for user in known_users:
-                limit = get_limit(user)
-                running = get_running_count(user)
-                users_list.append(f"• ID: {user} | Limit: {limit} | Running: {running}")
-            
-            bot.send_message(uid, "\n".join(users_list))
+            text, markup = render_users_page()
+            bot.send_message(uid, text, reply_markup=markup)
+        
+        elif data.startswith('users:') and uid in ADMIN_IDS:
+            parts = data.split(':')
+            user_filter = parts[1] if parts[1] in USER_FILTERS else 'all'
+            cursor = int(parts[3]) if len(parts) == 4 else None
+            text, markup = render_users_page(user_filter, after=cursor if parts[2:3] == ['a'] else None,
+                                             before=cursor if parts[2:3] == ['b'] else None)
+            bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
         
         elif data.startswith('add_buttons:') and uid in ADMIN_IDS:
             msg = data.split(':', 1)[1]
@@ -1310,33 +6259,18 @@ def callback_handler(call):
         
         elif data.startswith('broadcast_now:') and uid in ADMIN_IDS:
             msg = data.split(':', 1)[1]
-            parse_mode = "HTML" if re.search(r'<[a-z][\s\S]*>', msg) else None
-            
-            sent = 0
-            failed = 0
-            for uid in known_users:
-                try:
-                    bot.send_message(uid, f"📢 <b>Announcement</b>\n\n{msg}", parse_mode=parse_mode)
-                    sent += 1
-                    time.sleep(0.1)  # Rate limiting
-                except Exception as e:
-                    logger.error(f"Error broadcasting to {uid}: {e}")
-                    failed += 1
             
-            # Save to history
-            broadcast_history.append({
-                'type': 'text',
-                'content': msg,
-                'date': datetime.datetime.now().isoformat(),
-                'sent': sent,
-                'failed': failed
-            })
-            save_data()
+            def done(broadcast_id, counts):
+                bot.edit_message_text(
+                    chat_id=call.message.chat.id,
+                    message_id=call.message.message_id,
+                    text=f"✅ Broadcast complete!\n{format_broadcast_result(broadcast_id, counts)}")
             
+            ahead = deliver_broadcast('text', {'content': msg}, done)
             bot.edit_message_text(
                 chat_id=call.message.chat.id,
                 message_id=call.message.message_id,
-                text=f"✅ Broadcast complete!\nSent: {sent}\nFailed: {failed}")
+                text=queued_text("📢 Broadcast", ahead))
         
         elif data.startswith('add_buttons_image:') and uid in ADMIN_IDS:
             caption = data.split(':', 1)[1]
@@ -1356,35 +6290,18 @@ def callback_handler(call):
             if not (original_msg and original_msg.photo):
                 return bot.send_message(uid, "❌ Original image not found.")
             
-            # Download the image
-            file_info = bot.get_file(original_msg.photo[-1].file_id)
-            downloaded_file = bot.download_file(file_info.file_path)
-            
-            sent = 0
-            failed = 0
-            for uid in known_users:
-                try:
-                    bot.send_photo(uid, downloaded_file, caption=caption)
-                    sent += 1
-                    time.sleep(0.1)  # Rate limiting
-                except Exception as e:
-                    logger.error(f"Error broadcasting image to {uid}: {e}")
-                    failed += 1
-            
-            # Save to history
-            broadcast_history.append({
-                'type': 'image',
-                'caption': caption,
-                'date': datetime.datetime.now().isoformat(),
-                'sent': sent,
-                'failed': failed
-            })
-            save_data()
+            def done(broadcast_id, counts):
+                bot.edit_message_text(
+                    chat_id=call.message.chat.id,
+                    message_id=call.message.message_id,
+                    text=f"✅ Image broadcast complete!\n{format_broadcast_result(broadcast_id, counts)}")
             
+            # Telegram file ids can be re-sent by the bot, so the image is never downloaded
+            ahead = deliver_broadcast('image', {'file_id': original_msg.photo[-1].file_id, 'caption': caption}, done)
             bot.edit_message_text(
                 chat_id=call.message.chat.id,
                 message_id=call.message.message_id,
-                text=f"✅ Image broadcast complete!\nSent: {sent}\nFailed: {failed}")
+                text=queued_text("🖼 Image broadcast", ahead))
     
     except Exception as e:
         logger.error(f"Error in callback handler: {e}")
@@ -1392,6 +6309,7 @@ def callback_handler(call):
 
 # Error handler
 @bot.message_handler(func=lambda message: True)
+@track_handler('unknown_command')
 def unknown_command(message):
     if message.text.startswith('/'):
         bot.reply_to(message, "❌ Unknown command. Use /help for available commands.")
@@ -1401,8 +6319,21 @@ def unknown_command(message):
 # Start the bot
 if __name__ == '__main__':
     logger.info("🤖 ULTIMINE Hosting Bot is starting...")
+    load_data()
+    start_metrics_server()
+    start_resource_sampler()
+    start_janitor()
+    start_log_indexer()
+    start_admission_controller()
+    if cluster_enabled():
+        start_cluster()
     try:
-        bot.infinity_polling()
+        if HA_ENABLED:
+            run_with_failover()
+        else:
+            start_scheduler()
+            resume_broadcast_actions()
+            bot.infinity_polling()
     except Exception as e:
         logger.error(f"Bot crashed: {e}")
         raise
\ No newline at end of file
@@ -0,0 +1,211 @@
+"""Worker agent for a sharded ULTIMINE Hosting deployment.
+
+Runs hosted scripts on behalf of the control-plane bot (ultiminehosting.py
+started with CLUSTER_LISTEN). Each worker keeps its own DATA_DIR, answers
+start/stop/getlog/delete RPCs and reports a heartbeat with its capacity and
+running scripts. Modules installed on the control plane are mirrored into
+the worker's own MODULES_DIR: the heartbeat reply lists them, and a start
+whose modules are still missing launches once they are installed. Control plane and workers sign every RPC with the shared
+CLUSTER_SECRET. Several workers can share one host:
+
+    export CLUSTER_SECRET=<same value as the control plane>
+    python worker_agent.py --id w1 --listen unix:/tmp/w1.sock --control 127.0.0.1:7000 --data-dir /srv/w1
+    python worker_agent.py --id w2 --listen unix:/tmp/w2.sock --control 127.0.0.1:7000 --data-dir /srv/w2
+"""
+import argparse
+import base64
+import hashlib
+import json
+import os
+import datetime
+import re
+import threading
+import time
+
+DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+
+module_lock = threading.Lock()
+failed_modules = set()  # not retried on every heartbeat; a start request tries them again
+
+
+def missing_modules(hosting, wanted, retry_failed=False):
+    if not isinstance(wanted, list):
+        return []
+    return [m for m in wanted if isinstance(m, str) and hosting.REQUIREMENT_RE.match(m)
+            and m not in hosting.installed_modules and (retry_failed or m not in failed_modules)]
+
+
+def install_modules(hosting, wanted, retry_failed=False):
+    """Install the modules of the control plane this worker lacks, in one pip run if possible"""
+    with module_lock:
+        missing = missing_modules(hosting, wanted, retry_failed)
+        if not missing:
+            return
+        if hosting.run_pip_install(missing):
+            results = {name: True for name in missing}
+        else:
+            results = {name: hosting.run_pip_install([name]) for name in missing}
+        for name, ok in results.items():
+            if ok:
+                failed_modules.discard(name)
+                hosting.installed_modules[name] = {'installed_by': 'control plane', 'date': datetime.datetime.now().isoformat()}
+            else:
+                failed_modules.add(name)
+                hosting.logger.error(f"Could not install module {name} on this worker")
+        hosting.save_data()
+
+
+def is_inner_path(path):
+    """True if path is relative and can't climb out of the directory it is joined to"""
+    return isinstance(path, str) and not os.path.isabs(path) and '..' not in re.split(r'[\\/]', path)
+
+
+def validate_request(hosting, request):
+    """Return an error if the request's uid, filename or project could reach outside the user's files"""
+    uid = request.get('uid')
+    filename = request.get('filename')
+    project = request.get('project')
+    if not isinstance(uid, str) or not uid.isdigit():
+        return "Invalid uid"
+    if not isinstance(filename, str) or not filename or os.path.basename(filename) != filename:
+        return "Invalid filename"
+    if project is not None:
+        if not isinstance(project, dict) or project.get('name') != filename:
+            return "Invalid project"
+        archive = project.get('archive')
+        ext = hosting.get_archive_ext(archive) if isinstance(archive, str) else None
+        if not ext or archive != filename + ext:
+            return "Invalid project archive"
+        if not isinstance(project.get('digest'), str) or not DIGEST_RE.match(project['digest']):
+            return "Invalid project digest"
+        if not is_inner_path(project.get('entry')) or not is_inner_path(project.get('root') or ''):
+            return "Invalid project entry"
+    elif hosting.sanitize_target(uid, filename) != filename:
+        return "Invalid filename"
+    if request.get('op') == 'start' and not isinstance(request.get('digest'), str):
+        return "Invalid digest"
+    return None
+
+
+def handle_request(hosting, request):
+    op = request.get('op')
+    if op in ('start', 'stop', 'getlog', 'delete'):
+        error = validate_request(hosting, request)
+        if error:
+            return {'ok': False, 'error': error}
+    uid = request.get('uid')
+    filename = request.get('filename')
+    key = f"{uid}:{filename}"
+    log_path = os.path.join(hosting.LOGS_DIR, f"{uid}_{filename}.log")
+
+    if op == 'start':
+        if key in hosting.processes:
+            return {'ok': True, 'already_running': True}
+        user_dir = hosting.ensure_user_dir(uid)
+        project = request.get('project')
+        if project:
+            stored = hosting.get_project(uid, project['name'])
+            target = os.path.join(user_dir, project['archive'])
+            current = stored is not None and stored['digest'] == request['digest'] and os.path.exists(target)
+        else:
+            target = os.path.join(user_dir, filename)
+            current = False
+            if os.path.exists(target):
+                with open(target, 'rb') as f:
+                    current = hashlib.sha256(f.read()).hexdigest() == request['digest']
+        if not current:
+            if 'content' not in request:
+                return {'ok': False, 'need_content': True}
+            with open(target, 'wb') as f:
+                f.write(base64.b64decode(request['content']))
+            if project:
+                with open(os.path.join(user_dir, project['name'] + hosting.PROJECT_SUFFIX), 'w') as f:
+                    json.dump(project, f)
+        if missing_modules(hosting, request.get('modules'), retry_failed=True):
+            def install_then_launch():
+                install_modules(hosting, request['modules'], retry_failed=True)
+                error = hosting.launch_script(uid, filename, project)
+                if error:
+                    hosting.logger.error(f"Could not start {key} after installing its modules: {error}")
+            threading.Thread(target=install_then_launch, name=f"install:{key}", daemon=True).start()
+            return {'ok': True, 'installing_modules': True}
+        error = hosting.launch_script(uid, filename, project)
+        return {'ok': error is None, 'error': error}
+
+    if op == 'stop':
+        runtime = hosting.stop_script(key)
+        return {'ok': True, 'runtime': runtime, 'was_running': runtime is not None}
+
+    if op == 'getlog':
+        if not os.path.exists(log_path):
+            return {'ok': False, 'error': 'No log'}
+        with open(log_path, 'rb') as f:
+            f.seek(max(0, os.path.getsize(log_path) - hosting.CLUSTER_MAX_LOG_BYTES))
+            return {'ok': True, 'content': base64.b64encode(f.read()).decode('ascii')}
+
+    if op == 'delete':
+        hosting.stop_script(key)
+        if not hosting.delete_project(uid, filename):
+            path = os.path.join(hosting.get_user_dir(uid), filename)
+            if os.path.exists(path):
+                os.remove(path)
+        if os.path.exists(log_path):
+            os.remove(log_path)
+        return {'ok': True}
+
+    if op == 'status':
+        return {'ok': True, 'running': list(hosting.processes)}
+
+    return {'ok': False, 'error': f"Unknown op {op}"}
+
+
+def heartbeat_loop(hosting, args):
+    import psutil
+
+    while True:
+        request = {
+            'op': 'heartbeat',
+            'worker_id': args.id,
+            'address': args.advertise or args.listen,
+            'capacity': args.capacity,
+            'running': list(hosting.processes),
+            'memory_percent': psutil.virtual_memory().percent
+        }
+        try:
+            response = hosting.rpc_call(args.control, request, timeout=5)
+        except OSError as e:
+            hosting.logger.error(f"Heartbeat to {args.control} failed: {e}")
+        else:
+            if missing_modules(hosting, response.get('modules')) and not module_lock.locked():
+                threading.Thread(target=install_modules, args=(hosting, response['modules']),
+                                 name='install-modules', daemon=True).start()
+        time.sleep(hosting.CLUSTER_HEARTBEAT_INTERVAL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ULTIMINE Hosting worker agent")
+    parser.add_argument('--id', required=True, help='unique worker name')
+    parser.add_argument('--listen', required=True, help='host:port or unix:/path for RPCs from the control plane')
+    parser.add_argument('--advertise', help='address the control plane should use, if different from --listen')
+    parser.add_argument('--control', required=True, help='control plane CLUSTER_LISTEN address')
+    parser.add_argument('--capacity', type=int, default=50, help='max scripts this worker runs')
+    parser.add_argument('--data-dir', required=True)
+    args = parser.parse_args()
+
+    if not os.environ.get('CLUSTER_SECRET'):
+        parser.error("set CLUSTER_SECRET to the control plane's shared secret")
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    os.environ['DATA_DIR'] = args.data_dir
+    os.environ.pop('CLUSTER_LISTEN', None)  # this process runs scripts locally
+
+    import ultiminehosting as hosting
+
+    hosting.load_data()  # modules installed by earlier runs
+    hosting.serve_rpc(args.listen, lambda request: handle_request(hosting, request))
+    hosting.logger.info(f"Worker {args.id} listening on {args.listen}, capacity {args.capacity}")
+    heartbeat_loop(hosting, args)
+
+
+if __name__ == '__main__':
+    main()